@@ -137,13 +137,36 @@ int main(int argc, char *argv[])
 
 void readFifoLoop(){
   APPacket pkt;
+	// Each module needs TX_MODULE_DELAY_MS after a send, the others can send
+	// meanwhile. The gateway paces and interleaves the modules the same way.
+	steady_clock::time_point next_tx[5];
 	cout << "Waiting for data in TX_FIFO (" << TX_FIFO_PATH << ")" << endl;
 	
+	FILE *tx_fifo = NULL;
 	while(1){
-		FILE *tx_fifo = fopen(TX_FIFO_PATH, "r");
-		fread(&pkt, sizeof(pkt), 1, tx_fifo);
+		// Keep TX_FIFO open as long as a writer holds it, the gateway
+		// pads every packet to sizeof(APPacket) and may write several at once
+		if(tx_fifo == NULL){
+			tx_fifo = fopen(TX_FIFO_PATH, "r");
+			if(tx_fifo == NULL){
+				cout << "error opening " << TX_FIFO_PATH << endl;
+				bcm2835_delay(1000);
+				continue;
+			}
+		}
+		memset(&pkt, 0, sizeof(pkt));
+		size_t n = fread(&pkt, 1, sizeof(pkt), tx_fifo);
+		if(n < 5){
+			// EOF, all writers closed the FIFO
+			fclose(tx_fifo);
+			tx_fifo = NULL;
+			continue;
+		}
         //~ cout << "sending " << pkt.packet.payload << " on module: " << (int)pkt.module_num << endl;
 
+    if(pkt.module_num >= 1 && pkt.module_num <= 4){
+      this_thread::sleep_until(next_tx[pkt.module_num]);
+    }
     switch(pkt.module_num){
       case 1:
         cc1200_m1.send(pkt.packet);
@@ -164,9 +187,9 @@ void readFifoLoop(){
       default:
         cout << "invalid module number: " << pkt.module_num << endl;
     }
-		bcm2835_delay(75); // TODO: Better solution with interrupts  semaphores...
-		
-		fclose(tx_fifo);
+    if(pkt.module_num >= 1 && pkt.module_num <= 4){
+      next_tx[pkt.module_num] = steady_clock::now() + milliseconds(TX_MODULE_DELAY_MS);
+    }
 	}
 }
 
@@ -196,10 +219,11 @@ void handlePacket(CCPHYPacket& packet, CC1200& module){
   
 	FILE *rx_fifo = fopen(RX_FIFO_PATH, "a");
 	int len = packet.length + 4 + sizeof(p.module_num);
-	//~ fwrite(&p, len, 1, rx_fifo);
-	//~ int len = packet.length + 4 + sizeof(p.module_num);
-	//~ printf("writing to fifo (%d bytes): %*s\n", len, len, &p);
-	fprintf(rx_fifo, "%*s\r\n", packet.length + 4 + sizeof(p.module_num), &p);
+	// Raw frame: module, status1, status2, length, address, payload[length], "\r\n".
+	// The gateway delimits frames by the length byte, "\r\n" is only checked
+	// to resynchronise. fprintf("%s") would stop at the first 0 byte.
+	fwrite(&p, len, 1, rx_fifo);
+	fputs("\r\n", rx_fifo);
 	fclose(rx_fifo);
 	//~ cout << "written " << len << " Bytes to RX_FIFO" << endl;
 }
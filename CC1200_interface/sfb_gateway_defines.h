@@ -38,6 +38,9 @@
 #define CRC_OK_BYTE(x) (x & CRC_OK_BIT)
 #define PACKET_CRC_OK(x) (x.statusbyte2 & CRC_OK_BIT)
 
+// Pause of a module after sending, gateway_interface.py tx_module_interval
+#define TX_MODULE_DELAY_MS  75
+
 #define LED_DATA_PIN  RPI_V2_GPIO_P1_35
 #define LED_CLK_PIN   RPI_V2_GPIO_P1_37
 
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for provisioning a hall with SETI commands.
+
+TX_FIFO is replaced by a responder that answers every SETI Q through
+LineReader after latency seconds, like a PhyNode on the air would.
+
+    before  one request at a time, send and wait for the reply
+            (what seti_script.sh did through /gateway/SETI, without the
+            sleep 0.5s between the curls)
+    after   BatchRunner, commands spread over the modules, up to
+            batch_inflight requests per module on the air
+
+Run from the repository root:
+    python3 benchmarks/bench_batch.py [commands] [latency]
+"""
+
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gateway_interface
+from gateway_interface import (
+    DHCP,
+    BatchRunner,
+    CCPhyParser,
+    LineReader,
+    Preserver,
+    RadioStats,
+)
+
+
+class NullMqtt:
+    def publish(self, *args, **kwargs):
+        pass
+
+
+class Responder:
+    def __init__(self, parser, latency):
+        self.parser = parser
+        self.latency = latency
+
+    def submit(self, data, callback=None, priority=None):
+        payload = bytes(data[5 : 5 + data[3]]).decode()
+        instr, mode, seqnr = payload.split(" ")[:3]
+        timer = threading.Timer(
+            self.latency, self.parser.parse_line, args=("SETI R " + seqnr,)
+        )
+        timer.start()
+        future = Future()
+        future.set_result(len(data))
+        return future
+
+
+def commands(count):
+    return [
+        {
+            "instr": "SETI",
+            "addr": 10 + index % 200,
+            "itemdescr": 1000 + index,
+            "amount": 100,
+            "module": 1 + index % 3,
+        }
+        for index in range(0, count)
+    ]
+
+
+def run_legacy(proto, items, timeout):
+    ok = 0
+    for item in items:
+        pending = proto.expect()
+        payload = proto.create_set_item_request(
+            item["addr"], item["itemdescr"], item["amount"], seqnr=pending.seqnr
+        )
+        gateway_interface.APPacket(item["module"], item["addr"], payload).send()
+        if proto.wait_for(pending, timeout):
+            ok += 1
+    return ok
+
+
+def run_batch(proto, items, timeout):
+    runner = BatchRunner(proto, inflight=8, timeout=timeout)
+    return sum(result["ok"] for result in runner.run(items))
+
+
+if __name__ == "__main__":
+    gateway_interface.log = lambda level, topic, message, *args: None
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.02
+    items = commands(count)
+
+    proto = CCPhyParser()
+    preserver = Preserver(NullMqtt())
+    parser = LineReader(RadioStats(proto), DHCP(proto), preserver, proto)
+    gateway_interface.tx_writer = Responder(parser, latency)
+
+    print("commands: {:d}, latency: {:.3f} s".format(count, latency))
+    for name, run in [("before", run_legacy), ("after", run_batch)]:
+        start = time.perf_counter()
+        ok = run(proto, items, 1.0)
+        print("{:7s} {:8.3f} s  ok: {:d}".format(name, time.perf_counter() - start, ok))
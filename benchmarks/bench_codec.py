@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+"""
+Size and airtime of the ASCII and the binary over-the-air encoding.
+
+Every message type is encoded with typical values as ASCII, "binary"
+(varints + CRC-8) and "compact" (varints only), decoded back and checked.
+The airtime is for the radio settings in CC1200_RPi_reg_config.h: 38.4
+kbps 2-GFSK, 24 bytes preamble, 4 bytes sync word, length and address
+byte and the CRC-16 of the CC1200.
+
+Run from the repository root:
+    python3 benchmarks/bench_codec.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gateway_interface import BinaryCodec
+
+BITRATE = 38400
+# preamble + sync word + length + address + CRC-16
+FRAME_OVERHEAD = 24 + 4 + 1 + 1 + 2
+
+MESSAGES = [
+    b"PING Q 17",
+    b"PING R 17",
+    b"DUID Q 17",
+    b"DUID R 17 10502 14",
+    b"SADR Q 17 10502 14",
+    b"SADR R 17 ACK",
+    b"CHNL R 17 ACK",
+    b"POLL Q 17 4711 1003",
+    b"POLL R 17 4711 3 14 87",
+    b"ENUM R 17 1003 12 14 4711 3",
+    b"RSVE Q 17 4711 3",
+    b"RSVE R 17 4711",
+    b"SETI Q 17 1003 12",
+    b"SETI R 17",
+    b"NTFY M 1003 3",
+    b"STRT M",
+    b"RSTO M 14 10502 4711",
+    b"FULE M 14 95",
+]
+
+
+def airtime(size):
+    return (FRAME_OVERHEAD + size) * 8 / BITRATE * 1000
+
+
+if __name__ == "__main__":
+    codec = BinaryCodec()
+    totals = [0, 0, 0]
+    print(
+        "{:30s} {:>5s} {:>6s} {:>7s}   {:>7s} {:>7s} {:>7s}".format(
+            "message", "ascii", "binary", "compact", "ascii", "binary", "compact"
+        )
+    )
+    for line in MESSAGES:
+        sizes = [len(line)]
+        for encoding in ["binary", "compact"]:
+            payload = codec.encode(line, encoding)
+            assert codec.decode(payload) == line, (line, payload)
+            sizes.append(len(payload))
+        totals = [total + size for total, size in zip(totals, sizes)]
+        print(
+            "{:30s} {:5d} {:6d} {:7d}   {:5.2f}ms {:5.2f}ms {:5.2f}ms".format(
+                line.decode(), *sizes, *map(airtime, sizes)
+            )
+        )
+    # Every message is its own frame
+    print(
+        "{:30s} {:5d} {:6d} {:7d}   {:5.1f}ms {:5.1f}ms {:5.1f}ms".format(
+            "total",
+            *totals,
+            *[
+                (FRAME_OVERHEAD * len(MESSAGES) + total) * 8 / BITRATE * 1000
+                for total in totals
+            ]
+        )
+    )
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for taking the inventory of a hall with DUID broadcasts.
+
+TX_FIFO is replaced by a simulated population. Every node answers a DUID
+broadcast on every module it was sent on, and a reply collides with every
+other reply on the same module that is on air at the same time (like
+sfb_simulator.py). The replies that get through are handed to LineReader
+at the end of their transmission.
+
+    before  one broadcast with broadcast_window, the nodes answer within
+            latency (what /gateway/DUID did)
+    after   Discovery, rounds of slotted replies until the estimated
+            number of nodes is heard
+
+Run from the repository root:
+    python3 benchmarks/bench_discovery.py [nodes] [slot in ms]
+"""
+
+import heapq
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gateway_interface
+from gateway_interface import (
+    DHCP,
+    CCPhyParser,
+    Discovery,
+    FanOut,
+    LineReader,
+    Preserver,
+    RadioStats,
+)
+from sfb_simulator import airtime
+
+
+class NullMqtt:
+    def publish(self, *args, **kwargs):
+        pass
+
+
+class Population:
+    def __init__(self, parser, count, latency=(0.005, 0.05)):
+        self.parser = parser
+        self.nodes = [(30000 + index, 48) for index in range(0, count)]
+        self.latency = latency
+        self.collided = 0
+        self.__air = []
+        self.__cond = threading.Condition()
+        threading.Thread(target=self._air_loop, daemon=True).start()
+
+    def submit(self, data, callback=None, priority=None):
+        module = data[0]
+        fields = bytes(data[5 : 5 + data[3]]).decode().split(" ")
+        now = time.monotonic()
+        replies = []
+        for uid, phyaddr in self.nodes:
+            if len(fields) >= 5:
+                slot = random.randrange(0, int(fields[3])) * int(fields[4]) / 1000
+                start = now + self.latency[0] + slot
+            else:
+                start = now + random.uniform(*self.latency)
+            line = "DUID R {} {} {}".format(fields[2], uid, phyaddr)
+            replies.append((start, start + airtime(len(line)), line))
+        replies.sort()
+
+        last_end = 0.0
+        with self.__cond:
+            for index, (start, end, line) in enumerate(replies):
+                following = index + 1 < len(replies) and replies[index + 1][0] < end
+                if start < last_end or following:
+                    self.collided += 1
+                else:
+                    heapq.heappush(self.__air, (end, module, line))
+                last_end = max(last_end, end)
+            self.__cond.notify_all()
+        future = Future()
+        future.set_result(len(data))
+        return future
+
+    def _air_loop(self):
+        while True:
+            with self.__cond:
+                while not self.__air or self.__air[0][0] > time.monotonic():
+                    self.__cond.wait(
+                        self.__air[0][0] - time.monotonic() if self.__air else None
+                    )
+                end, module, line = heapq.heappop(self.__air)
+            self.parser.parse_line(line, module=module, rssi=0xB0)
+
+
+def run_legacy(proto, modules, window):
+    nodes = FanOut(proto).request(
+        modules,
+        0,
+        lambda seqnr: proto.create_duid_request(0, seqnr=seqnr),
+        window,
+        key=lambda reply: reply["uid"],
+    )
+    return len(nodes), 1
+
+
+def run_discovery(proto, modules, slot):
+    result = Discovery(proto, slot=slot).run("DUID", modules)
+    for number, row in enumerate(result["rounds"]):
+        print(
+            "        round {:2d}: {:4d} slots  {:4d} heard  {:4d} new  "
+            "estimate {}  unheard {}".format(
+                number + 1,
+                row["slots"],
+                row["heard"],
+                row["new"],
+                row["estimate"],
+                row["unheard"],
+            )
+        )
+    return len(result["nodes"]), len(result["rounds"])
+
+
+if __name__ == "__main__":
+    gateway_interface.log = lambda level, topic, message, *args: None
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    slot = (float(sys.argv[2]) if len(sys.argv) > 2 else 15) / 1000
+    modules = [1, 2, 3]
+    random.seed(0)
+
+    proto = CCPhyParser()
+    preserver = Preserver(NullMqtt())
+    parser = LineReader(RadioStats(proto), DHCP(proto, path=""), preserver, proto)
+    population = Population(parser, count)
+    gateway_interface.tx_writer = population
+
+    print("nodes: {:d}, slot: {:.0f} ms".format(count, slot * 1000))
+    for name, run in [
+        ("before", lambda: run_legacy(proto, modules, 2.0)),
+        ("after", lambda: run_discovery(proto, modules, slot)),
+    ]:
+        start = time.perf_counter()
+        heard, rounds = run()
+        print(
+            "{:7s} {:8.3f} s  heard: {:4d}/{:d}  rounds: {:d}".format(
+                name, time.perf_counter() - start, heard, count, rounds
+            )
+        )
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark for LineReader.parse_line on mixed traffic.
+
+The lines are a mix of POLL, DUID, SETI, PING and STAT replies, FULE, LOWE
+and RSTO messages and a few invalid lines, roughly what a POLL round with
+DHCP running looks like.
+
+    before  the if/elif chain of LineReader.parse_line (copied here)
+    after   LineReader with the MessageSchema dispatch
+
+log() and sys.stderr are silenced in both, so only the parsing is timed.
+
+Run from the repository root:
+    python3 benchmarks/bench_line_reader.py [lines]
+"""
+
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gateway_interface
+from gateway_interface import DHCP, CCPhyParser, LineReader, Preserver, RadioStats
+
+
+class NullMqtt:
+    def publish(self, *args, **kwargs):
+        pass
+
+
+class LegacyLineReader(LineReader):
+    def parse_line(self, line, module=None, rssi=None):
+        gateway_interface.log(10, "LINE_READER", str(line) + "\n")
+
+        # Where the line was heard, kept with the reply for fan-out requests
+        source = {"module": module, "rssi": rssi}
+
+        linedata = line.split(" ")
+
+        if len(linedata) < 2:
+            sys.stderr.write("[E] Invalid line: {li}".format(li=line))
+            return
+
+        tmstamp = time.strftime("%H:%M:%S", time.localtime())
+        instr = linedata[0]
+        mode = linedata[1]
+        param = linedata[2:]
+
+        # log(10, 'LINE_READER', 'inst: {} mode: {} param:{}'.format(instr, mode, str(param)))
+
+        # we only care about replies
+        if mode == "R":
+            if instr == "PING":
+                seqnr = int(param[0])
+                # self.stats.log_packet_by_seqnr(seqnr, 'rx')
+                # self.stats.add_pong(seqnr)
+            elif instr == "DUID":
+                # sequence number doesn't matter as the DUID is constant
+                if len(param) != 3:
+                    sys.stderr.write("[E] Parse error: Invalid DUID reply\n")
+                    return
+                seqnr = int(param[0])
+                duid = int(param[1])
+                phyaddr = int(param[2])
+                reply = {"uid": duid, "addr": phyaddr}
+                self.proto.log_by_seqnr(seqnr=seqnr, reply=reply, source=source)
+                # self.stats.log_packet_by_seqnr(seqnr, 'rx')
+                # time.sleep(0.2)
+                # self.dhcp.offer(duid)
+            elif instr == "SADR":
+                if len(param) != 2 or param[1] != "ACK":
+                    sys.stderr.write("[E] Parse error: Invalid SADR reply\n")
+                    return
+                seqnr = int(param[0])
+                reply = {"ack": True}
+                self.proto.log_by_seqnr(seqnr=seqnr, reply=reply, source=source)
+            elif instr == "CHNL":
+                if len(param) != 2 or param[1] != "ACK":
+                    sys.stderr.write("[E] Parse error: Invalid SADR reply\n")
+                    return
+                seqnr = int(param[0])
+                reply = {"ack": True}
+                self.proto.log_by_seqnr(seqnr=seqnr, reply=reply, source=source)
+            elif instr == "STAT":
+                if len(param) != 2:
+                    sys.stderr.write("[E] Parse error: Invalid STAT reply\n")
+                    return
+                seqnr = int(param[0])
+                value = int(param[1])
+                # self.stats.log_packet_by_seqnr(seqnr, 'rx')
+                # self.stats.add_final_stat(seqnr, value)
+            elif instr == "BATS":
+                if len(param) != 2:
+                    sys.stderr.write("[E] Parse error: Invalid BATS reply\n")
+                    return
+                seqnr = int(param[0])
+                reply = {"ack": True}
+                self.proto.log_by_seqnr(seqnr=seqnr, reply=reply, source=source)
+                # self.stats.log_packet_by_seqnr(seqnr, 'rx')
+                # self.stats.add_final_stat(seqnr, value)
+            elif instr == "POLL":
+                if len(param) != 5:
+                    sys.stderr.write("[E] Parse error: Invalid POLL reply\n")
+                    return
+                seqnr = int(param[0])
+                ordernumber = int(param[1])
+                amount = int(param[2])
+                phyaddr = int(param[3])
+                energy = int(param[4])
+                poll = {
+                    "ordernumber": ordernumber,
+                    "amount": amount,
+                    "phyaddr": phyaddr,
+                    "energy": energy,
+                }
+                self.preserver.store_by_ordernumber(poll, tmstamp, seqnr)
+                self.proto.log_by_seqnr(seqnr=seqnr, reply=poll, source=source)
+            elif instr == "ENUM":
+                if len(param) != 6:
+                    sys.stderr.write("[E] Parse error: Invalid POLL reply\n")
+                    return
+                seqnr = int(param[0])
+                itemdescr = int(param[1])
+                amount = int(param[2])
+                phyaddr = int(param[3])
+                ordernumber = int(param[4])
+                orderamount = int(param[5])
+                reply = {
+                    "itemdescr": itemdescr,
+                    "amount": amount,
+                    "phyaddr": phyaddr,
+                    "ordernumber": ordernumber,
+                    "orderamount": orderamount,
+                }
+                self.proto.log_by_seqnr(seqnr=seqnr, reply=reply, source=source)
+            elif instr == "DLVR":
+                if len(param) != 1:
+                    sys.stderr.write("[E] Parse error: Invalid DLVR reply\n")
+                    return
+                seqnr = int(param[0])
+            elif instr == "ISRT":
+                if len(param) != 1:
+                    sys.stderr.write("[E] Parse error: Invalid ISRT reply\n")
+                    return
+                seqnr = int(param[0])
+                reply = {"ack": True}
+                self.proto.log_by_seqnr(seqnr=seqnr, reply=reply, source=source)
+            elif instr == "SETI":
+                if len(param) != 1:
+                    sys.stderr.write("[E] Parse error: Invalid SETI reply\n")
+                    return
+                seqnr = int(param[0])
+                reply = {"ack": True}
+                self.proto.log_by_seqnr(seqnr=seqnr, reply=reply, source=source)
+            elif instr == "RSVE":
+                if len(param) != 2:
+                    sys.stderr.write("[E] Parse error: Invalid STAT reply\n")
+                    return
+                seqnr = int(param[0])
+                ordernumber = int(param[1])
+                reply = {"ordernumber": ordernumber}
+                self.proto.log_by_seqnr(seqnr=seqnr, reply=reply, source=source)
+                self.preserver.block_by_ordernumber(ordernumber)
+            else:
+                pass
+                # TODO might also be something else
+                # self.stats.log_packet(0, 'rx')
+        elif mode == "M":
+            if instr == "RSTO":
+                if len(param) < 3:
+                    sys.stderr.write("[E] Parse error: Invalid RSTO message\n")
+                    return
+                phyaddr = int(param[0])
+                uid = int(param[1])
+                ordernumber = int(param[2])
+                self.preserver.rsto_by_phyaddr(phyaddr, ordernumber)
+            elif instr == "FULE":
+                if len(param) != 2:
+                    sys.stderr.write("[E] Parse error: Invalid FULE message\n")
+                    return
+                phyaddr = int(param[0])
+                energy = int(param[1])
+                self.preserver.update_energy(phyaddr, energy, tmstamp)
+            elif instr == "LOWE":
+                if len(param) != 2:
+                    sys.stderr.write("[E] Parse error: Invalid FULE message\n")
+                    return
+                phyaddr = int(param[0])
+                energy = int(param[1])
+                self.preserver.update_energy(phyaddr, energy, tmstamp)
+
+
+def traffic(count):
+    templates = [
+        "POLL R {seqnr} 1001 {amount} {phyaddr} 90",
+        "POLL R {seqnr} 1001 {amount} {phyaddr} 90",
+        "DUID R {seqnr} {uid} {phyaddr}",
+        "SETI R {seqnr}",
+        "PING R {seqnr}",
+        "STAT R {seqnr} 17",
+        "FULE M {phyaddr} 95",
+        "LOWE M {phyaddr} 12",
+        "RSTO M {phyaddr} {uid} 1001",
+        "SADR R {seqnr} NACK",
+        "XXXX",
+    ]
+    return [
+        random.choice(templates).format(
+            seqnr=random.randrange(0, 255),
+            amount=random.randrange(0, 10),
+            phyaddr=random.randrange(10, 60),
+            uid=random.randrange(1000, 10000),
+        )
+        for i in range(0, count)
+    ]
+
+
+def run(cls, lines):
+    mqttc = NullMqtt()
+    proto = CCPhyParser()
+    preserver = Preserver(mqttc)
+    preserver.publish_information = lambda phynode=None: None
+    reader = cls(RadioStats(proto), DHCP(proto), preserver, proto)
+    start = time.perf_counter()
+    for line in lines:
+        reader.parse_line(line, module=1, rssi=90)
+    return len(lines) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    gateway_interface.log = lambda level, topic, message, *args: None
+    lines = traffic(count)
+    stderr = sys.stderr
+    sys.stderr = io.StringIO()
+    try:
+        # Best of a few interleaved runs, the handlers dominate the noise
+        results = [("before", 0.0), ("after", 0.0)]
+        for i in range(0, 5):
+            results = [
+                (name, max(rate, run(cls, lines)))
+                for (name, rate), cls in zip(results, [LegacyLineReader, LineReader])
+            ]
+    finally:
+        sys.stderr = stderr
+
+    print("lines: {:d}".format(count))
+    for name, rate in results:
+        print("{:7s} {:10.0f} lines/s".format(name, rate))
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""
+Cost of logging on the RX path.
+
+Mixed traffic is handed to GatewayHandler._handle_packet (parsing,
+Preserver, MQTT no-op), with log level INFO and DEBUG:
+
+    none    log() is a no-op, the cost of the RX path without logging
+    before  the old models.log(): format, logging.log() to the log file
+            and print(), all on the calling thread
+    after   models.log(): level check first, queue, written by the
+            logging thread
+
+stdout goes to /dev/null in both, the log file to a temporary directory.
+
+Run from the repository root:
+    python3 benchmarks/bench_logging.py [packets]
+"""
+
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+import gateway_interface
+from gateway_interface import (
+    DHCP,
+    APPacket,
+    CCPacket,
+    CCPhyParser,
+    GatewayHandler,
+    LineReader,
+    Preserver,
+    RadioStats,
+)
+
+from bench_line_reader import traffic
+
+
+class NullMqtt:
+    def publish(self, *args, **kwargs):
+        pass
+
+
+def legacy_log(level, topic, message, *args):
+    # models.log() before the queue, callers formatted their messages
+    if args:
+        message = message.format(*args)
+    logging.log(level, "[{}]: {}".format("{:<20}".format(topic), message))
+    print("[{}]: {}".format("{:<20}".format(topic), message))
+
+
+def use_legacy(filename, level):
+    models.stop_logging()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    handler = logging.FileHandler(filename)
+    handler.setFormatter(logging.Formatter(models.LOG_FORMAT))
+    root.addHandler(handler)
+    root.setLevel(level)
+    gateway_interface.log = legacy_log
+    gateway_interface.log_enabled = lambda level, topic: True
+
+
+def use_queue(filename, level):
+    models.configure_logging(level=level, filename=filename)
+    gateway_interface.log = models.log
+    gateway_interface.log_enabled = models.log_enabled
+
+
+def use_none(filename, level):
+    models.stop_logging()
+    gateway_interface.log = lambda level, topic, message, *args: None
+    gateway_interface.log_enabled = lambda level, topic: False
+
+
+def run(packets):
+    mqttc = NullMqtt()
+    proto = CCPhyParser()
+    preserver = Preserver(mqttc)
+    preserver.publish_information = lambda phynode=None: None
+    parser = LineReader(RadioStats(proto), DHCP(proto), preserver, proto)
+    gateway = GatewayHandler(proto, RadioStats(proto), DHCP(proto), parser, mqttc)
+    models.log_config["dropped"] = 0
+    start = time.perf_counter()
+    for ap_pkt in packets:
+        gateway._handle_packet(ap_pkt)
+    elapsed = time.perf_counter() - start
+    models.stop_logging()
+    return elapsed / len(packets) * 1e6, models.log_config["dropped"]
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    packets = []
+    for index, line in enumerate(traffic(count)):
+        cc = CCPacket(address=0, payload=bytearray(line.encode()))
+        cc.status1 = 0xB0
+        cc.status2 = 0x80
+        packets.append(APPacket(1 + index % 4, cc))
+
+    stdout, stderr = sys.stdout, sys.stderr
+    results = []
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, "w") as devnull:
+        sys.stdout = sys.stderr = devnull
+        try:
+            use_none(None, None)
+            results.append(("none", logging.NOTSET, run(packets)))
+            for name, use in [("before", use_legacy), ("after", use_queue)]:
+                for level in [logging.INFO, logging.DEBUG]:
+                    use(os.path.join(tmp, "{}.log".format(name)), level)
+                    results.append((name, level, run(packets)))
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+    print("packets: {:d}".format(count))
+    for name, level, (usec, dropped) in results:
+        print(
+            "{:7s} {:5s} {:8.2f} us/packet  dropped: {:d}".format(
+                name, logging.getLevelName(level), usec, dropped
+            )
+        )
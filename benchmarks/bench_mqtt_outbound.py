@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for publishing to a slow MQTT broker from the RX path.
+
+Mixed traffic is handed to GatewayHandler._handle_packet, one packet per
+millisecond, every packet is published to /gateway/phynode/replys. The
+MQTT client takes delay seconds per publish and stalls for one hiccup in
+the middle of the run, like a slow TLS link or a broker reconnect.
+
+    before  the client is called on the RX thread
+    after   MqttOutbound, replys batched for batch_window seconds
+
+'rx' is the time the RX path was busy (without the pacing), 'drained' the time until the last
+message was handed to the client.
+
+Run from the repository root:
+    python3 benchmarks/bench_mqtt_outbound.py [packets] [delay] [hiccup]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gateway_interface
+from gateway_interface import (
+    DHCP,
+    APPacket,
+    CCPacket,
+    CCPhyParser,
+    GatewayHandler,
+    LineReader,
+    MqttOutbound,
+    Preserver,
+    RadioStats,
+)
+
+from bench_line_reader import traffic
+
+
+class SlowMqtt:
+    def __init__(self, delay, hiccup, after):
+        self.delay = delay
+        self.hiccup = hiccup
+        self.after = after
+        self.messages = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.messages += 1
+        if self.messages == self.after:
+            time.sleep(self.hiccup)
+        time.sleep(self.delay)
+
+
+def run(packets, mqttc, outbound=None):
+    proto = CCPhyParser()
+    preserver = Preserver(mqttc)
+    preserver.publish_information = lambda phynode=None: None
+    parser = LineReader(RadioStats(proto), DHCP(proto), preserver, proto)
+    gateway = GatewayHandler(
+        proto, RadioStats(proto), DHCP(proto), parser, outbound or mqttc
+    )
+    rx = 0.0
+    start = time.perf_counter()
+    for ap_pkt in packets:
+        handled = time.perf_counter()
+        gateway._handle_packet(ap_pkt)
+        rx += time.perf_counter() - handled
+        time.sleep(0.001)
+    counters = {}
+    if outbound is not None:
+        outbound.stop()
+        counters = outbound.get_counters()
+    return rx, time.perf_counter() - start, mqttc.messages, counters
+
+
+if __name__ == "__main__":
+    gateway_interface.log = lambda level, topic, message, *args: None
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.002
+    hiccup = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+    packets = []
+    for index, line in enumerate(traffic(count)):
+        cc = CCPacket(address=0, payload=bytearray(line.encode()))
+        cc.status1 = 0xB0
+        cc.status2 = 0x80
+        packets.append(APPacket(1 + index % 4, cc))
+
+    before = SlowMqtt(delay, hiccup, count // 2)
+    after = SlowMqtt(delay, hiccup, 5)
+    outbound = MqttOutbound(
+        after,
+        maxsize=count,
+        policy="drop_oldest",
+        batch_topics=["/gateway/phynode/replys"],
+        batch_window=0.1,
+    )
+    stderr = sys.stderr
+    with open(os.devnull, "w") as devnull:
+        sys.stderr = devnull
+        try:
+            results = [
+                ("before", run(packets, before)),
+                ("after", run(packets, after, outbound)),
+            ]
+        finally:
+            sys.stderr = stderr
+
+    print(
+        "packets: {:d}, delay: {:.3f} s, hiccup: {:.3f} s".format(count, delay, hiccup)
+    )
+    for name, (rx, drained, messages, counters) in results:
+        print(
+            "{:7s} rx: {:7.3f} s  drained: {:7.3f} s  messages: {:6d}".format(
+                name, rx, drained, messages
+            )
+        )
+        if counters:
+            print(
+                "        max depth: {max_depth:d}  dropped: {dropped:d}  "
+                "latency avg: {latency_avg:.3f} s  max: {latency_max:.3f} s".format(
+                    **counters
+                )
+            )
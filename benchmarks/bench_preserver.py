@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""
+Scaling benchmark for the Preserver lookups.
+
+The Preserver is filled with 10 to 10,000 PhyNodes and hit with the
+updates LineReader and the Flask routes do for a node: update_energy,
+rsve_by_phyaddr, block_by_ordernumber, rsto_by_phyaddr and get_rsto_status.
+
+    before  linear scans over phynode_list (the old methods, copied here)
+    after   Preserver with the phyaddr, uid and ordernumber indexes
+
+publish_information() and log() are no-ops in both, so only the lookups
+are timed.
+
+Run from the repository root:
+    python3 benchmarks/bench_preserver.py [operations]
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gateway_interface
+from gateway_interface import Preserver
+
+SIZES = [10, 100, 1000, 10000]
+
+
+def phynodes(count):
+    return [
+        {
+            "uid": 1000 + index,
+            "phyaddr": 10 + index,
+            "rsto": False,
+            "ordernumber": 0,
+            "blocked": False,
+            "empty": False,
+            "energy": 0,
+            "energy_timestamp": "",
+            "poll_list": [],
+        }
+        for index in range(0, count)
+    ]
+
+
+class NullMqtt:
+    def publish(self, *args, **kwargs):
+        pass
+
+
+class IndexedPreserver(Preserver):
+    count = 0
+
+    def init(self):
+        return phynodes(self.count)
+
+    def print_phynodelist(self):
+        pass
+
+    def publish_information(self, phynode=None):
+        pass
+
+
+class LegacyPreserver(IndexedPreserver):
+    def update_energy(self, phyaddr, energy, timestamp):
+        for phynode in self.phynode_list:
+            if phynode["phyaddr"] == phyaddr:
+                phynode["energy"] = energy
+                phynode["energy_timestamp"] = timestamp
+
+    def rsve_by_phyaddr(self, phyaddr, ordernumber):
+        for phynode in self.phynode_list:
+            if phynode["phyaddr"] == phyaddr:
+                phynode["ordernumber"] = ordernumber
+                return True
+        return False
+
+    def block_by_ordernumber(self, ordernumber):
+        for phynode in self.phynode_list:
+            if phynode["ordernumber"] == ordernumber:
+                phynode["blocked"] = True
+                return
+
+    def rsto_by_phyaddr(self, phyaddr, ordernumber):
+        found = None
+        for phynode in self.phynode_list:
+            if phynode["phyaddr"] == phyaddr:
+                found = phynode
+        if found is not None and ordernumber != 0:
+            found["blocked"] = False
+            found["ordernumber"] = 0
+            found["rsto"] = True
+
+    def get_rsto_status(self, phyaddr):
+        for phynode in self.phynode_list:
+            if phynode["phyaddr"] == phyaddr:
+                result = phynode["rsto"]
+                phynode["rsto"] = False
+                return result
+
+
+def run(cls, count, operations):
+    cls.count = count
+    preserver = cls(NullMqtt())
+    phyaddrs = [random.randrange(10, 10 + count) for i in range(0, operations)]
+    start = time.perf_counter()
+    for index, phyaddr in enumerate(phyaddrs):
+        ordernumber = 1000 + index
+        preserver.update_energy(phyaddr, 90, "")
+        preserver.rsve_by_phyaddr(phyaddr, ordernumber)
+        preserver.block_by_ordernumber(ordernumber)
+        preserver.rsto_by_phyaddr(phyaddr, ordernumber)
+        preserver.get_rsto_status(phyaddr)
+    return operations / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    gateway_interface.log = lambda level, topic, message, *args: None
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print("{:>6s} {:>16s} {:>16s}".format("nodes", "before [ops/s]", "after [ops/s]"))
+    for count in SIZES:
+        print(
+            "{:6d} {:16.0f} {:16.0f}".format(
+                count,
+                run(LegacyPreserver, count, operations),
+                run(IndexedPreserver, count, operations),
+            )
+        )
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for persisting the Preserver state of a large hall.
+
+The Preserver is filled with nodes PhyNodes and hit with updates as fast
+as possible, mostly update_energy (every POLL and ENRG reply), some
+rsve_by_phyaddr and rsto_by_phyaddr for reservations.
+
+    before  write-through, every change is appended to the log on the
+            request path (the same format, one write per change)
+    after   PreserverStore, the changes are written behind every
+            interval seconds, a PhyNode that changed in between once
+
+'update' is the time the request path took per update, 'drained' the time
+until everything was on disk. The write amplification is the number of
+bytes written (log and checkpoints) per byte of changed PhyNode records.
+Recovery is load() of the checkpoint with the log of the run, and with a
+log that is just below the compaction limit.
+
+Run from the repository root:
+    python3 benchmarks/bench_preserver_store.py [updates] [nodes] [sync]
+"""
+
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gateway_interface
+from gateway_interface import Preserver, PreserverStore
+
+from bench_preserver import phynodes
+
+
+class NullMqtt:
+    def publish(self, *args, **kwargs):
+        pass
+
+
+class HallPreserver(Preserver):
+    count = 0
+
+    def init(self):
+        return phynodes(self.count)
+
+
+class WriteThroughStore(PreserverStore):
+    # Called with the lock of the Preserver held, one write per change
+    def changed(self, phynode):
+        self._write(None, {phynode["phyaddr"]: phynode})
+
+    def replace(self, phynodes):
+        self._write(phynodes, {})
+
+
+def operations(count, nodes):
+    ops = []
+    for index in range(0, count):
+        phyaddr = 10 + random.randrange(0, nodes)
+        kind = random.random()
+        if kind < 0.8:
+            ops.append(("energy", phyaddr, random.randrange(0, 100)))
+        elif kind < 0.9:
+            ops.append(("rsve", phyaddr, 4000 + index))
+        else:
+            ops.append(("rsto", phyaddr, 4000 + index))
+    return ops
+
+
+def record_bytes(preserver, ops):
+    # What the changes would be as single records, without coalescing
+    size = 0
+    for kind, phyaddr, value in ops:
+        size += len(
+            json.dumps(preserver.get_by_phyaddr(phyaddr), separators=(",", ":"))
+        )
+    return size + len(ops)
+
+
+def run(path, store, ops, nodes):
+    HallPreserver.count = nodes
+    preserver = HallPreserver(NullMqtt(), store)
+    # Publishing is benchmarked by bench_state_publish.py
+    preserver.publisher.changed = lambda phynode=None: None
+    store.flush()
+    written = store.get_counters()["bytes"]
+
+    start = time.perf_counter()
+    for kind, phyaddr, value in ops:
+        if kind == "energy":
+            preserver.update_energy(phyaddr, value, "2024-01-01 12:00:00")
+        elif kind == "rsve":
+            preserver.rsve_by_phyaddr(phyaddr, value)
+        else:
+            preserver.rsto_by_phyaddr(phyaddr, value)
+    updated = time.perf_counter() - start
+    store.flush()
+    drained = time.perf_counter() - start
+    store.stop()
+
+    counters = store.get_counters()
+    amplification = (counters["bytes"] - written) / record_bytes(preserver, ops)
+    start = time.perf_counter()
+    recovered = PreserverStore(path).load()
+    recovery = time.perf_counter() - start
+    assert recovered == preserver.phynode_list
+    return updated, drained, amplification, counters, recovery
+
+
+def worst_recovery(path, nodes, sync):
+    # Filled up to the compaction limit, load() replays the whole log
+    store = PreserverStore(path, compact_ratio=float("inf"), sync=sync)
+    store._write(phynodes(nodes), {})
+    limit = 4.0 * os.path.getsize(path)
+    while os.path.getsize(path + ".log") < limit:
+        batch = {}
+        for phynode in random.sample(phynodes(nodes), 1000):
+            phynode["energy"] = random.randrange(0, 100)
+            batch[phynode["phyaddr"]] = phynode
+        store._write(None, batch)
+    store.stop()
+    start = time.perf_counter()
+    PreserverStore(path).load()
+    return time.perf_counter() - start, os.path.getsize(path + ".log")
+
+
+if __name__ == "__main__":
+    gateway_interface.log = lambda level, topic, message, *args: None
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    nodes = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    sync = bool(int(sys.argv[3])) if len(sys.argv) > 3 else True
+    random.seed(0)
+    ops = operations(count, nodes)
+
+    print("updates: {:d}, nodes: {:d}, fsync: {}".format(count, nodes, sync))
+    stdout = sys.stdout
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "preserver_state.json")
+        for name, store in [
+            ("before", WriteThroughStore(path, sync=sync)),
+            ("after", PreserverStore(path, interval=0.5, sync=sync)),
+        ]:
+            # print_phynodelist() prints all PhyNodes
+            with open(os.devnull, "w") as devnull:
+                sys.stdout = devnull
+                try:
+                    results.append((name, run(path, store, ops, nodes)))
+                finally:
+                    sys.stdout = stdout
+            for suffix in ["", ".log"]:
+                os.remove(path + suffix)
+        worst, worst_log = worst_recovery(path, nodes, sync)
+        checkpoint = os.path.getsize(path)
+
+    for name, (updated, drained, amplification, counters, recovery) in results:
+        print(
+            "{:7s} update: {:7.2f} us  drained: {:7.3f} s  written: {:7.1f} MB  "
+            "amplification: {:5.2f}".format(
+                name,
+                updated / count * 1e6,
+                drained,
+                counters["bytes"] / 1e6,
+                amplification,
+            )
+        )
+        print(
+            "        records: {:d}  checkpoints: {:d}  recovery: {:6.1f} ms "
+            "(log {:.1f} MB)".format(
+                counters["records"],
+                counters["checkpoints"],
+                recovery * 1000,
+                counters["log_bytes"] / 1e6,
+            )
+        )
+    print(
+        "recovery at the compaction limit: {:6.1f} ms (checkpoint {:.1f} MB, "
+        "log {:.1f} MB)".format(worst * 1000, checkpoint / 1e6, worst_log / 1e6)
+    )
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+"""
+Burst benchmark for handling decoded RX_FIFO packets.
+
+A broadcast POLL is answered by every PhyNode on every module at once. The
+burst is built from such replies (plus FULE messages) and handed to
+
+    before  _handle_packet() and time.sleep(0.05) per packet in the RX loop
+            (what GatewayHandler._rx_loop did)
+    after   RxWorkerPool.put(), the RX loop returns immediately
+
+'rx loop' is the time the RX loop was busy, which is how long RX_FIFO is
+not read. 'drained' is the time until every packet was handled.
+
+Run from the repository root:
+    python3 benchmarks/bench_rx_burst.py [nodes] [workers]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gateway_interface import (
+    DHCP,
+    APPacket,
+    CCPacket,
+    CCPhyParser,
+    GatewayHandler,
+    LineReader,
+    Preserver,
+    RadioStats,
+    RxWorkerPool,
+)
+
+
+class NullMqtt:
+    def publish(self, *args, **kwargs):
+        pass
+
+
+def burst(nodes):
+    packets = []
+    for phyaddr in range(10, 10 + nodes):
+        for module in range(1, 4):
+            for payload in [
+                "POLL R 7 1001 3 {:d} 90".format(phyaddr),
+                "FULE M {:d} 95".format(phyaddr),
+            ]:
+                cc = CCPacket(address=0, payload=bytearray(payload.encode()))
+                cc.status1 = 0xB0
+                cc.status2 = 0x80
+                packets.append(APPacket(module, cc))
+    return packets
+
+
+def handler():
+    mqttc = NullMqtt()
+    proto = CCPhyParser()
+    dhcp = DHCP(proto)
+    stats = RadioStats(proto)
+    preserver = Preserver(mqttc)
+    parser = LineReader(stats, dhcp, preserver, proto)
+    return GatewayHandler(proto, stats, dhcp, parser, mqttc)
+
+
+def run_legacy(gateway, packets):
+    start = time.perf_counter()
+    for ap_pkt in packets:
+        gateway._handle_packet(ap_pkt)
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    return elapsed, elapsed, 0, 0
+
+
+def run_pool(gateway, packets, workers):
+    pool = RxWorkerPool(gateway._handle_packet, workers=workers)
+    pool.start()
+    start = time.perf_counter()
+    for ap_pkt in packets:
+        pool.put(ap_pkt)
+    rx_loop = time.perf_counter() - start
+    pool.join()
+    drained = time.perf_counter() - start
+    counters = pool.get_counters()
+    pool.stop()
+    return rx_loop, drained, counters["max_depth"], counters["dropped"]
+
+
+if __name__ == "__main__":
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    packets = burst(nodes)
+    gateway = handler()
+
+    results = [
+        ("before", run_legacy(gateway, packets)),
+        ("after", run_pool(gateway, packets, workers)),
+    ]
+
+    print("packets: {:d}, workers: {:d}".format(len(packets), workers))
+    for name, (rx_loop, drained, max_depth, dropped) in results:
+        print(
+            "{:7s} rx loop: {:8.3f} s  drained: {:8.3f} s  max depth: {:d}  "
+            "dropped: {:d}".format(name, rx_loop, drained, max_depth, dropped)
+        )
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+"""
+Throughput benchmark for decoding RX_FIFO traffic.
+
+The recorded PhyNode traffic in CC1200_interface/experiment/data is turned
+into RX_FIFO frames (payload and RSSI of every logged packet, module
+number taken round robin). The stream is written into a pipe as fast as
+possible and decoded on the other end by
+
+    before  read everything, split on b"\r\n", struct.unpack per packet
+            (what GatewayHandler._rx_loop did)
+    after   RxDecoder.readinto() + decode()
+
+Every 100th frame is preceded by two garbage bytes. 'correct' counts the
+frames that came out exactly as they went in. The old decoder also breaks
+every frame whose status bytes, address or payload contain "\r\n".
+
+Run from the repository root:
+    python3 benchmarks/bench_rx_decoder.py [repeat]
+"""
+
+import collections
+import glob
+import io
+import os
+import re
+import struct
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from gateway_interface import CC_MAX_PAYLOAD, APPacket, CCPacket, RxDecoder
+
+LOG_LINE = re.compile(r"^\[.*?\] \| (.*)\t\| (-?\d+)dBm")
+
+
+def recorded_frames():
+    frames = []
+    pattern = os.path.join(ROOT, "CC1200_interface", "experiment", "data", "*.txt")
+    for name in sorted(glob.glob(pattern)):
+        with open(name, errors="replace") as f:
+            for line in f:
+                match = LOG_LINE.match(line)
+                if match is None:
+                    continue
+                payload = match.group(1).encode()[:CC_MAX_PAYLOAD]
+                rssi = int(match.group(2)) & 0xFF
+                module = 1 + len(frames) % 4
+                address = len(frames) % 256
+                frames.append(
+                    (module, rssi, 0x80 | len(frames) % 128, address, payload)
+                )
+    return frames
+
+
+def encode(frame):
+    module, status1, status2, address, payload = frame
+    return bytes([module, status1, status2, len(payload), address]) + payload + b"\r\n"
+
+
+def legacy_decode(stream):
+    result = []
+    data = stream.read()
+    for dat in data.split(b"\r\n"):
+        if len(dat) == 0:
+            break
+        payload_len = len(dat) - 5
+        if payload_len < 0:
+            continue
+        module, status1, status2, length, addr, payload = struct.unpack(
+            "BBBBB%ds" % (payload_len), dat
+        )
+        cc = CCPacket(address=addr, payload=bytearray(payload))
+        cc.status1 = status1
+        cc.status2 = status2
+        result.append(APPacket(module, cc))
+    return result
+
+
+def decoder_decode(stream):
+    result = []
+    decoder = RxDecoder()
+    while decoder.readinto(stream):
+        result.extend(decoder.decode())
+    return result
+
+
+def as_tuple(ap_pkt):
+    cc = ap_pkt.pkt
+    return (ap_pkt.module, cc.status1, cc.status2, cc.address, bytes(cc.payload))
+
+
+def run(data, decode):
+    rfd, wfd = os.pipe()
+
+    def writer():
+        view = memoryview(data)
+        while view:
+            view = view[os.write(wfd, view[:65536]) :]
+        os.close(wfd)
+
+    thread = threading.Thread(target=writer)
+    start = time.perf_counter()
+    thread.start()
+    with io.FileIO(rfd, "r") as stream:
+        result = decode(stream)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    return result, elapsed
+
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    frames = recorded_frames() * repeat
+    # Every 100th frame is preceded by a few garbage bytes, like a write
+    # that was cut short
+    data = b"".join(
+        (b"\x03\x00" if i % 100 == 99 else b"") + encode(frame)
+        for i, frame in enumerate(frames)
+    )
+    print(
+        "{:d} recorded frames, {:.1f} MB".format(len(frames), len(data) / 1e6)
+    )
+
+    for name, decode in [("before", legacy_decode), ("after", decoder_decode)]:
+        result, elapsed = run(data, decode)
+        decoded = collections.Counter(as_tuple(ap_pkt) for ap_pkt in result)
+        correct = sum((decoded & collections.Counter(frames)).values())
+        print(
+            "{:7s} {:10.0f} frames/s  {:8.1f} MB/s  correct: {:d}/{:d}".format(
+                name,
+                len(result) / elapsed,
+                len(data) / elapsed / 1e6,
+                correct,
+                len(frames),
+            )
+        )
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for publishing the PhyNode state during a POLL burst.
+
+Every PhyNode answers a POLL, every reply updates the energy of its node in
+the Preserver, like LineReader does.
+
+    before  json.dumps() and publish of the full phynode_list per change
+            (what Preserver.publish_information() did)
+    after   StatePublisher, deltas collected for publish_window seconds
+
+'bytes' and 'messages' are what went to the MQTT client, 'cpu' is the
+process CPU time of the burst until everything was published.
+
+Run from the repository root:
+    python3 benchmarks/bench_state_publish.py [nodes] [polls]
+"""
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gateway_interface
+from gateway_interface import Preserver
+
+
+class CountingMqtt:
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.messages += 1
+        self.bytes += len(payload)
+
+
+class HallPreserver(Preserver):
+    count = 0
+
+    def init(self):
+        return [
+            {
+                "uid": 1000 + index,
+                "phyaddr": 10 + index,
+                "rsto": False,
+                "ordernumber": 0,
+                "blocked": False,
+                "empty": False,
+                "energy": 0,
+                "energy_timestamp": "",
+                "poll_list": [],
+            }
+            for index in range(0, self.count)
+        ]
+
+
+class LegacyPreserver(HallPreserver):
+    def publish_information(self, phynode=None):
+        with self.lock:
+            payload = json.dumps(self.phynode_list)
+        self.mqtt_client.publish(
+            topic="/gateway/phynode/information",
+            payload=payload,
+            qos=0,
+            retain=False,
+        )
+
+
+def run(cls, count, polls):
+    mqttc = CountingMqtt()
+    cls.count = count
+    preserver = cls(mqttc)
+    if cls is not LegacyPreserver:
+        preserver.publisher.flush()
+    mqttc.messages = mqttc.bytes = 0
+
+    cpu = time.process_time()
+    start = time.perf_counter()
+    for poll in range(0, polls):
+        for phyaddr in range(10, 10 + count):
+            preserver.update_energy(phyaddr, 90 - poll, "12:00:{:02d}".format(poll))
+    if cls is not LegacyPreserver:
+        preserver.publisher.flush()
+        preserver.publisher.stop()
+    return (
+        mqttc.bytes,
+        mqttc.messages,
+        time.process_time() - cpu,
+        time.perf_counter() - start,
+    )
+
+
+if __name__ == "__main__":
+    gateway_interface.log = lambda level, topic, message, *args: None
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    polls = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    print("nodes: {:d}, polls: {:d}".format(count, polls))
+    for name, cls in [("before", LegacyPreserver), ("after", HallPreserver)]:
+        size, messages, cpu, wall = run(cls, count, polls)
+        print(
+            "{:7s} bytes: {:10d}  messages: {:6d}  cpu: {:7.3f} s  wall: {:7.3f} s".format(
+                name, size, messages, cpu, wall
+            )
+        )
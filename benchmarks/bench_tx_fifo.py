@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for the TX path to SFBGateway.app.
+
+A reader thread stands in for readFifoLoop. It consumes AP_PACKET_SIZE
+records from a temporary FIFO and optionally sleeps after every record
+like the 75 ms delay in readFifoLoop.
+
+    before  open(), write() and close() of TX_FIFO for every packet,
+            the reader reopens the FIFO for every packet
+    after   TxWriter, the FIFO stays open on both sides
+
+'caller' is the time until the last send returned, which is what a Flask
+thread waits for. Packets written while the old reader was about to close
+the FIFO are dropped by the kernel, they are reported as lost.
+
+Run from the repository root:
+    python3 benchmarks/bench_tx_fifo.py [packets] [reader delay in ms]
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gateway_interface import AP_PACKET_SIZE, APPacket, CCPhyParser, TxWriter
+
+
+def reader(path, delay, reopen, done, received):
+    while not done.is_set():
+        with open(path, "rb", buffering=0) as fifo:
+            while True:
+                data = fifo.read(AP_PACKET_SIZE)
+                if len(data) == 0:
+                    break
+                received[0] += 1
+                received[1] = time.perf_counter()
+                if delay:
+                    time.sleep(delay)
+                if reopen:
+                    break
+
+
+def run(path, packets, send, delay, reopen):
+    done = threading.Event()
+    received = [0, 0.0]
+    thread = threading.Thread(
+        target=reader, args=(path, delay, reopen, done, received), daemon=True
+    )
+    thread.start()
+    start = time.perf_counter()
+    wait = send(packets)
+    caller = time.perf_counter() - start
+    wait()
+    deadline = time.perf_counter() + 1 + delay * len(packets)
+    while received[0] < len(packets) and time.perf_counter() < deadline:
+        time.sleep(0.001)
+    drained = received[1] - start
+    # Wake the reader from open() and let it finish
+    done.set()
+    time.sleep(0.1 + delay)
+    try:
+        os.close(os.open(path, os.O_WRONLY | os.O_NONBLOCK))
+    except OSError:
+        pass
+    thread.join()
+    return caller, received[0] / drained, len(packets) - received[0]
+
+
+def send_legacy(path):
+    def send(packets):
+        for pkt in packets:
+            # What APPacket.send() did before TxWriter
+            tx_fifo = open(path, "wb")
+            tx_fifo.write(pkt.get_bytes())
+            tx_fifo.close()
+        return lambda: None
+
+    return send
+
+
+def send_writer(path):
+    def send(packets):
+        writer = TxWriter(path, maxsize=len(packets))
+        futures = [writer.submit(pkt.get_bytes()) for pkt in packets]
+
+        def wait():
+            for future in futures:
+                future.result()
+            writer.stop()
+
+        return wait
+
+    return send
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    delay = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.0
+    proto = CCPhyParser()
+    packets = [
+        APPacket(1 + i % 3, 10 + i % 40, proto.create_set_item_request(10, 1001, 100))
+        for i in range(count)
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "sfb_txfifo")
+        os.mkfifo(path)
+        results = [
+            ("before", run(path, packets, send_legacy(path), delay, True)),
+            ("after", run(path, packets, send_writer(path), delay, False)),
+        ]
+
+    print("packets: {:d}, reader delay: {:.0f} ms".format(count, delay * 1000))
+    for name, (caller, rate, lost) in results:
+        print(
+            "{:7s} caller: {:8.3f} s  {:10.0f} packets/s  lost: {:d}".format(
+                name, caller, rate, lost
+            )
+        )
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for the TX scheduler with a SETI burst and one urgent BUTN.
+
+A reader thread stands in for readFifoLoop and records when every packet
+was sent on its module. The burst is spread over the four modules, the
+BUTN for module 1 is submitted after the burst.
+
+    before  arrival order, one FIFO stream, readFifoLoop sleeps 75 ms
+            after every packet (TxWriter without module_interval and
+            everything in one class)
+    after   TxWriter with module_interval 75 ms and priority classes,
+            readFifoLoop pauses 75 ms per module
+
+'drained' is the time until the last packet was sent, 'butn' how long the
+BUTN waited to be sent.
+
+Run from the repository root:
+    python3 benchmarks/bench_tx_scheduler.py [packets] [delay in ms]
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gateway_interface
+from gateway_interface import AP_PACKET_SIZE, APPacket, CCPhyParser, TxWriter
+
+
+def reader(path, count, delay, per_module, sent):
+    next_tx = {}
+    with open(path, "rb", buffering=0) as fifo:
+        while len(sent) < count:
+            record = b""
+            while len(record) < AP_PACKET_SIZE:
+                data = fifo.read(AP_PACKET_SIZE - len(record))
+                if not data:
+                    return
+                record += data
+            module = record[0] if per_module else 0
+            wait = next_tx.get(module, 0.0) - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            sent.append((record[0], record[5:9], time.monotonic()))
+            next_tx[module] = time.monotonic() + delay
+
+
+def run(path, packets, delay, per_module):
+    writer = TxWriter(
+        path, maxsize=len(packets) + 1, module_interval=delay if per_module else 0.0
+    )
+    sent = []
+    thread = threading.Thread(
+        target=reader, args=(path, len(packets) + 1, delay, per_module, sent)
+    )
+    thread.start()
+    start = time.monotonic()
+    for pkt in packets:
+        writer.submit(pkt.get_bytes(), priority="bulk")
+    proto = CCPhyParser()
+    butn = APPacket(1, 0, proto.create_butn_request(0, 1, seqnr=0))
+    butn_at = time.monotonic()
+    # Before there were no priorities, everything went out in arrival order
+    writer.submit(butn.get_bytes(), priority="control" if per_module else "bulk")
+    thread.join()
+    writer.stop()
+    butn_sent = [at for module, instr, at in sent if instr == b"BUTN"][0]
+    return sent[-1][2] - start, butn_sent - butn_at
+
+
+if __name__ == "__main__":
+    gateway_interface.log = lambda level, topic, message, *args: None
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    delay = (float(sys.argv[2]) if len(sys.argv) > 2 else 75) / 1000
+    proto = CCPhyParser()
+    packets = [
+        APPacket(
+            1 + index % 4,
+            10 + index,
+            proto.create_set_item_request(10 + index, 1000 + index, 1, seqnr=index),
+        )
+        for index in range(0, count)
+    ]
+
+    print("packets: {:d}, delay: {:.0f} ms".format(count, delay * 1000))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "txfifo")
+        os.mkfifo(path)
+        for name, per_module in [("before", False), ("after", True)]:
+            drained, butn = run(path, packets, delay, per_module)
+            print(
+                "{:7s} drained: {:7.3f} s  butn: {:7.3f} s".format(name, drained, butn)
+            )
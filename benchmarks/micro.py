@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmarks for the packet and protocol hot paths.
+
+Every benchmark runs without SFBGateway.app, radio or MQTT broker: the
+MQTT client is a no-op and log() is silenced. Each one is timed with
+timeit, the best of --repeat runs is reported in microseconds per call.
+
+    python3 benchmarks/micro.py --output results.json
+    python3 benchmarks/micro.py --baseline results.json --threshold 0.2
+
+With --baseline every benchmark that got slower than the baseline by more
+than threshold (0.2 = 20 %) is flagged and the exit code is 1.
+
+Run from the repository root.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gateway_interface
+from gateway_interface import (
+    DHCP,
+    APPacket,
+    CCPacket,
+    CCPhyParser,
+    GatewayHandler,
+    LineReader,
+    LinkQuality,
+    Preserver,
+    RadioStats,
+)
+
+from bench_line_reader import traffic
+from bench_preserver import phynodes
+
+
+class NullMqtt:
+    def publish(self, *args, **kwargs):
+        pass
+
+
+class HallPreserver(Preserver):
+    count = 14
+
+    def init(self):
+        return phynodes(self.count)
+
+
+def setup(nodes):
+    mqttc = NullMqtt()
+    proto = CCPhyParser()
+    HallPreserver.count = nodes
+    preserver = HallPreserver(mqttc)
+    preserver.publisher.flush()
+    # Publishing is timed by itself, keep the PUBLISHER thread out of the rest
+    preserver.publish_information = lambda phynode=None: None
+    parser = LineReader(RadioStats(proto), DHCP(proto), preserver, proto)
+    gateway = GatewayHandler(proto, RadioStats(proto), DHCP(proto), parser, mqttc)
+    return proto, preserver, parser, gateway
+
+
+def benchmarks(nodes):
+    proto, preserver, parser, gateway = setup(nodes)
+    lines = traffic(1000)
+    packets = []
+    for index, line in enumerate(lines):
+        cc = CCPacket(address=0, payload=bytearray(line.encode()))
+        cc.status1 = 0xB0
+        cc.status2 = 0x80
+        packets.append(APPacket(1 + index % 4, cc))
+    cc = CCPacket(address=10, payload=b"POLL Q 17 4711 1003")
+    ap = APPacket(2, cc)
+    phyaddrs = [random.randrange(10, 10 + nodes) for i in range(0, 1000)]
+    links = LinkQuality()
+    for index, phyaddr in enumerate(phyaddrs):
+        links.record(phyaddr, 1 + index % 4, 0xB0, 0x20, str(index))
+
+    def each(items, func):
+        # One call per item, cycling through the prepared inputs
+        state = {"index": 0}
+
+        def run():
+            index = state["index"]
+            state["index"] = (index + 1) % len(items)
+            func(items[index])
+
+        return run
+
+    def builders():
+        proto.create_ping_request(10, seqnr=1)
+        proto.create_duid_request(0, seqnr=2)
+        proto.create_poll_request(0, 4711, 1003, seqnr=3)
+        proto.create_set_item_request(10, 1003, 12, seqnr=4)
+        proto.create_reserve_request(10, 4711, 3, seqnr=5)
+
+    return {
+        "ccpacket_get_bytes": cc.get_bytes,
+        "appacket_create": lambda: APPacket(2, 10, b"POLL Q 17 4711 1003"),
+        "appacket_get_bytes": ap.get_bytes,
+        "ccphyparser_create_x5": builders,
+        "linereader_parse_line": each(lines, parser.parse_line),
+        "preserver_update_energy": each(
+            phyaddrs, lambda phyaddr: preserver.update_energy(phyaddr, 90, "")
+        ),
+        "preserver_rsve_rsto": each(
+            phyaddrs,
+            lambda phyaddr: (
+                preserver.rsve_by_phyaddr(phyaddr, 4711),
+                preserver.rsto_by_phyaddr(phyaddr, 4711),
+            ),
+        ),
+        "publish_snapshot": preserver.publisher.snapshot,
+        "publish_delta_x10": lambda: preserver.publisher.delta(
+            preserver.phynode_list[:10]
+        ),
+        "gateway_handle_packet": each(packets, gateway._handle_packet),
+        "metrics_inc": lambda: gateway_interface.metrics.inc(
+            "gateway_rx_packets_total", (1,)
+        ),
+        "metrics_observe": lambda: gateway_interface.metrics.observe(
+            "gateway_rx_fifo_latency_seconds", 0.003
+        ),
+        "links_record": each(
+            phyaddrs, lambda phyaddr: links.record(phyaddr, 2, 0xB0, 0x20, "x")
+        ),
+        "links_stats": links.stats,
+    }
+
+
+def run(nodes, repeat):
+    results = {}
+    for name, func in benchmarks(nodes).items():
+        timer = timeit.Timer(func)
+        number, elapsed = timer.autorange()
+        best = min([elapsed] + timer.repeat(repeat=repeat - 1, number=number))
+        results[name] = {"usec": best / number * 1e6, "number": number}
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None:
+            print("{:28s} {:10.2f} us  (new)".format(name, result["usec"]))
+            continue
+        change = result["usec"] / before["usec"] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(
+            "{:28s} {:10.2f} us  {:10.2f} us  {:+7.1%}{}".format(
+                name, before["usec"], result["usec"], change, flag
+            )
+        )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--nodes", type=int, default=14)
+    args = parser.parse_args()
+
+    random.seed(0)
+    gateway_interface.log = lambda level, topic, message, *args: None
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = io.StringIO()
+    try:
+        results = run(args.nodes, args.repeat)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "nodes": args.nodes,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline["results"], args.threshold)
+        if regressions:
+            print(
+                "{:d} regressions above {:.0%}: {}".format(
+                    len(regressions), args.threshold, ", ".join(regressions)
+                )
+            )
+    else:
+        for name, result in sorted(results.items()):
+            print("{:28s} {:10.2f} us".format(name, result["usec"]))
+    sys.exit(1 if regressions else 0)
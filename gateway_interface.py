@@ -1,6 +1,8 @@
+import array
 import struct
 import sys
 import os
+import io
 import subprocess
 import json
 import time
@@ -9,8 +11,16 @@ import configparser
 import serial
 import threading
 import signal
+import queue
+import collections
+import bisect
+import heapq
+import math
+import numpy as np
 
-from models import log
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from models import configure_logging_from, log, log_enabled
 from enum import Enum
 from pathlib import Path
 
@@ -18,6 +28,16 @@ from pathlib import Path
 RX_FIFO = "/tmp/sfb_rxfifo"
 TX_FIFO = "/tmp/sfb_txfifo"
 
+# sizeof(APPacket) in sfb_gateway_defines.h: module_num + CCPHYPacket
+# (4 header bytes + 256 payload bytes). readFifoLoop reads records of this size.
+AP_PACKET_SIZE = 1 + 4 + 256
+
+# Module numbers of the CC1200 modules in sfb_gateway_defines.h
+AP_MODULES = range(1, 5)
+
+# Max. payload of a CCPacket
+CC_MAX_PAYLOAD = 126
+
 
 """
 ############################################################
@@ -44,6 +64,8 @@ if "GatewayServer" not in config_parser or "GatewayInterface" not in config_pars
     sys.exit(-1)
 gs_config = config_parser["GatewayServer"]
 if_config = config_parser["GatewayInterface"]
+if "Logging" in config_parser:
+    configure_logging_from(config_parser["Logging"])
 
 
 """
@@ -135,6 +157,10 @@ class CCPacket:
     def get_rssi(self):
         return self.status1
 
+    def get_lqi(self):
+        # status2: 7 CRC_OK, 6:0 LQI
+        return self.status2 & 0x7F
+
 
 """
 ############################################################
@@ -148,7 +174,7 @@ to TX_FIFO need to have this format.
 
 An APPacket consists of a module number, which is the number of the
 CC1200 module to be used to send a packet / that a packet was received on,
-and can therefore be in [0,4), since there are 4 CC1200 modules in an AP.
+and can therefore be in [1,4], since there are 4 CC1200 modules in an AP.
 
 An APPAcket can be created by passing either a module number + CCPacket
 or a module number, address  and payload to the constructor.
@@ -185,10 +211,10 @@ class APPacket:
                 "[APPacket]: module must be %s but is %s" % (type(int()), type(module))
             )
 
-        if module not in range(0, 4):
+        if module not in AP_MODULES:
             raise ValueError(
                 "[APPacket]: Invalid module number: %d (must be in %s)"
-                % (module, range(0, 4))
+                % (module, AP_MODULES)
             )
 
         self.module = module
@@ -198,20 +224,652 @@ class APPacket:
         cc = CCPacket(address, payload)
         self.init_cc(module, cc)
 
-    def send(self):
+    def get_bytes(self):
         pkt_format = "B%ds" % len(self.pkt)
         pkt = struct.pack(pkt_format, self.module, self.pkt.get_bytes())
-        tx_fifo = open(TX_FIFO, "wb")
-        tx_fifo.write(pkt)
-        tx_fifo.close()
+        return pkt.ljust(AP_PACKET_SIZE, b"\x00")
+
+    def encode(self):
+        # Only here both module and address are known
+        encoding = codec.select(self.module, self.pkt.address)
+        if encoding != "ascii":
+            self.pkt.payload = bytearray(codec.encode(self.pkt.payload, encoding))
+            self.pkt.length = len(self.pkt.payload)
+
+    def send(self, callback=None, priority=None):
+        self.encode()
+        future = tx_writer.submit(self.get_bytes(), callback, priority)
 
         log(
             10,
             "AP_PACKET",
-            "Send {:d} bytes on module {:d}: {} on addr: {}".format(
-                self.pkt.length, self.module, self.pkt.payload, self.pkt.address
-            ),
+            "Queued {:d} bytes on module {:d}: {} on addr: {}",
+            self.pkt.length,
+            self.module,
+            self.pkt.payload,
+            self.pkt.address,
+        )
+        return future
+
+
+"""
+############################################################
+"""
+
+
+"""
+Metrics collects counters and histograms for /metrics and renders them in
+the Prometheus text exposition format.
+
+Families are declared once with counter() or histogram(), inc() and
+observe() take the label values as tuple. Every thread writes into its own
+shard (a dict), so the hot paths take no lock and never wait for each
+other, render() sums the shards. The shards of threads that ended are
+folded into one base shard when a new thread registers or on render(), so
+the request threads of the web server don't pile up shards. Values that
+already exist elsewhere (queue depths, counters of the parser...) are read
+when rendering, by functions registered with gauge():
+
+    metrics.counter("gateway_tx_packets_total", "Packets written", ("module",))
+    metrics.inc("gateway_tx_packets_total", (1,))
+    metrics.gauge("gateway_tx_queue_depth", "Queued packets", tx_writer.qsize)
+
+With enabled False inc() and observe() return right away.
+"""
+
+
+class Metrics:
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.families = {}
+        # (thread, shard) of every thread that wrote, base has the ended ones
+        self.__shards = []
+        self.__base = {}
+        self.__prune_at = 16
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+
+    def __call__(self):
+        return self
+
+    def counter(self, name, description, labels=()):
+        self.families.setdefault(name, ("counter", description, labels, None))
+
+    def histogram(self, name, description, labels=(), buckets=None):
+        buckets = tuple(buckets or self.BUCKETS)
+        self.families.setdefault(name, ("histogram", description, labels, buckets))
+
+    def gauge(self, name, description, func, labels=(), kind="gauge"):
+        # func() returns a value, or a dict of label values to values
+        self.families[name] = (kind, description, labels, func)
+
+    def _shard(self):
+        try:
+            return self.__local.shard
+        except AttributeError:
+            shard = self.__local.shard = {}
+            with self.__lock:
+                if len(self.__shards) >= self.__prune_at:
+                    self._prune()
+                    self.__prune_at = max(16, 2 * len(self.__shards))
+                self.__shards.append((threading.current_thread(), shard))
+            return shard
+
+    @staticmethod
+    def _merge(values, shard):
+        for key, value in shard.items():
+            if isinstance(value, list):
+                total = values.setdefault(key, [0] * len(value))
+                for index, count in enumerate(value):
+                    total[index] += count
+            else:
+                values[key] = values.get(key, 0) + value
+
+    def _prune(self):
+        # Must be called with self.__lock held, an ended thread writes no more
+        alive = []
+        for thread, shard in self.__shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self._merge(self.__base, shard)
+        self.__shards = alive
+
+    def inc(self, name, labels=(), value=1):
+        if not self.enabled:
+            return
+        try:
+            shard = self.__local.shard
+        except AttributeError:
+            shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        if not self.enabled:
+            return
+        shard = self._shard()
+        key = (name, labels)
+        counts = shard.get(key)
+        if counts is None:
+            # One count per bucket, +Inf, then the sum
+            buckets = self.families[name][3]
+            counts = shard[key] = [0] * (len(buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.families[name][3], value)] += 1
+        counts[-1] += value
+
+    def _collect(self):
+        # Sums up the shards, dict.copy() doesn't release the GIL
+        with self.__lock:
+            self._prune()
+            shards = [shard.copy() for thread, shard in self.__shards]
+            values = {}
+            self._merge(values, self.__base)
+        for shard in shards:
+            self._merge(values, shard)
+        return values
+
+    @staticmethod
+    def _labels(names, values, extra=()):
+        pairs = [
+            '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+            for name, value in list(zip(names, values)) + list(extra)
+        ]
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self):
+        values = self._collect()
+        by_name = {}
+        for (name, labels), value in values.items():
+            by_name.setdefault(name, []).append((labels, value))
+        lines = []
+        for name, (kind, description, labels, extra) in sorted(self.families.items()):
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} {}".format(name, kind))
+            if callable(extra):
+                try:
+                    result = extra()
+                except Exception as err:
+                    log(40, "METRICS", "Collecting {} failed: {}", name, err)
+                    continue
+                if not isinstance(result, dict):
+                    result = {(): result}
+                for label_values, value in sorted(result.items()):
+                    if not isinstance(label_values, tuple):
+                        label_values = (label_values,)
+                    lines.append(
+                        "{}{} {}".format(
+                            name, self._labels(labels, label_values), value
+                        )
+                    )
+            elif kind == "histogram":
+                for label_values, counts in sorted(by_name.get(name, [])):
+                    cumulative = 0
+                    for bound, count in zip(extra + ("+Inf",), counts):
+                        cumulative += count
+                        lines.append(
+                            "{}_bucket{} {}".format(
+                                name,
+                                self._labels(labels, label_values, [("le", bound)]),
+                                cumulative,
+                            )
+                        )
+                    lines.append(
+                        "{}_sum{} {}".format(
+                            name, self._labels(labels, label_values), counts[-1]
+                        )
+                    )
+                    lines.append(
+                        "{}_count{} {}".format(
+                            name, self._labels(labels, label_values), cumulative
+                        )
+                    )
+            else:
+                for label_values, value in sorted(by_name.get(name, [])):
+                    lines.append(
+                        "{}{} {}".format(
+                            name, self._labels(labels, label_values), value
+                        )
+                    )
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(if_config.getboolean("metrics", fallback=True))
+
+metrics.counter("gateway_tx_packets_total", "Packets written to TX_FIFO", ("module",))
+metrics.counter(
+    "gateway_tx_bytes_total", "Payload bytes written to TX_FIFO", ("module",)
+)
+metrics.counter(
+    "gateway_tx_address_packets_total",
+    "Packets written to TX_FIFO per destination address",
+    ("address",),
+)
+metrics.histogram(
+    "gateway_tx_queue_seconds",
+    "Time a packet waited in the TX scheduler",
+    ("class",),
+)
+metrics.histogram("gateway_tx_fifo_write_seconds", "Duration of a write() to TX_FIFO")
+metrics.counter("gateway_rx_packets_total", "Packets read from RX_FIFO", ("module",))
+metrics.counter(
+    "gateway_rx_bytes_total", "Payload bytes read from RX_FIFO", ("module",)
+)
+metrics.counter(
+    "gateway_rx_address_packets_total",
+    "Packets read from RX_FIFO per address",
+    ("address",),
+)
+metrics.histogram(
+    "gateway_rx_fifo_latency_seconds",
+    "Time from reading a packet from RX_FIFO until it was handled",
+)
+metrics.counter("gateway_rx_lines_total", "Lines handled by LineReader", ("instr",))
+metrics.histogram(
+    "gateway_mqtt_publish_latency_seconds",
+    "Time a message waited in MqttOutbound until it was handed to the client",
+)
+metrics.counter(
+    "gateway_parse_errors_total",
+    "Lines LineReader could not parse",
+    ("instr",),
+)
+
+
+"""
+############################################################
+"""
+
+
+"""
+TxWriter owns the write end of TX_FIFO and schedules what goes out.
+
+It keeps one queue per CC1200 module and priority class:
+
+    control         resets and buttons (RSTO, RESE, BUTN)
+    interactive     request-reply from the routes, the default
+    bulk            provisioning through /gateway/batch
+    background      statistics
+
+Within a module the classes are served weighted fair (start-time fair
+queueing with the weights), so control traffic overtakes a SETI burst
+without starving it. A module is handed a packet at most every
+module_interval seconds, the pause readFifoLoop makes after sending on a
+module, and the modules are served round robin. So the packets wait here,
+where the priorities apply, and not in the FIFO, and the four modules send
+in parallel. With module_interval 0 everything queued is written at once.
+
+A single TX_LOOP thread writes the packets it takes in one round with one
+write() call, up to max_batch records, and keeps the FIFO open for its
+whole lifetime. Every record is padded to AP_PACKET_SIZE, so readFifoLoop
+can read them back one by one from the open FIFO.
+
+submit() returns a concurrent.futures.Future, which resolves to the number
+of bytes written or fails with the IOError raised by the write. An optional
+callback is attached to the future as done callback. get_counters() has
+the queue latency per class.
+"""
+
+
+class TxWriter:
+    CLASSES = ["control", "interactive", "bulk", "background"]
+
+    def __init__(
+        self,
+        path=TX_FIFO,
+        maxsize=256,
+        max_batch=None,
+        put_timeout=1.0,
+        module_interval=0.0,
+        weights=None,
+    ):
+        self.path = path
+        self.put_timeout = put_timeout
+        # Keep a batch below PIPE_BUF, so a single write() is atomic.
+        self.max_batch = max_batch or max(1, 4096 // AP_PACKET_SIZE)
+        self.maxsize = maxsize
+        self.module_interval = module_interval
+        self.weights = {"control": 8, "interactive": 4, "bulk": 2, "background": 1}
+        self.weights.update(weights or {})
+        self.packets_sent = 0
+        self.writes = 0
+        self.__queues = {
+            module: {cls: collections.deque() for cls in self.CLASSES}
+            for module in AP_MODULES
+        }
+        self.__vtime = {
+            module: {cls: 0.0 for cls in self.CLASSES} for module in AP_MODULES
+        }
+        self.__clock = {module: 0.0 for module in AP_MODULES}
+        self.__next_tx = {module: 0.0 for module in AP_MODULES}
+        self.__rr = collections.deque(AP_MODULES)
+        self.__size = 0
+        self.__stats = {
+            cls: {"sent": 0, "latency_sum": 0.0, "latency_max": 0.0}
+            for cls in self.CLASSES
+        }
+        self.__fd = None
+        self.__stop = True
+        self.__tx_loop = None
+        self.__lock = threading.Lock()
+        self.__cond = threading.Condition()
+
+    def __call__(self):
+        return self
+
+    @staticmethod
+    def _parse_weights(value):
+        # "control:8, bulk:2" -> {"control": 8.0, "bulk": 2.0}
+        result = {}
+        for item in value.split(","):
+            if item.strip():
+                cls, weight = item.split(":")
+                result[cls.strip()] = float(weight)
+        return result
+
+    def start(self):
+        if self.__tx_loop is not None and self.__tx_loop.is_alive():
+            return
+        with self.__lock:
+            if self.__tx_loop is not None and self.__tx_loop.is_alive():
+                return
+            self.__stop = False
+            self.__tx_loop = threading.Thread(
+                name="TX_LOOP", target=self._tx_loop, daemon=True
+            )
+            self.__tx_loop.start()
+
+    def stop(self, timeout=None):
+        with self.__cond:
+            self.__stop = True
+            # Wake up TX_LOOP
+            self.__cond.notify_all()
+        if self.__tx_loop is not None and self.__tx_loop.is_alive():
+            self.__tx_loop.join(timeout)
+        self._close()
+
+    def qsize(self):
+        return self.__size
+
+    def get_counters(self):
+        with self.__cond:
+            classes = {}
+            for cls, stats in self.__stats.items():
+                classes[cls] = {
+                    "depth": sum(len(queues[cls]) for queues in self.__queues.values()),
+                    "sent": stats["sent"],
+                    "latency_avg": (
+                        stats["latency_sum"] / stats["sent"] if stats["sent"] else 0.0
+                    ),
+                    "latency_max": stats["latency_max"],
+                }
+            return {
+                "packets_sent": self.packets_sent,
+                "writes": self.writes,
+                "depth": self.__size,
+                "modules": {
+                    module: sum(len(packets) for packets in queues.values())
+                    for module, queues in self.__queues.items()
+                },
+                "classes": classes,
+            }
+
+    def submit(self, data, callback=None, priority=None):
+        if priority is None:
+            priority = "interactive"
+        if priority not in self.CLASSES:
+            raise ValueError(
+                "Invalid priority {} (must be in {})".format(priority, self.CLASSES)
+            )
+        module = data[0]
+        if module not in self.__queues:
+            raise ValueError(
+                "Invalid module number: {:d} (must be in {})".format(module, AP_MODULES)
+            )
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+
+        self.start()
+        with self.__cond:
+            if not self.__cond.wait_for(
+                lambda: self.__size < self.maxsize, self.put_timeout
+            ):
+                raise IOError(
+                    "TX queue is full ({:d} packets pending)".format(self.maxsize)
+                )
+            packets = self.__queues[module][priority]
+            if not packets:
+                # An idle class doesn't save up credit
+                vtime = self.__vtime[module]
+                vtime[priority] = max(vtime[priority], self.__clock[module])
+            packets.append((data, future, priority, time.monotonic()))
+            self.__size += 1
+            self.__cond.notify_all()
+        return future
+
+    def _dequeue(self, module):
+        # Must be called with self.__cond held, the module has packets
+        queues = self.__queues[module]
+        vtime = self.__vtime[module]
+        cls = min(
+            (cls for cls in self.CLASSES if queues[cls]), key=lambda cls: vtime[cls]
         )
+        self.__clock[module] = vtime[cls]
+        vtime[cls] += 1.0 / self.weights[cls]
+        self.__size -= 1
+        return queues[cls].popleft()
+
+    def _take(self):
+        # Must be called with self.__cond held. Returns the packets to
+        # write now and how long to wait if there are none.
+        now = time.monotonic()
+        batch = []
+        while len(batch) < self.max_batch:
+            taken = False
+            for module in list(self.__rr):
+                if len(batch) >= self.max_batch:
+                    break
+                if self.__next_tx[module] > now:
+                    continue
+                if not any(self.__queues[module].values()):
+                    continue
+                batch.append(self._dequeue(module))
+                self.__rr.remove(module)
+                self.__rr.append(module)
+                taken = True
+                if self.module_interval > 0:
+                    self.__next_tx[module] = now + self.module_interval
+            if not taken:
+                break
+        self.__cond.notify_all()
+        if batch:
+            return batch, None
+        waiting = [
+            self.__next_tx[module]
+            for module, queues in self.__queues.items()
+            if any(queues.values())
+        ]
+        return batch, (min(waiting) - now if waiting else None)
+
+    def _open(self):
+        if self.__fd is None:
+            # Blocks until SFBGateway.app opened the FIFO for reading
+            self.__fd = os.open(self.path, os.O_WRONLY)
+            log(10, "TX_LOOP", "Opened {}".format(self.path))
+        return self.__fd
+
+    def _close(self):
+        if self.__fd is not None:
+            try:
+                os.close(self.__fd)
+            except OSError:
+                pass
+            self.__fd = None
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view:
+            written = os.write(self._open(), view)
+            view = view[written:]
+
+    def _tx_loop(self):
+        log(10, "TX_LOOP", "Started!")
+        while True:
+            with self.__cond:
+                batch, timeout = self._take()
+                while not batch and not self.__stop:
+                    self.__cond.wait(timeout)
+                    batch, timeout = self._take()
+                if self.__stop:
+                    for item in batch:
+                        item[1].set_exception(IOError("TX_LOOP stopped"))
+                    break
+
+            data = b"".join(item[0] for item in batch)
+            started = time.monotonic()
+            try:
+                try:
+                    self._write(data)
+                except BrokenPipeError:
+                    # The reader went away, reopen once and try again
+                    self._close()
+                    self._write(data)
+            except Exception as err:
+                self._close()
+                log(40, "TX_LOOP", "Write to {} failed: {}".format(self.path, err))
+                for item in batch:
+                    item[1].set_exception(IOError(str(err)))
+                continue
+
+            now = time.monotonic()
+            metrics.observe("gateway_tx_fifo_write_seconds", now - started)
+            with self.__cond:
+                self.writes += 1
+                self.packets_sent += len(batch)
+                for data, future, cls, queued_at in batch:
+                    stats = self.__stats[cls]
+                    stats["sent"] += 1
+                    stats["latency_sum"] += now - queued_at
+                    stats["latency_max"] = max(stats["latency_max"], now - queued_at)
+            for data, future, cls, queued_at in batch:
+                # module, status1, status2, length, address
+                metrics.inc("gateway_tx_packets_total", (data[0],))
+                metrics.inc("gateway_tx_bytes_total", (data[0],), data[3])
+                metrics.inc("gateway_tx_address_packets_total", (data[4],))
+                metrics.observe("gateway_tx_queue_seconds", now - queued_at, (cls,))
+            for item in batch:
+                item[1].set_result(len(item[0]))
+        self._close()
+        log(10, "TX_LOOP", "Stopped!")
+
+
+tx_writer = TxWriter(
+    TX_FIFO,
+    maxsize=if_config.getint("tx_queue_size", fallback=256),
+    module_interval=if_config.getfloat("tx_module_interval", fallback=0.075),
+    weights=TxWriter._parse_weights(if_config.get("tx_weights", fallback="")),
+)
+
+
+"""
+############################################################
+"""
+
+
+"""
+RxDecoder turns the byte stream read from RX_FIFO back into APPackets.
+
+SFBGateway.app writes every received packet as
+    module, status1, status2, length, address, payload[length], "\r\n"
+Frames are delimited by the length byte, so a status byte, address or
+payload may contain "\r\n". The trailing "\r\n" is only checked to make
+sure the frame is aligned. If a header is implausible or the trailer does
+not match, one byte is dropped and decoding resumes at the next one.
+
+Data is read into a fixed bytearray with readinto(), incomplete frames stay
+in the buffer until the rest was read.
+"""
+
+
+class RxDecoder:
+    HEADER_SIZE = 5
+
+    def __init__(self, size=8192):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        self.frames = 0
+        self.garbage = 0
+
+    def __call__(self):
+        return self
+
+    def _compact(self):
+        if self.start == 0:
+            return
+        pending = self.end - self.start
+        self.buf[0:pending] = self.buf[self.start : self.end]
+        self.start = 0
+        self.end = pending
+
+    def readinto(self, stream):
+        # Returns the number of bytes read, 0 on EOF
+        if self.end == len(self.buf):
+            self._compact()
+        n = stream.readinto(self.view[self.end :])
+        if n:
+            self.end += n
+        return n or 0
+
+    def feed(self, data):
+        data = memoryview(data)
+        while data:
+            if self.end == len(self.buf):
+                self._compact()
+            n = min(len(data), len(self.buf) - self.end)
+            self.view[self.end : self.end + n] = data[:n]
+            self.end += n
+            data = data[n:]
+            yield from self.decode()
+
+    def decode(self):
+        buf = self.buf
+        view = self.view
+        pos = self.start
+        end = self.end
+        header = self.HEADER_SIZE
+        # header + "\r\n"
+        while end - pos >= header + 2:
+            module = buf[pos]
+            length = buf[pos + 3]
+            if module not in AP_MODULES or length == 0 or length > CC_MAX_PAYLOAD:
+                pos += 1
+                self.garbage += 1
+                continue
+
+            payload_end = pos + header + length
+            if payload_end + 2 > end:
+                # Incomplete, wait for more data
+                break
+            if buf[payload_end] != 13 or buf[payload_end + 1] != 10:
+                pos += 1
+                self.garbage += 1
+                continue
+
+            cc = CCPacket(buf[pos + 4], bytearray(view[pos + header : payload_end]))
+            cc.status1 = buf[pos + 1]
+            cc.status2 = buf[pos + 2]
+            self.start = pos = payload_end + 2
+            self.frames += 1
+            yield APPacket(module, cc)
+
+        self.start = pos
+        if self.start == self.end:
+            self.start = self.end = 0
 
 
 """
@@ -243,42 +901,218 @@ class CCPhyStats(Enum):
 """
 
 
+"""
+PendingRequest is handed out by CCPhyParser.expect() for a request that
+was (or is about to be) sent with a given seqnr. Replies with that seqnr
+are added by LineReader (through CCPhyParser.log_by_seqnr) as soon as they
+arrive, and wait() returns once 'expected' replies are in or the deadline
+is reached. With expected=None (broadcasts) wait() always runs until the
+deadline and returns everything that was received until then.
+
+If a key function is given, 'expected' counts distinct keys, so a node
+heard on several modules is only counted once. The module and RSSI every
+reply was received with are kept in 'sources'.
+"""
+
+
+class PendingRequest:
+    def __init__(self, seqnr, expected=1, key=None):
+        self.seqnr = seqnr
+        self.expected = expected
+        self.key = key
+        self.replys = []
+        self.sources = []
+        self.__keys = set()
+        self.__done = threading.Event()
+        # Called once the expected replies are in, e.g. to wake up a waiter
+        # of several requests
+        self.on_done = None
+
+    def add(self, reply, source=None):
+        self.replys.append(reply)
+        self.sources.append(source)
+        if self.key is None:
+            count = len(self.replys)
+        else:
+            self.__keys.add(self.key(reply))
+            count = len(self.__keys)
+        if self.expected is not None and count >= self.expected:
+            self.__done.set()
+            if self.on_done is not None:
+                self.on_done()
+
+    def done(self):
+        return self.__done.is_set()
+
+    def wait(self, timeout):
+        self.__done.wait(timeout)
+        return list(self.replys)
+
+
+"""
+############################################################
+"""
+
+
+"""
+ReplyTable stores replies that arrived while nobody was waiting for their
+seqnr. It has one fixed-size ring buffer per seqnr, entries older than ttl
+seconds are dropped when the slot is read or the seqnr is reused.
+"""
+
+
+class ReplyTable:
+    def __init__(self, size=256, depth=16, ttl=10.0):
+        self.ttl = ttl
+        self.slots = [collections.deque(maxlen=depth) for i in range(0, size)]
+
+    def __len__(self):
+        return sum(len(slot) for slot in self.slots)
+
+    def put(self, seqnr, reply):
+        self.slots[seqnr].append((time.monotonic(), reply))
+
+    def take(self, seqnr):
+        # Returns the valid replies and the number of expired ones
+        slot = self.slots[seqnr]
+        deadline = time.monotonic() - self.ttl
+        result = [reply for tm, reply in slot if tm >= deadline]
+        expired = len(slot) - len(result)
+        slot.clear()
+        return result, expired
+
+    def clear(self, seqnr):
+        expired = len(self.slots[seqnr])
+        self.slots[seqnr].clear()
+        return expired
+
+    def items(self):
+        return [
+            (seqnr, [reply for tm, reply in slot])
+            for seqnr, slot in enumerate(self.slots)
+        ]
+
+
+"""
+############################################################
+"""
+
+
 class CCPhyParser:
-    def __init__(self):
+    def __init__(self, ttl=None, hold=None):
+        if ttl is None:
+            ttl = if_config.getfloat("reply_ttl", fallback=10.0)
+        if hold is None:
+            hold = if_config.getfloat("seqnr_hold", fallback=1.0)
         self.seqnr = 0
-        self.replys_by_seqnr = self.create_list()
+        self.hold = hold
+        self.replys_by_seqnr = ReplyTable(ttl=ttl)
+        self.pending_by_seqnr = {}
+        self.released_at = [float("-inf") for i in range(0, 256)]
+        self.lock = threading.Lock()
+        self.released = threading.Condition(self.lock)
+        self.skipped = 0
+        self.exhausted = 0
+        self.expired = 0
+        self.unmatched = 0
         log(20, "CC_PHY_PARSER", "Initialized!")
 
-    def create_list(self):
-        l = {}.fromkeys([i for i in range(0, 256)])
-        for k in l.keys():
-            l[k] = []
-        return l
-
     def print(self):
-        print(sorted(self.replys_by_seqnr.items()))
+        print([item for item in self.replys_by_seqnr.items() if item[1]])
 
     def get_seqnr(self):
         return self.seqnr
 
-    def log_by_seqnr(self, seqnr, reply):
-        self.replys_by_seqnr[seqnr].append(reply)
+    def get_counters(self):
+        with self.lock:
+            return {
+                "skipped": self.skipped,
+                "exhausted": self.exhausted,
+                "expired": self.expired,
+                "unmatched": self.unmatched,
+                "pending": len(self.pending_by_seqnr),
+                "stored": len(self.replys_by_seqnr),
+            }
+
+    def _next_seqnr(self):
+        # Must be called with self.lock held. Skips seqnrs which still have
+        # an outstanding request or whose request was released (answered or
+        # timed out) less than self.hold seconds ago, so a late reply can't
+        # complete the next request. Seqnrs without a pending request (PING,
+        # BUTN...) are not held. Returns None if no seqnr is free right now.
+        now = time.monotonic()
+        for i in range(0, 255):
+            seqnr = self.seqnr
+            self.seqnr = (self.seqnr + 1) % 255
+            if seqnr in self.pending_by_seqnr:
+                continue
+            if now - self.released_at[seqnr] < self.hold:
+                continue
+            self.skipped += i
+            # Replies left over from the last use of the seqnr
+            self.expired += self.replys_by_seqnr.clear(seqnr)
+            return seqnr
+        return None
+
+    def _allocate(self):
+        # Must be called with self.lock held, waits until a seqnr is free
+        seqnr = self._next_seqnr()
+        if seqnr is None:
+            self.exhausted += 1
+        while seqnr is None:
+            self.released.wait(self.hold / 10)
+            seqnr = self._next_seqnr()
+        return seqnr
+
+    def next_seqnr(self):
+        with self.lock:
+            return self._allocate()
+
+    def log_by_seqnr(self, seqnr, reply, source=None):
+        with self.lock:
+            pending = self.pending_by_seqnr.get(seqnr)
+            if pending is None:
+                self.unmatched += 1
+                self.replys_by_seqnr.put(seqnr, reply)
+            else:
+                pending.add(reply, source)
+
+    def expect(self, expected=1, key=None):
+        with self.lock:
+            pending = PendingRequest(self._allocate(), expected, key)
+            self.pending_by_seqnr[pending.seqnr] = pending
+        return pending
+
+    def release(self, pending):
+        with self.lock:
+            if self.pending_by_seqnr.get(pending.seqnr) is pending:
+                del self.pending_by_seqnr[pending.seqnr]
+                self.released_at[pending.seqnr] = time.monotonic()
+                self.released.notify_all()
+
+    def wait_for(self, pending, timeout):
+        try:
+            return pending.wait(timeout)
+        finally:
+            self.release(pending)
 
     def get_by_seqnr(self, seqnr):
-        result = self.replys_by_seqnr[seqnr]
-        if len(result) != 0:
-            self.replys_by_seqnr[seqnr] = []
+        with self.lock:
+            result, expired = self.replys_by_seqnr.take(seqnr)
+            self.expired += expired
         return result
 
-    def _mkmsg(self, addr, *data):
+    def _mkmsg(self, addr, *data, seqnr=None):
+        if seqnr is None:
+            seqnr = self.next_seqnr()
+
         if len(data) > 1:
             bin_str = self._mkmsg_no_seq(
-                addr, data[0], self.seqnr, " ".join(map(lambda x: str(x), data[1:]))
+                addr, data[0], seqnr, " ".join(map(lambda x: str(x), data[1:]))
             )
         else:
-            bin_str = self._mkmsg_no_seq(addr, data[0], self.seqnr)
+            bin_str = self._mkmsg_no_seq(addr, data[0], seqnr)
 
-        self.seqnr = (self.seqnr + 1) % 255
         return bin_str
 
     def _mkmsg_no_seq(self, addr, *data):
@@ -286,50 +1120,55 @@ class CCPhyParser:
         bin_str = base_str.encode("UTF-8")
         return bin_str
 
-    def create_ping_request(self, addr):
-        return self._mkmsg(addr, "PING Q")
+    def create_ping_request(self, addr, seqnr=None):
+        return self._mkmsg(addr, "PING Q", seqnr=seqnr)
 
-    def create_beacon_request(self, addr):
-        return self._mkmsg(addr, "BECN Q")
+    def create_beacon_request(self, addr, seqnr=None):
+        return self._mkmsg(addr, "BECN Q", seqnr=seqnr)
 
-    def create_duid_request(self, addr):
-        return self._mkmsg(addr, "DUID Q")
+    def create_duid_request(self, addr, seqnr=None, slots=None, slot_ms=None):
+        # With slots every node answers in a random one of slots x slot_ms
+        if slots is None:
+            return self._mkmsg(addr, "DUID Q", seqnr=seqnr)
+        return self._mkmsg(addr, "DUID Q", slots, slot_ms, seqnr=seqnr)
 
-    def create_bats_request(self, addr, energy):
-        return self._mkmsg(addr, "BATS Q", energy)
+    def create_bats_request(self, addr, energy, seqnr=None):
+        return self._mkmsg(addr, "BATS Q", energy, seqnr=seqnr)
 
-    def create_enum_request(self, addr):
-        return self._mkmsg(addr, "ENUM Q")
+    def create_enum_request(self, addr, seqnr=None, slots=None, slot_ms=None):
+        if slots is None:
+            return self._mkmsg(addr, "ENUM Q", seqnr=seqnr)
+        return self._mkmsg(addr, "ENUM Q", slots, slot_ms, seqnr=seqnr)
 
-    def create_sadr_request(self, addr, uid, newaddr):
-        return self._mkmsg(addr, "SADR Q", uid, newaddr)
+    def create_sadr_request(self, addr, uid, newaddr, seqnr=None):
+        return self._mkmsg(addr, "SADR Q", uid, newaddr, seqnr=seqnr)
 
-    def create_chnl_request(self, addr, channel):
-        return self._mkmsg(addr, "CHNL Q", channel)
+    def create_chnl_request(self, addr, channel, seqnr=None):
+        return self._mkmsg(addr, "CHNL Q", channel, seqnr=seqnr)
 
-    def create_poll_request(self, addr, ordernumber, descriptor):
-        return self._mkmsg(addr, "POLL Q", ordernumber, descriptor)
+    def create_poll_request(self, addr, ordernumber, descriptor, seqnr=None):
+        return self._mkmsg(addr, "POLL Q", ordernumber, descriptor, seqnr=seqnr)
 
     def create_notify_msg(self, addr, descriptor, amount):
         return self._mkmsg_no_seq(addr, "NTFY M", descriptor, amount)
 
-    def create_notify_request(self, addr, descriptor, amount):
-        return self._mkmsg(addr, "NTFY Q", descriptor, amount)
+    def create_notify_request(self, addr, descriptor, amount, seqnr=None):
+        return self._mkmsg(addr, "NTFY Q", descriptor, amount, seqnr=seqnr)
 
     def create_deliver_msg(self, addr, amount):
         return self._mkmsg_no_seq(addr, "DLVR M", amount)
 
-    def create_deliver_request(self, addr, amount):
-        return self._mkmsg(addr, "DLVR Q", amount)
+    def create_deliver_request(self, addr, amount, seqnr=None):
+        return self._mkmsg(addr, "DLVR Q", amount, seqnr=seqnr)
 
-    def create_insert_request(self, addr, amount):
-        return self._mkmsg(addr, "ISRT Q", amount)
+    def create_insert_request(self, addr, amount, seqnr=None):
+        return self._mkmsg(addr, "ISRT Q", amount, seqnr=seqnr)
 
-    def create_reserve_request(self, addr, ordernumber, amount):
-        return self._mkmsg(addr, "RSVE Q", ordernumber, amount)
+    def create_reserve_request(self, addr, ordernumber, amount, seqnr=None):
+        return self._mkmsg(addr, "RSVE Q", ordernumber, amount, seqnr=seqnr)
 
-    def create_set_item_request(self, addr, item, amount=0):
-        return self._mkmsg(addr, "SETI Q", item, amount)
+    def create_set_item_request(self, addr, item, amount=0, seqnr=None):
+        return self._mkmsg(addr, "SETI Q", item, amount, seqnr=seqnr)
 
     def create_start_msg(self, addr):
         return self._mkmsg_no_seq(addr, "STRT M")
@@ -337,11 +1176,11 @@ class CCPhyParser:
     def create_stop_msg(self, addr):
         return self._mkmsg_no_seq(addr, "STOP M")
 
-    def create_stat_request(self, addr, item):
-        return self._mkmsg(addr, "STAT Q", item)
+    def create_stat_request(self, addr, item, seqnr=None):
+        return self._mkmsg(addr, "STAT Q", item, seqnr=seqnr)
 
-    def create_butn_request(self, addr, buttonid):
-        return self._mkmsg(addr, "BUTN Q", buttonid)
+    def create_butn_request(self, addr, buttonid, seqnr=None):
+        return self._mkmsg(addr, "BUTN Q", buttonid, seqnr=seqnr)
 
 
 """
@@ -350,17 +1189,24 @@ class CCPhyParser:
 
 
 class RadioStats:
+    # Columns of rows() with their array/struct type codes
+    COLUMNS = (
+        [("TIME", "d"), ("ADDRESS", "q"), ("DUID", "q")]
+        + [(stat.name, "q") for stat in CCPhyStats]
+        + [("AP_TX_SUCCESS_PKG", "q"), ("AP_RX_SUCCESS_PKG", "q")]
+    )
+
     def __init__(self, proto):
         self.pong_count = []
         self.seqnr = 0
         self.proto = proto
         self.final_stats = {}
-        self.reset()
         self.csv_suffix = "generic"
         self.runtime_stats_active = None
         self.runtime_stats = None
         self.seqnr_to_addr = None
-        self.log_prefix = None
+        self.log_prefix = if_config.get("stats_prefix", fallback="radio_stats")
+        self.reset()
         log(20, "RADIO_STATS", "Initialized!")
 
     def reset(self):
@@ -430,7 +1276,27 @@ class RadioStats:
         else:
             self.runtime_stats[addr][direction] += 1
 
-    def dump_stats(self):
+    def rows(self, now=None):
+        # One row per address, -1 for missing values. Runs without a lock
+        # next to the RX path, the addresses are copied up front.
+        if now is None:
+            now = time.time()
+        final_stats = self.final_stats
+        runtime_stats = self.runtime_stats
+        for addr in sorted(final_stats.keys() | runtime_stats.keys()):
+            final = final_stats.get(addr, {})
+            row = [now, addr, -1]
+            for stat in CCPhyStats:
+                data = final.get(stat.name, {}).get("data")
+                row.append(-1 if data is None else data)
+            runtime = runtime_stats.get(addr)
+            if runtime is None:
+                row += [-1, -1]
+            else:
+                row += [runtime["tx"], runtime["rx"]]
+            yield row
+
+    def dump_stats(self, fmt="csv"):
         # print("Sent {ping} pings with an average of {pong:.1f} replies".format(
         # ping = len(self.pong_count),
         # pong = np.mean(self.pong_count)))
@@ -446,40 +1312,29 @@ class RadioStats:
             )
         )
 
-        buf = "ADDRESS,DUID," + ",".join([x.name for x in CCPhyStats])
-        buf += ",AP_TX_SUCCESS_PKG,AP_RX_SUCCESS_PKG\n"
-        for addr in sorted(self.final_stats.keys()):
-            buf += "{addr},{duid}".format(addr=str(addr), duid="-1")
-            str(addr)
-
-            for stat in CCPhyStats:
-                if self.final_stats[addr][stat.name]["data"] is None:
-                    buf += ",-1"
-                else:
-                    buf += "," + str(self.final_stats[addr][stat.name]["data"])
-
-            if addr in self.runtime_stats:
-                buf += "," + str(self.runtime_stats[addr]["tx"])
-                buf += "," + str(self.runtime_stats[addr]["rx"])
-            else:
-                buf += ",-1,-1"
-
-            buf += "\n"
-        print(buf)
-        with open(
-            "{pre}-{suf}.csv".format(pre=self.log_prefix, suf=self.csv_suffix), "w"
-        ) as f:
-            f.write(buf)
-
-    def gather(self, addr):
-        # no clever code - just get that damn data somehow
-        self.final_stats[addr] = dict(
-            [[x.name, {"seqnr": None, "data": None}] for x in CCPhyStats]
+        writer = stats_writer(fmt)
+        path = "{pre}-{suf}.{ext}".format(
+            pre=self.log_prefix, suf=self.csv_suffix, ext=writer.extension
+        )
+        with open(path, "wb") as f:
+            out = writer(f.write, self.COLUMNS)
+            for row in self.rows():
+                out.write(row)
+            out.close()
+        log(20, "RADIO_STATS", "Wrote {:d} rows to {}", out.rows, path)
+        return path
+
+    def gather(self, addr, items=CCPhyStats):
+        # Clears the values of addr that are about to be collected, the
+        # STAT requests are sent by StatCollector
+        final = self.final_stats.setdefault(
+            addr, dict([[x.name, {"seqnr": None, "data": None}] for x in CCPhyStats])
         )
-        for statistic in CCPhyStats:
-            self.final_stats[addr][statistic.name]["seqnr"] = self.proto.get_seqnr()
-            # serial_write(self.proto.create_stat_request(addr, statistic.value))
-            time.sleep(0.200)
+        for statistic in items:
+            final[statistic.name] = {"seqnr": None, "data": None}
+
+    def set_final_stat(self, addr, statistic, data, seqnr=None):
+        self.final_stats[addr][statistic.name] = {"seqnr": seqnr, "data": data}
 
     def add_final_stat(self, seqnr, data):
         for addr in self.final_stats.keys():
@@ -497,205 +1352,262 @@ class RadioStats:
 """
 
 
-class LineReader:
-    def __init__(self, stats, dhcp, preserver, proto):
-        self.stats = stats
-        self.dhcp = dhcp
-        self.preserver = preserver
-        self.proto = proto
-        log(20, "LINE_READER", "Initialized!")
+"""
+Stats exports stream RadioStats.rows() through a writer row by row instead
+of building the whole file in memory. A writer is created with a write
+function (f.write of a file opened in binary mode, or a list's append for
+a streamed HTTP response) and the columns, the header is only written when
+asked for, so both formats can be appended to:
+
+    csv       CsvStatsWriter, header line and one line per row
+    columnar  ColumnarStatsWriter, b"SFBSTATS", version (uint16), length
+              (uint32) and the JSON schema {"columns": [[name, type], ...]}
+              with array type codes, then blocks of up to block_rows rows:
+              the row count (uint32) and every column packed little endian
+              one after the other. read_columnar() reads it back.
+"""
+
+
+class CsvStatsWriter:
+    extension = "csv"
+    mimetype = "text/csv"
+
+    def __init__(self, write, columns, header=True):
+        self.write_bytes = write
+        self.rows = 0
+        if header:
+            self.write_bytes((",".join(name for name, kind in columns) + "\n").encode())
 
     def __call__(self):
         return self
 
-    def parse_line(self, line):
-        log(10, "LINE_READER", str(line) + "\n")
+    def write(self, row):
+        self.write_bytes((",".join(map(str, row)) + "\n").encode())
+        self.rows += 1
+
+    def close(self):
+        pass
+
+
+class ColumnarStatsWriter:
+    extension = "sfbs"
+    mimetype = "application/octet-stream"
+    MAGIC = b"SFBSTATS"
+    VERSION = 1
+
+    def __init__(self, write, columns, header=True, block_rows=1024):
+        self.write_bytes = write
+        self.kinds = [kind for name, kind in columns]
+        self.block_rows = block_rows
+        self.rows = 0
+        self.__block = [array.array(kind) for kind in self.kinds]
+        if header:
+            schema = json.dumps({"columns": [list(column) for column in columns]})
+            schema = schema.encode()
+            self.write_bytes(
+                self.MAGIC + struct.pack("<HI", self.VERSION, len(schema)) + schema
+            )
 
-        linedata = line.split(" ")
+    def __call__(self):
+        return self
 
-        if len(linedata) < 2:
-            sys.stderr.write("[E] Invalid line: {li}".format(li=line))
+    def write(self, row):
+        for column, value in zip(self.__block, row):
+            column.append(value)
+        self.rows += 1
+        if len(self.__block[0]) >= self.block_rows:
+            self.flush()
+
+    def flush(self):
+        count = len(self.__block[0])
+        if not count:
             return
+        block = [struct.pack("<I", count)]
+        for column in self.__block:
+            if sys.byteorder != "little":
+                column.byteswap()
+            block.append(column.tobytes())
+        self.write_bytes(b"".join(block))
+        self.__block = [array.array(kind) for kind in self.kinds]
+
+    def close(self):
+        self.flush()
 
-        tmstamp = time.strftime("%H:%M:%S", time.localtime())
-        instr = linedata[0]
-        mode = linedata[1]
-        param = linedata[2:]
-
-        # log(10, 'LINE_READER', 'inst: {} mode: {} param:{}'.format(instr, mode, str(param)))
-
-        # we only care about replies
-        if mode == "R":
-            if instr == "PING":
-                seqnr = int(param[0])
-                # self.stats.log_packet_by_seqnr(seqnr, 'rx')
-                # self.stats.add_pong(seqnr)
-            elif instr == "DUID":
-                # sequence number doesn't matter as the DUID is constant
-                if len(param) != 3:
-                    sys.stderr.write("[E] Parse error: Invalid DUID reply\n")
-                    return
-                seqnr = int(param[0])
-                duid = int(param[1])
-                phyaddr = int(param[2])
-                reply = {"uid": duid, "addr": phyaddr}
-                self.proto.log_by_seqnr(seqnr=seqnr, reply=reply)
-                # self.stats.log_packet_by_seqnr(seqnr, 'rx')
-                # time.sleep(0.2)
-                # self.dhcp.offer(duid)
-            elif instr == "SADR":
-                if len(param) != 2 or param[1] != "ACK":
-                    sys.stderr.write("[E] Parse error: Invalid SADR reply\n")
-                    return
-                seqnr = int(param[0])
-                reply = {"ack": True}
-                self.proto.log_by_seqnr(seqnr=seqnr, reply=reply)
-            elif instr == "CHNL":
-                if len(param) != 2 or param[1] != "ACK":
-                    sys.stderr.write("[E] Parse error: Invalid SADR reply\n")
-                    return
-                seqnr = int(param[0])
-                reply = {"ack": True}
-                self.proto.log_by_seqnr(seqnr=seqnr, reply=reply)
-            elif instr == "STAT":
-                if len(param) != 2:
-                    sys.stderr.write("[E] Parse error: Invalid STAT reply\n")
-                    return
-                seqnr = int(param[0])
-                value = int(param[1])
-                # self.stats.log_packet_by_seqnr(seqnr, 'rx')
-                # self.stats.add_final_stat(seqnr, value)
-            elif instr == "BATS":
-                if len(param) != 2:
-                    sys.stderr.write("[E] Parse error: Invalid BATS reply\n")
-                    return
-                seqnr = int(param[0])
-                reply = {"ack": True}
-                self.proto.log_by_seqnr(seqnr=seqnr, reply=reply)
-                # self.stats.log_packet_by_seqnr(seqnr, 'rx')
-                # self.stats.add_final_stat(seqnr, value)
-            elif instr == "POLL":
-                if len(param) != 5:
-                    sys.stderr.write("[E] Parse error: Invalid POLL reply\n")
-                    return
-                seqnr = int(param[0])
-                ordernumber = int(param[1])
-                amount = int(param[2])
-                phyaddr = int(param[3])
-                energy = int(param[4])
-                poll = {
-                    "ordernumber": ordernumber,
-                    "amount": amount,
-                    "phyaddr": phyaddr,
-                    "energy": energy,
-                }
-                self.preserver.store_by_ordernumber(poll, tmstamp)
-            elif instr == "ENUM":
-                if len(param) != 6:
-                    sys.stderr.write("[E] Parse error: Invalid POLL reply\n")
-                    return
-                seqnr = int(param[0])
-                itemdescr = int(param[1])
-                amount = int(param[2])
-                phyaddr = int(param[3])
-                ordernumber = int(param[4])
-                orderamount = int(param[5])
-                reply = {
-                    "itemdescr": itemdescr,
-                    "amount": amount,
-                    "phyaddr": phyaddr,
-                    "ordernumber": ordernumber,
-                    "orderamount": orderamount,
-                }
-                self.proto.log_by_seqnr(seqnr, reply)
-            elif instr == "DLVR":
-                if len(param) != 1:
-                    sys.stderr.write("[E] Parse error: Invalid DLVR reply\n")
-                    return
-                seqnr = int(param[0])
-            elif instr == "ISRT":
-                if len(param) != 1:
-                    sys.stderr.write("[E] Parse error: Invalid ISRT reply\n")
-                    return
-                seqnr = int(param[0])
-                reply = {"ack": True}
-                self.proto.log_by_seqnr(seqnr=seqnr, reply=reply)
-            elif instr == "SETI":
-                if len(param) != 1:
-                    sys.stderr.write("[E] Parse error: Invalid SETI reply\n")
-                    return
-                seqnr = int(param[0])
-                reply = {"ack": True}
-                self.proto.log_by_seqnr(seqnr=seqnr, reply=reply)
-            elif instr == "RSVE":
-                if len(param) != 2:
-                    sys.stderr.write("[E] Parse error: Invalid STAT reply\n")
-                    return
-                seqnr = int(param[0])
-                ordernumber = int(param[1])
-                reply = {"ordernumber": ordernumber}
-                self.proto.log_by_seqnr(seqnr=seqnr, reply=reply)
-                self.preserver.block_by_ordernumber(ordernumber)
-            else:
-                pass
-                # TODO might also be something else
-                # self.stats.log_packet(0, 'rx')
-        elif mode == "M":
-            if instr == "RSTO":
-                if len(param) < 3:
-                    sys.stderr.write("[E] Parse error: Invalid RSTO message\n")
-                    return
-                phyaddr = int(param[0])
-                uid = int(param[1])
-                ordernumber = int(param[2])
-                self.preserver.rsto_by_phyaddr(phyaddr, ordernumber)
-            elif instr == "FULE":
-                if len(param) != 2:
-                    sys.stderr.write("[E] Parse error: Invalid FULE message\n")
-                    return
-                phyaddr = int(param[0])
-                energy = int(param[1])
-                self.preserver.update_energy(phyaddr, energy, tmstamp)
-            elif instr == "LOWE":
-                if len(param) != 2:
-                    sys.stderr.write("[E] Parse error: Invalid FULE message\n")
-                    return
-                phyaddr = int(param[0])
-                energy = int(param[1])
-                self.preserver.update_energy(phyaddr, energy, tmstamp)
+
+STATS_WRITERS = {"csv": CsvStatsWriter, "columnar": ColumnarStatsWriter}
+
+
+def stats_writer(fmt):
+    if fmt not in STATS_WRITERS:
+        raise ValueError(
+            "Unknown format {}, expected one of {}".format(
+                fmt, ", ".join(sorted(STATS_WRITERS))
+            )
+        )
+    return STATS_WRITERS[fmt]
+
+
+def read_columnar(f):
+    # Returns the column names and a generator of the rows as tuples
+    magic = ColumnarStatsWriter.MAGIC
+    head = f.read(len(magic) + 6)
+    if head[: len(magic)] != magic:
+        raise ValueError("Not a columnar stats file")
+    version, length = struct.unpack("<HI", head[len(magic) :])
+    if version != ColumnarStatsWriter.VERSION:
+        raise ValueError("Unsupported columnar stats version {}".format(version))
+    columns = json.loads(f.read(length).decode())["columns"]
+
+    def rows():
+        while True:
+            count = f.read(4)
+            if len(count) < 4:
+                return
+            count = struct.unpack("<I", count)[0]
+            block = []
+            for name, kind in columns:
+                column = array.array(kind)
+                column.frombytes(f.read(count * column.itemsize))
+                if sys.byteorder != "little":
+                    column.byteswap()
+                block.append(column)
+            yield from zip(*block)
+
+    return [name for name, kind in columns], rows()
 
 
 """
-############################################################
+StatsExport writes RadioStats exports on its own thread (STATS_EXPORT), so
+neither the RX path nor an HTTP request waits for a large export. Files
+are written to "<path>.tmp" first and renamed when complete. stream()
+returns the export as chunks for a streamed HTTP response instead.
+
+With series_interval > 0 the STATS_SERIES thread appends one row per node
+every series_interval seconds to "<prefix>-series.<extension>", a time
+series of the counters.
 """
 
 
-class SerialReader:
-    def __init__(self, parser):
-        self.recv_buf = ""
-        self.parser = parser
-        log(20, "SERIAL_READER", "Initialized!")
+class StatsExport:
+    def __init__(self, stats, prefix=None, fmt=None, series_interval=None):
+        if prefix is None:
+            prefix = stats.log_prefix
+        if fmt is None:
+            fmt = if_config.get("stats_format", fallback="csv")
+        if series_interval is None:
+            series_interval = if_config.getfloat("stats_series_interval", fallback=0)
+        self.stats = stats
+        self.prefix = prefix
+        self.writer = stats_writer(fmt)
+        self.series_interval = series_interval
+        self.series_path = "{}-series.{}".format(prefix, self.writer.extension)
+        self.exports = 0
+        self.errors = 0
+        self.series_rows = 0
+        self.last = None
+        self.__executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="STATS_EXPORT"
+        )
+        self.__stop = threading.Event()
+        self.__thread = None
 
     def __call__(self):
         return self
 
-    def parse_lines(self, lines):
-        for line in lines:
-            self.parser.parse_line(line)
+    def start(self):
+        if self.series_interval <= 0:
+            return
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__stop.clear()
+        self.__thread = threading.Thread(
+            name="STATS_SERIES", target=self._series_loop, daemon=True
+        )
+        self.__thread.start()
+
+    def stop(self, timeout=None):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+        self.__executor.shutdown(wait=True)
+
+    def export(self, fmt=None, path=None):
+        # Returns the path and a Future that is done once the file is written
+        writer = self.writer if fmt is None else stats_writer(fmt)
+        if path is None:
+            path = "{}-{}.{}".format(
+                self.prefix, time.strftime("%Y%m%d-%H%M%S"), writer.extension
+            )
+        return path, self.__executor.submit(self._export, writer, path)
+
+    def stream(self, fmt=None):
+        writer = self.writer if fmt is None else stats_writer(fmt)
+
+        def chunks():
+            buf = []
+            out = writer(buf.append, self.stats.COLUMNS)
+            for row in self.stats.rows():
+                out.write(row)
+                if buf:
+                    yield b"".join(buf)
+                    buf.clear()
+            out.close()
+            if buf:
+                yield b"".join(buf)
+
+        return writer, chunks()
+
+    def append(self, path=None):
+        # One row per node to the time series, header only for a new file
+        if path is None:
+            path = self.series_path
+        with open(path, "ab") as f:
+            out = self.writer(f.write, self.stats.COLUMNS, header=f.tell() == 0)
+            for row in self.stats.rows():
+                out.write(row)
+            out.close()
+        self.series_rows += out.rows
+        return out.rows
+
+    def get_counters(self):
+        return {
+            "exports": self.exports,
+            "errors": self.errors,
+            "series_rows": self.series_rows,
+            "last": self.last,
+        }
 
-    def data_received(self, data):
+    def _export(self, writer, path):
+        start = time.monotonic()
         try:
-            str_data = data.decode("UTF-8")
-            self.recv_buf += str_data
-            lines = self.recv_buf.split("\n\r")
+            with open(path + ".tmp", "wb") as f:
+                out = writer(f.write, self.stats.COLUMNS)
+                for row in self.stats.rows():
+                    out.write(row)
+                out.close()
+            os.replace(path + ".tmp", path)
+        except Exception as err:
+            self.errors += 1
+            log(40, "STATS_EXPORT", "Export to {} failed: {}", path, err)
+            raise
+        self.exports += 1
+        self.last = {
+            "path": path,
+            "rows": out.rows,
+            "seconds": round(time.monotonic() - start, 3),
+        }
+        log(20, "STATS_EXPORT", "Wrote {:d} rows to {}", out.rows, path)
+        return path
 
-            if len(lines) > 1:
-                self.parse_lines(lines[0:-1])
-                self.recv_buf = lines[-1]
-        except UnicodeDecodeError:
-            sys.stderr.write(
-                "[E] UART output contains garbage: {data}\n".format(data=data)
-            )
+    def _series_loop(self):
+        log(10, "STATS_SERIES", "Started!")
+        while not self.__stop.wait(self.series_interval):
+            try:
+                self.append()
+            except Exception as err:
+                self.errors += 1
+                log(40, "STATS_SERIES", str(err))
+        log(10, "STATS_SERIES", "Stopped!")
 
 
 """
@@ -704,91 +1616,1557 @@ class SerialReader:
 
 
 """
-DHCP duid struct:
-    {
-        duid: number,
-        addr: [0-255],
-        state: ['OFFER_SENT', 'COMPLETE"],
-        seqnr: number
-        ping_cnt: number,
-        pong_cnt: number
-    }
+FanOut sends one request on several CC1200 modules at once and collects
+the replies of all modules in one shared window, instead of sending and
+waiting module by module.
+
+Replies are merged by 'key' (e.g. the phyaddr), so a node heard on several
+modules is returned once. Every entry lists the modules it was heard on
+with their RSSI in 'heard', 'module' and 'rssi' are those of the first
+reply.
 """
 
 
-class DHCP:
+class FanOut:
     def __init__(self, proto):
         self.proto = proto
-        self.by_duid = {}
-        self.by_addr = {}
-        self.next_addr = 1
-        log(20, "DHCP", "Initialized!")
+        log(20, "FAN_OUT", "Initialized!")
 
     def __call__(self):
         return self
 
-    def discover(self):
-        module = gs_config.getint("module")
-        pkt = APPacket(module, 0, self.proto.create_duid_request(0))
-        pkt.send()
-
-    def offer(self, duid):
-        module = gs_config.getint("module")
-        if duid not in self.by_duid:
-            devinfo = {
-                "duid": duid,
-                "addr": self.next_addr,
-                "state": "OFFER_SENT",
-                "seqnr": self.proto.get_seqnr(),
-                "stats": {},
-                "ping_cnt": 0,
-                "pong_cnt": 0,
-            }
-            self.by_duid[duid] = devinfo
-
-            print(
-                "[I] Offering address {addr} to node {duid}".format(
-                    addr=self.next_addr, duid=duid
-                )
-            )
+    def request(self, modules, addr, create, window, expected=None, key=None):
+        # create(seqnr=...) builds the payload for the reserved seqnr
+        pending = self.proto.expect(expected, key)
+        try:
+            payload = create(seqnr=pending.seqnr)
+            for module in modules:
+                APPacket(module, addr, payload).send()
+            pending.wait(window)
+        finally:
+            self.proto.release(pending)
+        return self.merge(pending)
+
+    def merge(self, pending):
+        result = []
+        by_key = {}
+        for reply, source in zip(pending.replys, pending.sources):
+            if source is None:
+                source = {"module": None, "rssi": None}
+            entry = None
+            if pending.key is not None:
+                entry = by_key.get(pending.key(reply))
+            if entry is None:
+                entry = dict(reply)
+                entry["module"] = source["module"]
+                entry["rssi"] = source["rssi"]
+                entry["heard"] = []
+                result.append(entry)
+                if pending.key is not None:
+                    by_key[pending.key(reply)] = entry
+            entry["heard"].append(dict(source))
+        return result
 
-            pkt = APPacket(
-                module, 0, self.proto.create_sadr_request(0, duid, self.next_addr)
-            )
-            pkt.send()
-            # ~ serial_write(proto.create_sadr_request(0, duid, self.next_addr))
-            self.next_addr += 1
-        elif self.by_duid[duid]["state"] != "COMPLETE":
-            self.by_duid[duid]["seqnr"] = self.proto.get_seqnr()
-            pkt = APPacket(
-                module,
-                0,
-                self.proto.create_sadr_request(0, duid, self.by_duid[duid]["addr"]),
-            )
-            pkt.send()
 
-    def ack(self, seqnr):
-        for device in self.by_duid.values():
-            if device["seqnr"] == seqnr:
-                device["state"] = "COMPLETE"
-                self.by_addr[device["addr"]] = device
+"""
+############################################################
+"""
 
-                print(
-                    "[I] node {duid} now has address {addr}".format(
-                        addr=device["addr"], duid=device["duid"]
-                    )
-                )
 
-                return
+"""
+Discovery takes the inventory of the nodes answering a broadcast DUID or
+ENUM in rounds of framed slotted ALOHA. The request carries the number of
+slots and their length, every node answers in one random slot, and only
+the nodes alone in their slot are heard. Nodes ignoring the slots answer
+at once, as before.
+
+Nodes can't be told to stay quiet, so every node answers in every round
+and the rounds are independent samples of the same population. The size
+of the population is estimated from how many of a round's nodes were
+heard before (capture-recapture, Schnabel estimator over all rounds). The
+next frame has estimate / LOAD slots, at this load most time is spent on
+slots with one node. Without recaptures yet, the estimate is e times the
+nodes heard, the population that fills a frame best, and the frame grows
+by four if nobody was heard.
+
+A node is missed by a round with probability 1 - heard / estimate, so
+estimate x the product of that over all rounds nodes are still unheard.
+run() stops when that is below UNHEARD, or when all expected nodes are
+heard:
+
+    {"nodes": [{"uid": 2330, "addr": 10, "module": 1, "rssi": 200,
+                "heard": [...]}, ...],
+     "rounds": [{"slots": 16, "heard": 9, "new": 9, "estimate": 24.5,
+                 "unheard": 9.4}, ...],
+     "estimate": 14.0, "unheard": 0.2, "elapsed": 3.1}
+"""
 
-        sys.stderr.write("[E] Got DHCP ACK for an offer we didn't send\n")
 
-    def clients(self):
-        return sorted(self.by_addr.keys())
+class Discovery:
+    # Nodes per slot the frames are sized for
+    LOAD = 0.7
+    # Expected number of unheard nodes run() stops at
+    UNHEARD = 0.2
+    KEYS = {"DUID": "uid", "ENUM": "phyaddr"}
+
+    def __init__(
+        self,
+        proto,
+        fanout=None,
+        slot=None,
+        slots=None,
+        max_slots=None,
+        max_rounds=None,
+        margin=None,
+    ):
+        if slot is None:
+            slot = gs_config.getfloat("discovery_slot", fallback=0.015)
+        if slots is None:
+            slots = gs_config.getint("discovery_slots", fallback=16)
+        if max_slots is None:
+            max_slots = gs_config.getint("discovery_max_slots", fallback=1024)
+        if max_rounds is None:
+            max_rounds = gs_config.getint("discovery_max_rounds", fallback=16)
+        if margin is None:
+            margin = gs_config.getfloat("discovery_margin", fallback=0.2)
+        self.proto = proto
+        self.fanout = FanOut(proto) if fanout is None else fanout
+        self.slot = slot
+        self.slots = slots
+        self.max_slots = max_slots
+        self.max_rounds = max_rounds
+        self.margin = margin
+        log(20, "DISCOVERY", "Initialized!")
 
-    def dump_stats(self):
-        print("\n\n --- DHCP stats ---\n")
-        print("  DUID  ADDR  STATE")
+    def __call__(self):
+        return self
+
+    def frame(self, estimate):
+        return max(self.slots, min(self.max_slots, math.ceil(estimate / self.LOAD)))
+
+    def run(self, instr="DUID", modules=(1, 2, 3), expected=None):
+        if instr not in self.KEYS:
+            raise ValueError("Discovery with {} is not supported".format(instr))
+        name = self.KEYS[instr]
+        create = {
+            "DUID": self.proto.create_duid_request,
+            "ENUM": self.proto.create_enum_request,
+        }[instr]
+        start = time.monotonic()
+        inventory = {}
+        rounds = []
+        # Schnabel: sum of heard x known before, sum of the recaptures
+        marked = 0
+        recaptured = 0
+        estimate = None
+        unheard = None
+        counts = []
+        slots = self.slots if expected is None else self.frame(expected)
+        for number in range(0, self.max_rounds):
+            pending = self.proto.expect(None, key=lambda reply: reply[name])
+            try:
+                payload = create(
+                    0,
+                    seqnr=pending.seqnr,
+                    slots=slots,
+                    slot_ms=round(self.slot * 1000),
+                )
+                for module in modules:
+                    APPacket(module, 0, payload).send()
+                pending.wait(slots * self.slot + self.margin)
+            finally:
+                self.proto.release(pending)
+
+            heard = self.fanout.merge(pending)
+            known = len(inventory)
+            new = 0
+            for entry in heard:
+                if entry[name] not in inventory:
+                    inventory[entry[name]] = entry
+                    new += 1
+            marked += len(heard) * known
+            recaptured += len(heard) - new
+            counts.append(len(heard))
+
+            if recaptured:
+                estimate = max(len(inventory), marked / recaptured)
+            elif inventory:
+                # Nothing heard twice yet, the population is much larger
+                estimate = max(math.e * len(heard), 2 * (estimate or 0))
+            if estimate is not None:
+                unheard = estimate
+                for count in counts:
+                    unheard *= 1 - min(count, estimate) / estimate
+            rounds.append(
+                {
+                    "slots": slots,
+                    "heard": len(heard),
+                    "new": new,
+                    "estimate": None if estimate is None else round(estimate, 1),
+                    "unheard": None if unheard is None else round(unheard, 2),
+                }
+            )
+            log(
+                20,
+                "DISCOVERY",
+                "Round {:d}: {:d} slots, {:d} heard, {:d} new, estimate {} ({} unheard)",
+                number + 1,
+                slots,
+                len(heard),
+                new,
+                rounds[-1]["estimate"],
+                rounds[-1]["unheard"],
+            )
+
+            if expected is not None and len(inventory) >= expected:
+                break
+            if estimate is None:
+                # Nobody heard: nobody there or every slot collided
+                if slots >= self.max_slots:
+                    break
+                slots = min(self.max_slots, slots * 4)
+                continue
+            if recaptured and unheard < self.UNHEARD:
+                break
+            slots = self.frame(estimate)
+
+        return {
+            "nodes": list(inventory.values()),
+            "rounds": rounds,
+            "estimate": estimate,
+            "unheard": unheard,
+            "elapsed": round(time.monotonic() - start, 3),
+        }
+
+
+"""
+############################################################
+"""
+
+
+"""
+BatchCommand describes one instruction /gateway/batch can send: the fields
+it needs (converted with int), defaults for the optional ones and how to
+build the payload. reply is False for instructions whose reply isn't
+logged by seqnr (PING, BUTN), they are done once they are sent. before is
+called with the Preserver and the fields before sending.
+"""
+
+
+class BatchCommand:
+    def __init__(self, create, fields, defaults=None, reply=True, before=None):
+        self.create = create
+        self.fields = fields
+        self.defaults = defaults or {}
+        self.reply = reply
+        self.before = before
+
+    def __call__(self):
+        return self
+
+    def parse(self, item):
+        # Raises KeyError or ValueError for a missing or invalid field
+        values = dict(self.defaults)
+        for name in self.fields:
+            values[name] = item[name]
+        return {name: int(value) for name, value in values.items()}
+
+
+BATCH_COMMANDS = {
+    "SADR": BatchCommand(
+        lambda proto, f, seqnr: proto.create_sadr_request(
+            f["addr"], f["uid"], f["newAddr"], seqnr=seqnr
+        ),
+        ("addr", "uid", "newAddr"),
+    ),
+    "SETI": BatchCommand(
+        lambda proto, f, seqnr: proto.create_set_item_request(
+            f["addr"], f["itemdescr"], f["amount"], seqnr=seqnr
+        ),
+        ("addr", "itemdescr"),
+        {"amount": 0},
+    ),
+    "CHNL": BatchCommand(
+        lambda proto, f, seqnr: proto.create_chnl_request(
+            f["addr"], f["channel"], seqnr=seqnr
+        ),
+        ("channel",),
+        {"addr": 0},
+    ),
+    "BATS": BatchCommand(
+        lambda proto, f, seqnr: proto.create_bats_request(
+            f["addr"], f["energy"], seqnr=seqnr
+        ),
+        ("addr", "energy"),
+    ),
+    "RSVE": BatchCommand(
+        lambda proto, f, seqnr: proto.create_reserve_request(
+            f["addr"], f["ordernumber"], f["amount"], seqnr=seqnr
+        ),
+        ("addr", "ordernumber", "amount"),
+        before=lambda preserver, f: preserver.rsve_by_phyaddr(
+            f["addr"], f["ordernumber"]
+        ),
+    ),
+    "NTFY": BatchCommand(
+        lambda proto, f, seqnr: proto.create_notify_request(
+            f["addr"], f["itemdescr"], f["amount"], seqnr=seqnr
+        ),
+        ("addr", "itemdescr", "amount"),
+    ),
+    "DLVR": BatchCommand(
+        lambda proto, f, seqnr: proto.create_deliver_request(
+            f["addr"], f["amount"], seqnr=seqnr
+        ),
+        ("addr", "amount"),
+    ),
+    "ISRT": BatchCommand(
+        lambda proto, f, seqnr: proto.create_insert_request(
+            f["addr"], f["amount"], seqnr=seqnr
+        ),
+        ("addr", "amount"),
+    ),
+    "STAT": BatchCommand(
+        lambda proto, f, seqnr: proto.create_stat_request(
+            f["addr"], f["item"], seqnr=seqnr
+        ),
+        ("addr", "item"),
+    ),
+    "PING": BatchCommand(
+        lambda proto, f, seqnr: proto.create_ping_request(f["addr"], seqnr=seqnr),
+        ("addr",),
+        reply=False,
+    ),
+    "BUTN": BatchCommand(
+        lambda proto, f, seqnr: proto.create_butn_request(
+            f["addr"], f["buttonid"], seqnr=seqnr
+        ),
+        ("addr", "buttonid"),
+        reply=False,
+    ),
+}
+
+
+"""
+BatchRunner sends a list of commands like
+
+    {"instr": "SETI", "addr": 10, "itemdescr": 1, "amount": 2, "module": 1}
+
+Commands are grouped into lanes by module. A command without module goes
+out on the best module for its addr according to LinkQuality, if there is
+one, otherwise on all modules and is done with the first reply. Every lane has its
+own BATCH thread with up to inflight requests on the air, each with its
+own seqnr, so the modules work in parallel and no lane waits for a reply
+before sending the next command. They are sent with the runner's priority,
+bulk by default. run() yields one result per command as it completes:
+
+    {"index": 0, "instr": "SETI", "module": 1, "addr": 10, "ok": true,
+     "reply": [...], "error": null, "elapsed": 0.042}
+"""
+
+
+class BatchRunner:
+    def __init__(
+        self,
+        proto,
+        preserver=None,
+        commands=None,
+        modules=None,
+        inflight=None,
+        timeout=None,
+        links=None,
+        priority="bulk",
+    ):
+        if inflight is None:
+            inflight = gs_config.getint("batch_inflight", fallback=8)
+        if timeout is None:
+            timeout = gs_config.getfloat("reply_timeout", fallback=1.0)
+        self.proto = proto
+        self.preserver = preserver
+        self.commands = BATCH_COMMANDS if commands is None else commands
+        self.modules = [1, 2, 3] if modules is None else modules
+        self.inflight = inflight
+        self.timeout = timeout
+        self.links = links
+        self.priority = priority
+        log(20, "BATCH", "Initialized!")
+
+    def __call__(self):
+        return self
+
+    def run(self, items, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        results = queue.Queue()
+        lanes = {}
+        for index, item in enumerate(items):
+            result = {
+                "index": index,
+                "instr": None,
+                "module": None,
+                "addr": None,
+                "ok": False,
+                "reply": None,
+                "error": None,
+                "elapsed": 0.0,
+            }
+            try:
+                result["instr"] = item["instr"]
+                command = self.commands[item["instr"]]
+                fields = command.parse(item)
+                if "module" in item:
+                    modules = (int(item["module"]),)
+                else:
+                    modules = tuple(self.modules)
+                    if self.links is not None and fields["addr"] != 0:
+                        best = self.links.best_module(fields["addr"])
+                        if best is not None:
+                            modules = (best,)
+            except KeyError as err:
+                result["error"] = "{} is not defined".format(err)
+                results.put(result)
+                continue
+            except (TypeError, ValueError) as err:
+                result["error"] = "{}".format(err)
+                results.put(result)
+                continue
+            result["module"] = modules[0] if len(modules) == 1 else list(modules)
+            result["addr"] = fields["addr"]
+            lanes.setdefault(modules, []).append((command, fields, result))
+
+        threads = [
+            threading.Thread(
+                name="BATCH_{}".format("_".join(map(str, modules))),
+                target=self._lane,
+                args=(modules, lane, results, timeout),
+                daemon=True,
+            )
+            for modules, lane in lanes.items()
+        ]
+        for thread in threads:
+            thread.start()
+        for i in range(0, len(items)):
+            yield results.get()
+
+    def _send(self, modules, command, fields, result):
+        # Returns the PendingRequest, None if no reply is expected
+        result["started"] = time.monotonic()
+        if command.before is not None and self.preserver is not None:
+            command.before(self.preserver, fields)
+        pending = None
+        if command.reply:
+            pending = self.proto.expect()
+            seqnr = pending.seqnr
+        else:
+            seqnr = self.proto.next_seqnr()
+        try:
+            payload = command.create(self.proto, fields, seqnr)
+            for module in modules:
+                APPacket(module, fields["addr"], payload).send(priority=self.priority)
+        except Exception:
+            if pending is not None:
+                self.proto.release(pending)
+            raise
+        return pending
+
+    def _finish(self, result, results, reply=None, error=None):
+        result["elapsed"] = round(time.monotonic() - result.pop("started"), 4)
+        result["reply"] = reply
+        result["error"] = error
+        result["ok"] = error is None
+        results.put(result)
+
+    def _lane(self, modules, lane, results, timeout):
+        lane = collections.deque(lane)
+        inflight = collections.deque()
+        wakeup = threading.Event()
+        while lane or inflight:
+            while lane and len(inflight) < self.inflight:
+                command, fields, result = lane.popleft()
+                try:
+                    pending = self._send(modules, command, fields, result)
+                except Exception as err:
+                    self._finish(result, results, error="{}".format(err))
+                    continue
+                if pending is None:
+                    self._finish(result, results, reply=[])
+                else:
+                    pending.on_done = wakeup.set
+                    inflight.append((pending, result, time.monotonic() + timeout))
+            if not inflight:
+                continue
+
+            # Wait for any request to complete or the next deadline, a reply
+            # that comes in after clear() is found by done() below
+            deadline = min(entry[2] for entry in inflight)
+            wakeup.wait(max(0.0, deadline - time.monotonic()))
+            wakeup.clear()
+            now = time.monotonic()
+            for entry in list(inflight):
+                pending, result, deadline = entry
+                if pending.done() or deadline <= now:
+                    inflight.remove(entry)
+                    self.proto.release(pending)
+                    replys = list(pending.replys)
+                    if replys:
+                        self._finish(result, results, reply=replys)
+                    else:
+                        self._finish(result, results, error="No reply")
+
+
+"""
+############################################################
+"""
+
+
+"""
+StatCollector collects the CCPhyStats counters of many nodes with STAT Q
+requests and fills RadioStats.final_stats. The requests of a sweep go
+through a BatchRunner with the background priority, so up to inflight
+requests per module are on the air and replies are matched by seqnr: a
+sweep takes about as long as the requests take on the air. Requests
+without reply are sent again at the end of the sweep, up to retries times.
+
+collect() runs a sweep and returns its summary, start() runs it on the
+STAT_COLLECTOR thread. Only one sweep runs at a time.
+"""
+
+
+class StatCollector:
+    def __init__(
+        self,
+        stats,
+        proto,
+        links=None,
+        inflight=None,
+        retries=None,
+        timeout=None,
+        runner=None,
+    ):
+        if inflight is None:
+            inflight = gs_config.getint("stat_inflight", fallback=8)
+        if retries is None:
+            retries = gs_config.getint("stat_retries", fallback=2)
+        if runner is None:
+            runner = BatchRunner(
+                proto,
+                inflight=inflight,
+                timeout=timeout,
+                links=links,
+                priority="background",
+            )
+        self.stats = stats
+        self.runner = runner
+        self.retries = retries
+        self.sweeps = 0
+        self.last = None
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    def __call__(self):
+        return self
+
+    def running(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def start(self, addrs, items=None, module=None, timeout=None):
+        # Returns False if a sweep is running already
+        if self.running():
+            return False
+        self.__thread = threading.Thread(
+            name="STAT_COLLECTOR",
+            target=self.collect,
+            args=(addrs, items, module, timeout),
+            daemon=True,
+        )
+        self.__thread.start()
+        return True
+
+    def collect(self, addrs, items=None, module=None, timeout=None):
+        if items is None:
+            items = list(CCPhyStats)
+        with self.__lock:
+            start = time.monotonic()
+            commands = []
+            for addr in addrs:
+                self.stats.gather(addr, items)
+                for statistic in items:
+                    command = {"instr": "STAT", "addr": addr, "item": statistic.value}
+                    if module is not None:
+                        command["module"] = module
+                    commands.append(command)
+
+            requests = len(commands)
+            retried = 0
+            for attempt in range(0, self.retries + 1):
+                if attempt:
+                    retried += len(commands)
+                missing = []
+                for result in self.runner.run(commands, timeout):
+                    command = commands[result["index"]]
+                    if result["ok"]:
+                        self.stats.set_final_stat(
+                            command["addr"],
+                            CCPhyStats(command["item"]),
+                            result["reply"][0]["value"],
+                        )
+                    else:
+                        missing.append(command)
+                commands = missing
+                if not commands:
+                    break
+
+            self.sweeps += 1
+            self.last = {
+                "nodes": len(addrs),
+                "requests": requests,
+                "retried": retried,
+                "missing": [
+                    [command["addr"], CCPhyStats(command["item"]).name]
+                    for command in commands
+                ],
+                "elapsed": round(time.monotonic() - start, 3),
+            }
+            log(
+                20,
+                "STAT_COLLECTOR",
+                "Collected {:d} values of {:d} nodes in {:.1f} s, {:d} missing",
+                requests - len(commands),
+                len(addrs),
+                self.last["elapsed"],
+                len(commands),
+            )
+            return self.last
+
+    def get_counters(self):
+        return {"running": self.running(), "sweeps": self.sweeps, "last": self.last}
+
+
+"""
+############################################################
+"""
+
+
+"""
+LinkQuality keeps the RSSI, LQI and arrival time of the last depth packets
+per link, a (phyaddr, module) pair. The samples are stored in ring buffers,
+one row of fixed numpy arrays per link, so the memory is bounded by links x
+depth. If all rows are in use, the link heard least recently is dropped.
+
+Every packet of a node is numbered as one transmission. The same line heard
+on several modules within dedup seconds counts once. The PDR of a link is
+its samples divided by the transmissions of the node in the same span, so
+it says how much of what the node sent reached that antenna.
+
+stats() computes mean, percentiles and PDR for all links at once.
+best_module() picks the module with the best PDR, then the best median
+RSSI.
+"""
+
+
+class LinkQuality:
+    def __init__(self, links=None, depth=None, dedup=None):
+        if links is None:
+            links = if_config.getint("link_max_links", fallback=4096)
+        if depth is None:
+            depth = if_config.getint("link_window", fallback=64)
+        if dedup is None:
+            dedup = if_config.getfloat("link_dedup", fallback=0.1)
+        self.depth = depth
+        self.dedup = dedup
+        self.rssi = np.zeros((links, depth), dtype=np.int16)
+        self.lqi = np.zeros((links, depth), dtype=np.uint8)
+        self.time = np.zeros((links, depth), dtype=np.float64)
+        self.txn = np.zeros((links, depth), dtype=np.int64)
+        self.count = np.zeros(links, dtype=np.int64)
+        self.last_seen = np.zeros(links, dtype=np.float64)
+        self.rows = {}
+        self.keys = [None] * links
+        # phyaddr -> [transmissions, last line, time of the last line]
+        self.nodes = {}
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        return self
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _row(self, key):
+        # Must be called with self.lock held
+        row = self.rows.get(key)
+        if row is not None:
+            return row
+        if len(self.rows) < len(self.keys):
+            row = len(self.rows)
+        else:
+            row = int(np.argmin(self.last_seen))
+            del self.rows[self.keys[row]]
+            self.evicted += 1
+        self.rows[key] = row
+        self.keys[row] = key
+        self.count[row] = 0
+        return row
+
+    def record(self, phyaddr, module, rssi, lqi, line=None):
+        now = time.monotonic()
+        if rssi is None:
+            rssi = 0
+        # status1 is the RSSI in dBm as signed byte
+        rssi = rssi - 256 if rssi > 127 else rssi
+        with self.lock:
+            node = self.nodes.get(phyaddr)
+            if node is None:
+                node = self.nodes[phyaddr] = [0, None, 0.0]
+            if line is None or line != node[1] or now - node[2] > self.dedup:
+                node[0] += 1
+                node[1] = line
+                node[2] = now
+            row = self._row((phyaddr, module))
+            index = self.count[row] % self.depth
+            self.rssi[row, index] = rssi
+            self.lqi[row, index] = lqi or 0
+            self.time[row, index] = now
+            self.txn[row, index] = node[0]
+            self.count[row] += 1
+            self.last_seen[row] = now
+
+    def stats(self, phyaddr=None, since=None):
+        now = time.monotonic()
+        with self.lock:
+            keys = [key for key in self.rows if phyaddr is None or key[0] == phyaddr]
+            if not keys:
+                return []
+            rows = np.array([self.rows[key] for key in keys])
+            rssi = self.rssi[rows].astype(np.float64)
+            lqi = self.lqi[rows].astype(np.float64)
+            arrived = self.time[rows]
+            txn = self.txn[rows]
+            count = self.count[rows]
+            transmissions = np.array([self.nodes[key[0]][0] for key in keys])
+
+        valid = np.arange(self.depth)[None, :] < count[:, None]
+        if since is not None:
+            valid &= arrived >= now - since
+        samples = valid.sum(axis=1)
+        keep = samples > 0
+        keys = [key for key, ok in zip(keys, keep) if ok]
+        valid = valid[keep]
+        samples = samples[keep]
+        rssi = np.where(valid, rssi[keep], np.nan)
+        lqi = np.where(valid, lqi[keep], np.nan)
+        first = np.where(valid, txn[keep], np.iinfo(np.int64).max).min(axis=1)
+        last_seen = np.where(valid, arrived[keep], 0.0).max(axis=1)
+        if not keys:
+            return []
+
+        # Percentiles like np.percentile per row, NaNs are sorted to the end
+        ordered = np.sort(rssi, axis=1)
+        rows = np.arange(len(keys))[:, None]
+        position = np.array([0.1, 0.5, 0.9])[None, :] * (samples - 1)[:, None]
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, samples[:, None] - 1)
+        fraction = position - lower
+        p10, p50, p90 = (
+            ordered[rows, lower] * (1 - fraction) + ordered[rows, upper] * fraction
+        ).T
+        mean = np.nansum(rssi, axis=1) / samples
+        lqi_mean = np.nansum(lqi, axis=1) / samples
+        pdr = np.minimum(samples / (transmissions[keep] - first + 1), 1.0)
+        # Rounded as arrays, round() per value is slower than the statistics.
+        # Every level row is rssi mean, p10, p50, p90, then the lqi mean.
+        levels = np.round(np.stack([mean, p10, p50, p90, lqi_mean]), 1).T.tolist()
+        columns = zip(
+            samples.tolist(),
+            levels,
+            np.round(pdr, 3).tolist(),
+            np.round(now - last_seen, 3).tolist(),
+        )
+        return [
+            {
+                "phyaddr": key[0],
+                "module": key[1],
+                "samples": number,
+                "rssi_mean": row[0],
+                "rssi_p10": row[1],
+                "rssi_p50": row[2],
+                "rssi_p90": row[3],
+                "lqi_mean": row[4],
+                "pdr": ratio,
+                "age": age,
+            }
+            for key, (number, row, ratio, age) in zip(keys, columns)
+        ]
+
+    def best_modules(self, phyaddr=None, since=None):
+        # phyaddr -> module with the best PDR, then the best median RSSI
+        best = {}
+        for link in self.stats(phyaddr, since):
+            score = (link["pdr"], link["rssi_p50"])
+            if link["phyaddr"] not in best or score > best[link["phyaddr"]][0]:
+                best[link["phyaddr"]] = (score, link["module"])
+        return {phyaddr: module for phyaddr, (score, module) in best.items()}
+
+    def best_module(self, phyaddr, since=None):
+        return self.best_modules(phyaddr, since).get(phyaddr)
+
+    def get_counters(self):
+        return {
+            "links": len(self.rows),
+            "nodes": len(self.nodes),
+            "evicted": self.evicted,
+        }
+
+
+"""
+############################################################
+"""
+
+
+"""
+The messages LineReader understands are described by MessageSchemas in
+MESSAGES, keyed by (instruction, mode). A schema lists the fields after
+"<INSTR> <MODE>" as (name, type) pairs, the types convert the strings.
+parse() takes the split line, checks the number of fields (at least that
+many if extra is set) and returns the converted fields as dict.
+
+New message types are added with the message decorator, the handler is
+called with the LineReader, the parsed fields and where the line was heard:
+
+    @message("NTFY", "R", ("seqnr", int))
+    def ntfy_reply(reader, msg, source):
+        ...
+"""
+
+
+class MessageSchema:
+    def __init__(self, instr, mode, fields, handler, extra=False):
+        self.instr = instr
+        self.mode = mode
+        self.names = tuple(name for name, conv in fields)
+        self.convs = tuple(conv for name, conv in fields)
+        self.count = len(fields)
+        self.extra = extra
+        self.handler = handler
+        self.labels = (instr,)
+        self.error = "[E] Parse error: Invalid {} {}\n".format(
+            instr, "reply" if mode == "R" else "message"
+        )
+        self.parse = self._compile()
+
+    def __call__(self):
+        return self
+
+    def _compile(self):
+        # One function per schema that builds the dict in a single literal,
+        # as collections.namedtuple does, zip() and a loop take twice as long
+        namespace = {"error": self.error}
+        items = []
+        for index, (name, conv) in enumerate(zip(self.names, self.convs)):
+            namespace["conv{:d}".format(index)] = conv
+            items.append(
+                "{!r}: conv{:d}(linedata[{:d}])".format(name, index, index + 2)
+            )
+        source = (
+            "def parse(linedata):\n"
+            "    if len(linedata) {} {:d}:\n"
+            "        raise ValueError(error)\n"
+            "    return {{{}}}\n"
+        ).format("<" if self.extra else "!=", self.count + 2, ", ".join(items))
+        exec(source, namespace)
+        return namespace["parse"]
+
+
+MESSAGES = {}
+
+
+def message(instr, mode, *fields, extra=False):
+    def register(handler):
+        MESSAGES[(instr, mode)] = MessageSchema(instr, mode, fields, handler, extra)
+        return handler
+
+    return register
+
+
+def ack(value):
+    if value != "ACK":
+        raise ValueError("expected ACK, got {}".format(value))
+    return True
+
+
+def timestamp(cache=[None, ""]):
+    # strftime once per second, not for every line
+    now = int(time.time())
+    if cache[0] != now:
+        cache[0] = now
+        cache[1] = time.strftime("%H:%M:%S", time.localtime(now))
+    return cache[1]
+
+
+def ack_reply(reader, msg, source):
+    reader.proto.log_by_seqnr(seqnr=msg["seqnr"], reply={"ack": True}, source=source)
+
+
+def value_reply(reader, msg, source):
+    reply = {"value": msg["value"]}
+    reader.proto.log_by_seqnr(seqnr=msg["seqnr"], reply=reply, source=source)
+
+
+def ignore(reader, msg, source):
+    pass
+
+
+"""
+############################################################
+"""
+
+
+class LineReader:
+    def __init__(self, stats, dhcp, preserver, proto, messages=None, links=None):
+        self.stats = stats
+        self.dhcp = dhcp
+        self.preserver = preserver
+        self.proto = proto
+        self.messages = MESSAGES if messages is None else messages
+        self.links = links
+        log(20, "LINE_READER", "Initialized!")
+
+    def __call__(self):
+        return self
+
+    def parse_line(self, line, module=None, rssi=None, lqi=None):
+        log(10, "LINE_READER", "{}\n", line)
+
+        linedata = line.split(" ")
+
+        if len(linedata) < 2:
+            metrics.inc("gateway_parse_errors_total", ("",))
+            sys.stderr.write("[E] Invalid line: {li}".format(li=line))
+            return
+
+        schema = self.messages.get((linedata[0], linedata[1]))
+        if schema is None:
+            return
+
+        try:
+            msg = schema.parse(linedata)
+        except ValueError:
+            metrics.inc("gateway_parse_errors_total", schema.labels)
+            sys.stderr.write(schema.error)
+            return
+        metrics.inc("gateway_rx_lines_total", schema.labels)
+
+        # Link quality and DHCP lease of the messages that say who sent them
+        phyaddr = msg.get("phyaddr")
+        if phyaddr is not None:
+            if self.links is not None and module is not None:
+                self.links.record(phyaddr, module, rssi, lqi, line)
+            if self.dhcp is not None:
+                self.dhcp.renew(phyaddr)
+
+        # Where the line was heard, kept with the reply for fan-out requests
+        schema.handler(self, msg, {"module": module, "rssi": rssi})
+
+
+# ~~~ Replies (RR mode) ~~~
+
+message("PING", "R", ("seqnr", int), extra=True)(ignore)
+message("STAT", "R", ("seqnr", int), ("value", int))(value_reply)
+message("SADR", "R", ("seqnr", int), ("ack", ack))(ack_reply)
+message("CHNL", "R", ("seqnr", int), ("ack", ack))(ack_reply)
+message("BATS", "R", ("seqnr", int), ("value", int))(ack_reply)
+message("NTFY", "R", ("seqnr", int))(ack_reply)
+message("DLVR", "R", ("seqnr", int))(ack_reply)
+message("ISRT", "R", ("seqnr", int))(ack_reply)
+message("SETI", "R", ("seqnr", int))(ack_reply)
+
+
+# sequence number doesn't matter as the DUID is constant
+@message("DUID", "R", ("seqnr", int), ("uid", int), ("phyaddr", int))
+def duid_reply(reader, msg, source):
+    reply = {"uid": msg["uid"], "addr": msg["phyaddr"]}
+    reader.proto.log_by_seqnr(seqnr=msg["seqnr"], reply=reply, source=source)
+
+
+@message(
+    "POLL",
+    "R",
+    ("seqnr", int),
+    ("ordernumber", int),
+    ("amount", int),
+    ("phyaddr", int),
+    ("energy", int),
+)
+def poll_reply(reader, msg, source):
+    seqnr = msg.pop("seqnr")
+    reader.preserver.store_by_ordernumber(msg, timestamp(), seqnr)
+    reader.proto.log_by_seqnr(seqnr=seqnr, reply=msg, source=source)
+
+
+@message(
+    "ENUM",
+    "R",
+    ("seqnr", int),
+    ("itemdescr", int),
+    ("amount", int),
+    ("phyaddr", int),
+    ("ordernumber", int),
+    ("orderamount", int),
+)
+def enum_reply(reader, msg, source):
+    seqnr = msg.pop("seqnr")
+    reader.proto.log_by_seqnr(seqnr=seqnr, reply=msg, source=source)
+
+
+@message("RSVE", "R", ("seqnr", int), ("ordernumber", int))
+def rsve_reply(reader, msg, source):
+    reply = {"ordernumber": msg["ordernumber"]}
+    reader.proto.log_by_seqnr(seqnr=msg["seqnr"], reply=reply, source=source)
+    reader.preserver.block_by_ordernumber(msg["ordernumber"])
+
+
+# ~~~ Messages (M mode) ~~~
+
+
+@message("RSTO", "M", ("phyaddr", int), ("uid", int), ("ordernumber", int), extra=True)
+def rsto_message(reader, msg, source):
+    reader.preserver.rsto_by_phyaddr(msg["phyaddr"], msg["ordernumber"])
+
+
+@message("FULE", "M", ("phyaddr", int), ("energy", int))
+@message("LOWE", "M", ("phyaddr", int), ("energy", int))
+def energy_message(reader, msg, source):
+    reader.preserver.update_energy(msg["phyaddr"], msg["energy"], timestamp())
+
+
+"""
+############################################################
+"""
+
+
+"""
+BinaryCodec is the compact over-the-air form of the ASCII messages.
+
+    size (Bytes)	element			description
+    --------------------------------------------------------------------
+    1				opcode			bit 7 set (ASCII messages start with a letter)
+                                    bit 6 set if a CRC-8 follows the fields
+                                    bits 5:0 instruction * 3 + mode (Q, R, M)
+    1-5 each		fields			unsigned LEB128 varints, ACK is 1, NACK 0
+    0-1				crc				CRC-8 (poly 0x07) of opcode and fields
+
+"compact" leaves out the CRC-8 and relies on the CRC-16 of the CC1200,
+"binary" keeps it. The order of INSTRUCTIONS is the wire format, only
+append to it.
+
+encode() turns an ASCII message into the binary form and returns it
+unchanged if it has no opcode or a field is not an unsigned number.
+decode() turns a binary message back into the ASCII line, so LineReader
+parses both the same way. Which form is sent is chosen per PhyNode address
+(encoding_nodes), per module (encoding_modules) or for all (encoding) in
+config.ini, the RX side detects it by the opcode bit.
+"""
+
+
+class BinaryCodec:
+    INSTRUCTIONS = [
+        "PING",
+        "BECN",
+        "DUID",
+        "BATS",
+        "ENUM",
+        "SADR",
+        "CHNL",
+        "POLL",
+        "NTFY",
+        "DLVR",
+        "ISRT",
+        "RSVE",
+        "SETI",
+        "STRT",
+        "STOP",
+        "STAT",
+        "BUTN",
+        "RSTO",
+        "FULE",
+        "LOWE",
+    ]
+    MODES = ["Q", "R", "M"]
+    ENCODINGS = ["ascii", "binary", "compact"]
+
+    def __init__(self, default="ascii", modules=None, nodes=None):
+        self.default = self._check(default)
+        self.modules = {
+            key: self._check(value) for key, value in (modules or {}).items()
+        }
+        self.nodes = {key: self._check(value) for key, value in (nodes or {}).items()}
+        self.opcodes = {}
+        self.messages = {}
+        for index, instr in enumerate(self.INSTRUCTIONS):
+            for mode_index, mode in enumerate(self.MODES):
+                code = index * len(self.MODES) + mode_index
+                self.opcodes[(instr.encode(), mode.encode())] = code
+                self.messages[code] = (instr.encode(), mode.encode())
+        self.crc_table = [self._crc_byte(value) for value in range(0, 256)]
+
+    def __call__(self):
+        return self
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config.get("encoding", fallback="ascii").strip(),
+            cls._parse_map(config.get("encoding_modules", fallback="")),
+            cls._parse_map(config.get("encoding_nodes", fallback="")),
+        )
+
+    @staticmethod
+    def _parse_map(value):
+        # "1:binary, 3:compact" -> {1: "binary", 3: "compact"}
+        result = {}
+        for item in value.split(","):
+            if item.strip():
+                key, encoding = item.split(":")
+                result[int(key)] = encoding.strip()
+        return result
+
+    def _check(self, encoding):
+        if encoding not in self.ENCODINGS:
+            raise ValueError(
+                "Invalid encoding {} (must be in {})".format(encoding, self.ENCODINGS)
+            )
+        return encoding
+
+    @staticmethod
+    def _crc_byte(value):
+        for i in range(0, 8):
+            value = ((value << 1) ^ 0x07 if value & 0x80 else value << 1) & 0xFF
+        return value
+
+    def crc8(self, data):
+        crc = 0
+        for value in data:
+            crc = self.crc_table[crc ^ value]
+        return crc
+
+    def select(self, module, addr):
+        if addr in self.nodes:
+            return self.nodes[addr]
+        return self.modules.get(module, self.default)
+
+    @staticmethod
+    def is_binary(payload):
+        return len(payload) > 0 and payload[0] & 0x80 != 0
+
+    def _schema(self, instr, mode):
+        return MESSAGES.get((instr.decode(), mode.decode()))
+
+    @staticmethod
+    def _is_ack(schema, index):
+        return (
+            schema is not None and index < schema.count and schema.convs[index] is ack
+        )
+
+    def encode(self, payload, encoding="binary"):
+        if encoding == "ascii" or self.is_binary(payload):
+            return payload
+        fields = bytes(payload).split(b" ")
+        code = self.opcodes.get(tuple(fields[0:2]))
+        if code is None:
+            return payload
+        schema = self._schema(*fields[0:2])
+        result = bytearray([0x80 | (0x40 if encoding == "binary" else 0) | code])
+        for index, field in enumerate(fields[2:]):
+            if self._is_ack(schema, index):
+                value = 1 if field == b"ACK" else 0
+            elif field.isdigit():
+                value = int(field)
+            else:
+                return payload
+            while value > 0x7F:
+                result.append(0x80 | (value & 0x7F))
+                value >>= 7
+            result.append(value)
+        if encoding == "binary":
+            result.append(self.crc8(result))
+        return bytes(result)
+
+    def decode(self, payload):
+        payload = bytes(payload)
+        if payload[0] & 0x40:
+            if len(payload) < 2 or self.crc8(payload[:-1]) != payload[-1]:
+                raise ValueError("CRC mismatch in binary message")
+            payload = payload[:-1]
+        message = self.messages.get(payload[0] & 0x3F)
+        if message is None:
+            raise ValueError("Unknown opcode 0x{:02X}".format(payload[0]))
+        schema = self._schema(*message)
+        fields = list(message)
+        value = 0
+        shift = 0
+        for byte in payload[1:]:
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if byte & 0x80:
+                continue
+            index = len(fields) - 2
+            if self._is_ack(schema, index):
+                fields.append(b"ACK" if value else b"NACK")
+            else:
+                fields.append(str(value).encode())
+            value = 0
+            shift = 0
+        if shift:
+            raise ValueError("Truncated varint in binary message")
+        return b" ".join(fields)
+
+
+codec = BinaryCodec.from_config(if_config)
+
+
+"""
+############################################################
+"""
+
+
+class SerialReader:
+    def __init__(self, parser):
+        self.recv_buf = ""
+        self.parser = parser
+        log(20, "SERIAL_READER", "Initialized!")
+
+    def __call__(self):
+        return self
+
+    def parse_lines(self, lines):
+        for line in lines:
+            self.parser.parse_line(line)
+
+    def data_received(self, data):
+        try:
+            str_data = data.decode("UTF-8")
+            self.recv_buf += str_data
+            lines = self.recv_buf.split("\n\r")
+
+            if len(lines) > 1:
+                self.parse_lines(lines[0:-1])
+                self.recv_buf = lines[-1]
+        except UnicodeDecodeError:
+            sys.stderr.write(
+                "[E] UART output contains garbage: {data}\n".format(data=data)
+            )
+
+
+"""
+############################################################
+"""
+
+
+"""
+DHCP assigns the 8-bit addresses of the nodes. Every node (by duid) has
+one lease:
+    {
+        duid: number,
+        addr: [first-last],
+        state: ['OFFER_SENT', 'COMPLETE'],
+        module: number,
+        expires: unix time,
+        ping_cnt: number,
+        pong_cnt: number
+    }
+
+Leases are indexed by duid and addr, the SADR replies are matched to the
+offers by seqnr in CCPhyParser. Free addresses are kept in a heap, the
+lowest one is offered first. A lease expires lease_time seconds after the
+node was last heard (any message with its phyaddr renews it), expired
+leases are taken back when the pool runs out. Addresses 0, reserved (the
+address of fresh nodes) and everything outside first-last are never
+offered.
+
+assign() discovers the nodes with Discovery (or takes the DUID replies it
+is given), keeps the address of a node if it is free, and sends the SADR
+offers through a BatchRunner: every offer on the module the node was heard
+best on, the modules in parallel. Offers without reply are sent again
+after backoff seconds, doubled for every retry. The leases are written to
+path (JSON) after every assign(), and read from it at start.
+"""
+
+
+class DHCP:
+    def __init__(
+        self,
+        proto,
+        discovery=None,
+        runner=None,
+        first=None,
+        last=None,
+        reserved=None,
+        lease_time=None,
+        retries=None,
+        backoff=None,
+        path=None,
+    ):
+        if first is None:
+            first = gs_config.getint("dhcp_first", fallback=1)
+        if last is None:
+            last = gs_config.getint("dhcp_last", fallback=254)
+        if reserved is None:
+            reserved = [
+                int(addr)
+                for addr in gs_config.get("dhcp_reserved", fallback="48").split(",")
+                if addr.strip()
+            ]
+        if lease_time is None:
+            lease_time = gs_config.getfloat("dhcp_lease_time", fallback=86400.0)
+        if retries is None:
+            retries = gs_config.getint("dhcp_retries", fallback=3)
+        if backoff is None:
+            backoff = gs_config.getfloat("dhcp_backoff", fallback=0.2)
+        if path is None:
+            path = gs_config.get("dhcp_leases", fallback="")
+        self.proto = proto
+        self.discovery = Discovery(proto) if discovery is None else discovery
+        self.runner = BatchRunner(proto) if runner is None else runner
+        self.addrs = set(range(max(first, 1), last + 1)) - set(reserved)
+        self.lease_time = lease_time
+        self.retries = retries
+        self.backoff = backoff
+        self.path = path
+        self.by_duid = {}
+        self.by_addr = {}
+        self.free = sorted(self.addrs)
+        self.lock = threading.RLock()
+        if self.path:
+            self.load()
+        log(20, "DHCP", "Initialized!")
+
+    def __call__(self):
+        return self
+
+    def _lease(self, duid, addr, state, module=None):
+        # Must be called with self.lock held
+        device = self.by_duid.get(duid)
+        if device is not None:
+            self._release(device)
+        device = {
+            "duid": duid,
+            "addr": addr,
+            "state": state,
+            "module": module,
+            "expires": time.time() + self.lease_time,
+            "ping_cnt": 0,
+            "pong_cnt": 0,
+        }
+        self.by_duid[duid] = device
+        self.by_addr[addr] = device
+        return device
+
+    def _release(self, device):
+        # Must be called with self.lock held
+        del self.by_duid[device["duid"]]
+        if self.by_addr.get(device["addr"]) is device:
+            del self.by_addr[device["addr"]]
+            heapq.heappush(self.free, device["addr"])
+
+    def _allocate(self):
+        # Must be called with self.lock held, raises IOError if the pool is empty
+        for attempt in range(0, 2):
+            while self.free:
+                addr = heapq.heappop(self.free)
+                if addr not in self.by_addr:
+                    return addr
+            if not attempt:
+                self.expire()
+        raise IOError("DHCP address pool exhausted")
+
+    def expire(self, now=None):
+        # Takes back the addresses of expired leases, returns their number
+        if now is None:
+            now = time.time()
+        with self.lock:
+            expired = [d for d in self.by_duid.values() if d["expires"] <= now]
+            for device in expired:
+                log(
+                    20,
+                    "DHCP",
+                    "Lease of {} on {} expired",
+                    device["duid"],
+                    device["addr"],
+                )
+                self._release(device)
+        return len(expired)
+
+    def renew(self, addr):
+        # Called for every message with a phyaddr by the RX workers, keeps
+        # the lease alive. Written locked, assign() and save() work on the
+        # leases, but at most once a second per node: the lookup before
+        # takes no lock.
+        device = self.by_addr.get(addr)
+        if device is None:
+            return
+        now = time.time()
+        if device["expires"] - now > self.lease_time - 1.0:
+            return
+        with self.lock:
+            device = self.by_addr.get(addr)
+            if device is not None:
+                device["expires"] = now + self.lease_time
+
+    def adopt(self, duid, addr):
+        # Records an address a node already has, if it is free
+        with self.lock:
+            device = self.by_duid.get(duid)
+            if device is not None and device["addr"] == addr:
+                device["state"] = "COMPLETE"
+                device["expires"] = time.time() + self.lease_time
+                return device
+            if addr not in self.addrs or addr in self.by_addr:
+                return None
+            return self._lease(duid, addr, "COMPLETE")
+
+    def release(self, duid):
+        with self.lock:
+            device = self.by_duid.get(duid)
+            if device is None:
+                return False
+            self._release(device)
+        self.save()
+        return True
+
+    def discover(self, modules=(1, 2, 3), expected=None):
+        # Returns the DUID replies, one per node, with the modules it was heard on
+        return self.discovery.run("DUID", modules, expected)["nodes"]
+
+    def offer(self, duid, module=None):
+        # Returns the lease for duid, with a new address if it has none
+        with self.lock:
+            device = self.by_duid.get(duid)
+            if device is None:
+                device = self._lease(duid, self._allocate(), "OFFER_SENT", module)
+                log(20, "DHCP", "Offering address {} to node {}", device["addr"], duid)
+            else:
+                device["state"] = "OFFER_SENT"
+                device["module"] = module
+        return device
+
+    def assign(self, modules=(1, 2, 3), expected=None, timeout=None, nodes=None):
+        def strength(source):
+            # status1 is the RSSI in dBm as signed byte
+            rssi = source["rssi"] or 0
+            return rssi - 256 if rssi > 127 else rssi
+
+        start = time.monotonic()
+        if nodes is None:
+            nodes = self.discover(modules, expected)
+        commands = []
+        result = {"discovered": len(nodes), "kept": 0, "assigned": [], "failed": []}
+        for node in nodes:
+            heard = max(node["heard"], key=strength)
+            if self.adopt(node["uid"], node["addr"]) is not None:
+                result["kept"] += 1
+                continue
+            try:
+                device = self.offer(node["uid"], heard["module"])
+            except IOError as err:
+                result["failed"].append({"duid": node["uid"], "error": str(err)})
+                continue
+            commands.append(
+                {
+                    "instr": "SADR",
+                    "addr": node["addr"],
+                    "uid": node["uid"],
+                    "newAddr": device["addr"],
+                    "module": heard["module"],
+                }
+            )
+
+        backoff = self.backoff
+        for attempt in range(0, self.retries + 1):
+            if attempt:
+                time.sleep(backoff)
+                backoff *= 2
+            missing = []
+            for reply in self.runner.run(commands, timeout):
+                command = commands[reply["index"]]
+                if reply["ok"]:
+                    with self.lock:
+                        device = self.by_duid.get(command["uid"])
+                        if device is not None:
+                            device["state"] = "COMPLETE"
+                            device["expires"] = time.time() + self.lease_time
+                    result["assigned"].append(
+                        {"duid": command["uid"], "addr": command["newAddr"]}
+                    )
+                else:
+                    missing.append(command)
+            commands = missing
+            if not commands:
+                break
+
+        # Offers that never got through go back to the pool, the node keeps
+        # its address and is offered a new one on the next assign()
+        with self.lock:
+            for command in commands:
+                device = self.by_duid.get(command["uid"])
+                if device is not None and device["state"] != "COMPLETE":
+                    self._release(device)
+                result["failed"].append({"duid": command["uid"], "error": "No reply"})
+        self.save()
+        result["elapsed"] = round(time.monotonic() - start, 3)
+        log(
+            20,
+            "DHCP",
+            "{:d} nodes: {:d} kept, {:d} assigned, {:d} failed in {:.1f} s",
+            len(nodes),
+            result["kept"],
+            len(result["assigned"]),
+            len(result["failed"]),
+            result["elapsed"],
+        )
+        return result
+
+    def leases(self):
+        with self.lock:
+            return [dict(self.by_duid[duid]) for duid in sorted(self.by_duid)]
+
+    def save(self):
+        if not self.path:
+            return
+        leases = [
+            {"duid": lease["duid"], "addr": lease["addr"], "expires": lease["expires"]}
+            for lease in self.leases()
+            if lease["state"] == "COMPLETE"
+        ]
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(leases, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                leases = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as err:
+            log(40, "DHCP", "Invalid leases in {}: {}", self.path, err)
+            return
+        now = time.time()
+        with self.lock:
+            for lease in leases:
+                if lease["expires"] > now and self.adopt(lease["duid"], lease["addr"]):
+                    self.by_duid[lease["duid"]]["expires"] = lease["expires"]
+        log(20, "DHCP", "Loaded {:d} leases from {}", len(self.by_duid), self.path)
+
+    def clients(self):
+        with self.lock:
+            return sorted(
+                addr for addr, d in self.by_addr.items() if d["state"] == "COMPLETE"
+            )
+
+    def dump_stats(self):
+        print("\n\n --- DHCP stats ---\n")
+        print("  DUID  ADDR  STATE")
 
         for duid in sorted(self.by_duid.keys()):
             print(
@@ -807,12 +3185,840 @@ class DHCP:
 """
 
 
-class Preserver:
-    def __init__(self, mqtt_client):
+"""
+MqttOutbound is the one way out to the MQTT broker.
+
+It has the publish() of the paho client, so it is handed to the Preserver
+and the GatewayHandler in place of the client. publish() only puts the
+message into a bounded queue, the MQTT_OUT thread hands them to the paho
+client. A slow broker or TLS link fills the queue instead of stalling the
+radio path. When the queue is full, the policy decides:
+
+    drop_oldest     the oldest queued message is dropped
+    block           publish() waits up to block_timeout, then the new
+                    message is dropped
+
+Messages to the batch_topics are collected for batch_window seconds and
+published as one JSON array, every payload is taken as JSON text. rate
+limits the messages per second handed to the client (0 is unlimited).
+"published" counts the messages, batched ones included, "batches" the
+arrays. A message that cannot be published is logged and counted as error,
+the MQTT_OUT thread goes on with the next one.
+"""
+
+
+class MqttOutbound:
+    POLICIES = ["drop_oldest", "block"]
+
+    def __init__(
+        self,
+        mqtt_client,
+        maxsize=None,
+        policy=None,
+        block_timeout=None,
+        rate=None,
+        batch_topics=None,
+        batch_window=None,
+    ):
+        if maxsize is None:
+            maxsize = if_config.getint("mqtt_queue_size", fallback=1024)
+        if policy is None:
+            policy = if_config.get("mqtt_queue_policy", fallback="drop_oldest")
+        if block_timeout is None:
+            block_timeout = if_config.getfloat("mqtt_block_timeout", fallback=0.5)
+        if rate is None:
+            rate = if_config.getfloat("mqtt_rate", fallback=0)
+        if batch_topics is None:
+            batch_topics = [
+                topic.strip()
+                for topic in if_config.get("mqtt_batch_topics", fallback="").split(",")
+                if topic.strip()
+            ]
+        if batch_window is None:
+            batch_window = if_config.getfloat("mqtt_batch_window", fallback=0.1)
+        if policy not in self.POLICIES:
+            raise ValueError(
+                "Invalid MQTT queue policy {} (must be in {})".format(
+                    policy, self.POLICIES
+                )
+            )
+        self.mqtt_client = mqtt_client
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.rate = rate
+        self.batch_topics = set(batch_topics)
+        self.batch_window = batch_window
+        self.published = 0
+        self.batches = 0
+        self.dropped = 0
+        self.errors = 0
+        self.max_depth = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.__sent = 0
+        self.__queue = queue.Queue(maxsize=maxsize)
+        self.__lock = threading.Lock()
+        # dropped and max_depth are counted by the publishing threads
+        self.__counters_lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__next_send = 0.0
+
+    def __call__(self):
+        return self
+
+    def start(self):
+        with self.__lock:
+            if self.__thread is not None and self.__thread.is_alive():
+                return
+            self.__stop.clear()
+            self.__thread = threading.Thread(
+                name="MQTT_OUT", target=self._out_loop, daemon=True
+            )
+            self.__thread.start()
+
+    def stop(self, timeout=None):
+        if self.__thread is not None and self.__thread.is_alive():
+            # Everything queued before is still published. The None only
+            # wakes the thread up, drop_oldest may drop it from a full queue,
+            # but then the queue isn't empty and the thread is awake anyway.
+            self.__stop.set()
+            try:
+                self.__queue.put_nowait(None)
+            except queue.Full:
+                pass
+            self.__thread.join(timeout)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.start()
+        item = (topic, payload, qos, retain, time.monotonic())
+        if self.policy == "block":
+            try:
+                self.__queue.put(item, timeout=self.block_timeout)
+            except queue.Full:
+                with self.__counters_lock:
+                    self.dropped += 1
+                return False
+        else:
+            while True:
+                try:
+                    self.__queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        self.__queue.get_nowait()
+                        with self.__counters_lock:
+                            self.dropped += 1
+                    except queue.Empty:
+                        pass
+        depth = self.__queue.qsize()
+        with self.__counters_lock:
+            if depth > self.max_depth:
+                self.max_depth = depth
+        return True
+
+    def get_counters(self):
+        sent = self.__sent
+        return {
+            "depth": self.__queue.qsize(),
+            "max_depth": self.max_depth,
+            "published": self.published,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "latency_avg": self.latency_sum / sent if sent else 0.0,
+            "latency_max": self.latency_max,
+        }
+
+    def _send(self, topic, payload, qos, retain, queued_at):
+        if self.rate > 0:
+            # Spread the messages evenly, at most rate per second
+            now = time.monotonic()
+            if self.__next_send > now:
+                time.sleep(self.__next_send - now)
+            self.__next_send = max(now, self.__next_send) + 1.0 / self.rate
+        latency = time.monotonic() - queued_at
+        self.__sent += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        metrics.observe("gateway_mqtt_publish_latency_seconds", latency)
+        try:
+            info = self.mqtt_client.publish(
+                topic=topic, payload=payload, qos=qos, retain=retain
+            )
+            if getattr(info, "rc", 0) != 0:
+                # e.g. MQTT_ERR_QUEUE_SIZE or MQTT_ERR_NO_CONN of paho
+                self.errors += 1
+        except Exception as err:
+            self.errors += 1
+            log(40, "MQTT_OUT", "Publish to {} failed: {}", topic, err)
+
+    @staticmethod
+    def _text(payload):
+        # A payload as JSON text for the array of a batch
+        if payload is None:
+            return "null"
+        if isinstance(payload, (bytes, bytearray)):
+            return payload.decode("utf-8", errors="replace")
+        if isinstance(payload, str):
+            return payload
+        return json.dumps(payload)
+
+    def _send_batch(self, topic, items):
+        payload = "[" + ",".join(self._text(item[1]) for item in items) + "]"
+        self.published += len(items)
+        self.batches += 1
+        self._send(topic, payload, items[0][2], items[0][3], items[0][4])
+
+    def _out_loop(self):
+        log(10, "MQTT_OUT", "Started!")
+        batches = {}
+        deadlines = {}
+        while True:
+            timeout = None
+            if deadlines:
+                timeout = max(0.0, min(deadlines.values()) - time.monotonic())
+            try:
+                item = self.__queue.get(timeout=timeout)
+            except queue.Empty:
+                item = ()
+
+            try:
+                if item and item[0] in self.batch_topics:
+                    batches.setdefault(item[0], []).append(item)
+                    deadlines.setdefault(item[0], time.monotonic() + self.batch_window)
+                elif item:
+                    self.published += 1
+                    self._send(*item)
+
+                now = time.monotonic()
+                for topic, deadline in list(deadlines.items()):
+                    if deadline <= now:
+                        del deadlines[topic]
+                        self._send_batch(topic, batches.pop(topic))
+            except Exception as err:
+                self.errors += 1
+                log(40, "MQTT_OUT", "Publishing failed: {}", err)
+            if self.__stop.is_set() and self.__queue.empty():
+                break
+        for topic, items in batches.items():
+            try:
+                self._send_batch(topic, items)
+            except Exception as err:
+                self.errors += 1
+                log(40, "MQTT_OUT", "Publishing batch to {} failed: {}", topic, err)
+        log(10, "MQTT_OUT", "Stopped!")
+
+
+"""
+############################################################
+"""
+
+
+"""
+MqttCommands takes commands from MQTT instead of HTTP.
+
+A message on <command_topic>/<INSTR> is handed to dispatch(instr, method,
+body), the same command layer as the Flask routes, the reply goes out on
+the response topic. The payload is a JSON object:
+
+    {"id": "42", "method": "POST", "body": {"addr": 10, "module": 1}}
+
+Everything but id, method and reply_to is the body if there is no "body"
+key, method defaults to POST. The reply is published to reply_to or
+<response_topic>/<INSTR>/<id>:
+
+    {"id": "42", "instr": "PING", "status": 200, "body": {...}}
+
+Commands block on their replies from the PhyNodes, so they run on
+the MQTT_CMD workers and never on the network loop of the client.
+"""
+
+
+class MqttCommands:
+    def __init__(
+        self,
+        mqtt_client,
+        outbound,
+        dispatch,
+        topic=None,
+        response_topic=None,
+        workers=None,
+    ):
+        if topic is None:
+            topic = gs_config.get("command_topic", fallback="/gateway/cmd")
+        if response_topic is None:
+            response_topic = gs_config.get(
+                "response_topic", fallback="/gateway/response"
+            )
+        if workers is None:
+            workers = gs_config.getint("command_workers", fallback=4)
+        self.mqtt_client = mqtt_client
+        self.outbound = outbound
+        self.dispatch = dispatch
+        self.topic = topic.rstrip("/")
+        self.response_topic = response_topic.rstrip("/")
+        self.received = 0
+        self.invalid = 0
+        self.__executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="MQTT_CMD"
+        )
+
+    def __call__(self):
+        return self
+
+    def subscribe(self):
+        # Called from on_connect, the broker forgets the subscription on reconnect
+        pattern = self.topic + "/+"
+        self.mqtt_client.message_callback_add(pattern, self.on_message)
+        self.mqtt_client.subscribe(pattern)
+        log(20, "MQTT_CMD", "Subscribed to {}", pattern)
+
+    def stop(self):
+        self.__executor.shutdown(wait=True)
+
+    def get_counters(self):
+        return {"received": self.received, "invalid": self.invalid}
+
+    def on_message(self, client, userdata, msg):
+        self.received += 1
+        instr = msg.topic[len(self.topic) + 1 :]
+        try:
+            command = json.loads(msg.payload or b"{}")
+            if not isinstance(command, dict):
+                raise ValueError("payload is not a JSON object")
+        except ValueError as err:
+            self.invalid += 1
+            self._reply(instr, None, None, 400, {"FAILURE": str(err)})
+            return
+        self.__executor.submit(self._execute, instr, command)
+
+    def _execute(self, instr, command):
+        command_id = command.pop("id", None)
+        reply_to = command.pop("reply_to", None)
+        method = str(command.pop("method", "POST")).upper()
+        body = command.pop("body", command)
+        log(10, "MQTT_CMD", "{} {} id: {}", method, instr, command_id)
+        try:
+            status, payload = self.dispatch(instr, method, body)
+        except Exception as err:
+            log(40, "MQTT_CMD", "{} {} failed: {}", method, instr, err)
+            status, payload = 500, {"FAILURE": str(err)}
+        self._reply(instr, command_id, reply_to, status, payload)
+
+    def _reply(self, instr, command_id, reply_to, status, payload):
+        if reply_to is None:
+            reply_to = "{}/{}".format(self.response_topic, instr)
+            if command_id is not None:
+                reply_to += "/{}".format(command_id)
+        self.outbound.publish(
+            topic=reply_to,
+            payload=json.dumps(
+                {"id": command_id, "instr": instr, "status": status, "body": payload}
+            ),
+            qos=0,
+            retain=False,
+        )
+
+
+"""
+############################################################
+"""
+
+
+"""
+StatePublisher publishes the PhyNode state of the Preserver over MQTT.
+
+Changes are collected for publish_window seconds, then the changed nodes
+are published as one delta (a list of nodes) to <topic>/delta. Every
+snapshot_interval seconds, and when the whole list changed, the complete
+list is published to <topic> so late subscribers catch up. Serialising and
+publishing happens in the PUBLISHER thread, not in the thread that changed
+the state.
+"""
+
+
+class StatePublisher:
+    def __init__(
+        self,
+        mqtt_client,
+        nodes,
+        lock,
+        topic="/gateway/phynode/information",
+        window=None,
+        snapshot_interval=None,
+    ):
+        if window is None:
+            window = if_config.getfloat("publish_window", fallback=0.2)
+        if snapshot_interval is None:
+            snapshot_interval = if_config.getfloat("snapshot_interval", fallback=10.0)
         self.mqtt_client = mqtt_client
-        self.phynode_list = self.init()
-        self.received_poll_messages = []
+        self.nodes = nodes
+        self.lock = lock
+        self.topic = topic
+        self.window = window
+        self.snapshot_interval = snapshot_interval
+        self.deltas = 0
+        self.snapshots = 0
+        self.bytes_published = 0
+        self.__dirty = {}
+        self.__full = False
+        self.__busy = False
+        self.__changed = threading.Condition()
+        self.__last_snapshot = 0.0
+        self.__stop = True
+        self.__thread = None
+
+    def __call__(self):
+        return self
+
+    def start(self):
+        with self.__changed:
+            if self.__thread is not None and self.__thread.is_alive():
+                return
+            self.__stop = False
+            self.__thread = threading.Thread(
+                name="PUBLISHER", target=self._publish_loop, daemon=True
+            )
+            self.__thread.start()
+
+    def stop(self, timeout=None):
+        with self.__changed:
+            self.__stop = True
+            self.__changed.notify_all()
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+
+    def changed(self, phynode=None):
+        # phynode None: the whole list changed
+        self.start()
+        with self.__changed:
+            if phynode is None:
+                self.__full = True
+            else:
+                self.__dirty[phynode["phyaddr"]] = phynode
+            self.__changed.notify_all()
+
+    def flush(self, timeout=None):
+        # Blocks until all changes so far are published
+        with self.__changed:
+            return self.__changed.wait_for(
+                lambda: not (self.__dirty or self.__full or self.__busy), timeout
+            )
+
+    def get_counters(self):
+        return {
+            "deltas": self.deltas,
+            "snapshots": self.snapshots,
+            "bytes": self.bytes_published,
+        }
+
+    def snapshot(self):
+        with self.lock:
+            return json.dumps(self.nodes())
+
+    def delta(self, phynodes):
+        with self.lock:
+            delta = [dict(phynode) for phynode in phynodes]
+        return json.dumps(delta)
+
+    def _publish(self, topic, payload):
+        self.bytes_published += len(payload)
+        self.mqtt_client.publish(topic=topic, payload=payload, qos=0, retain=False)
+
+    def _publish_loop(self):
+        log(10, "PUBLISHER", "Started!")
+        while True:
+            with self.__changed:
+                self.__changed.wait_for(
+                    lambda: self.__stop or self.__dirty or self.__full,
+                    self.snapshot_interval,
+                )
+                if self.__stop:
+                    break
+                self.__busy = True
+            # Let the changes of a burst pile up
+            time.sleep(self.window)
+            with self.__changed:
+                dirty = self.__dirty
+                full = self.__full
+                self.__dirty = {}
+                self.__full = False
+
+            try:
+                now = time.monotonic()
+                if full or now - self.__last_snapshot >= self.snapshot_interval:
+                    self._publish(self.topic, self.snapshot())
+                    self.snapshots += 1
+                    self.__last_snapshot = now
+                elif dirty:
+                    self._publish(self.topic + "/delta", self.delta(dirty.values()))
+                    self.deltas += 1
+            except Exception as err:
+                log(40, "PUBLISHER", str(err))
+            finally:
+                with self.__changed:
+                    self.__busy = False
+                    self.__changed.notify_all()
+        log(10, "PUBLISHER", "Stopped!")
+
+
+"""
+############################################################
+"""
+
+
+"""
+PollStore keeps the POLL replies by ordernumber and seqnr.
+
+Every reply is stored once per (ordernumber, seqnr, phyaddr) with the time
+it was received. get() copies the replies of an order and leaves them in
+the store, so concurrent POLLs for different orders (or the same order)
+never take each other's replies. Replies older than ttl seconds are
+evicted, and the oldest ones when more than maxsize are stored.
+"""
+
+
+class PollStore:
+    def __init__(self, ttl=None, maxsize=None):
+        if ttl is None:
+            ttl = if_config.getfloat("poll_ttl", fallback=60.0)
+        if maxsize is None:
+            maxsize = if_config.getint("poll_store_size", fallback=4096)
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.evicted = 0
+        # (ordernumber, seqnr, phyaddr) -> (timestamp, poll), oldest first
+        self.entries = collections.OrderedDict()
+        self.by_ordernumber = {}
         self.lock = threading.Lock()
+
+    def __call__(self):
+        return self
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, poll, seqnr=None):
+        key = (int(poll["ordernumber"]), seqnr, poll["phyaddr"])
+        with self.lock:
+            self.entries[key] = (time.monotonic(), poll)
+            self.entries.move_to_end(key)
+            self.by_ordernumber.setdefault(key[0], {})[key] = poll
+            self._evict()
+
+    def get(self, ordernumber, seqnr=None):
+        with self.lock:
+            self._evict()
+            polls = self.by_ordernumber.get(int(ordernumber), {})
+            return [
+                poll for key, poll in polls.items() if seqnr is None or key[1] == seqnr
+            ]
+
+    def discard(self, ordernumber):
+        with self.lock:
+            for key in self.by_ordernumber.pop(int(ordernumber), {}):
+                del self.entries[key]
+
+    def get_counters(self):
+        return {"stored": len(self.entries), "evicted": self.evicted}
+
+    def _evict(self):
+        deadline = time.monotonic() - self.ttl
+        while self.entries:
+            key, (tm, poll) = next(iter(self.entries.items()))
+            if tm >= deadline and len(self.entries) <= self.maxsize:
+                break
+            del self.entries[key]
+            polls = self.by_ordernumber[key[0]]
+            del polls[key]
+            if not polls:
+                del self.by_ordernumber[key[0]]
+            self.evicted += 1
+
+
+"""
+############################################################
+"""
+
+
+"""
+PreserverStore keeps the PhyNode state of the Preserver on disk.
+
+The state is a checkpoint (path, the whole phynode_list as JSON) and a log
+(path + ".log") with one JSON line per changed PhyNode. Changes are only
+collected by changed() and replace(), the PRESERVER_STORE thread writes
+them behind every interval seconds, so a PhyNode that changed several
+times in between is written once. When the log gets longer than
+compact_ratio times the checkpoint, a new checkpoint is written and the
+log starts over. Checkpoint and log carry a generation, a log that was
+left over from an older checkpoint is not replayed. load() reads the
+checkpoint and replays the log on top of it, a torn last line is skipped.
+"""
+
+
+class PreserverStore:
+    VERSION = 1
+
+    def __init__(self, path=None, interval=None, compact_ratio=None, sync=None):
+        if path is None:
+            path = if_config.get("preserver_store", fallback="")
+        if interval is None:
+            interval = if_config.getfloat("preserver_store_interval", fallback=0.5)
+        if compact_ratio is None:
+            compact_ratio = if_config.getfloat("preserver_store_compact", fallback=4.0)
+        if sync is None:
+            sync = if_config.getboolean("preserver_store_sync", fallback=True)
+        self.path = path
+        self.interval = interval
+        self.compact_ratio = compact_ratio
+        self.sync = sync
+        self.records = 0
+        self.checkpoints = 0
+        self.bytes_written = 0
+        self.errors = 0
+        self.generation = 0
+        # phyaddr -> PhyNode as written, in the order of phynode_list
+        self.image = {}
+        self.__log = None
+        self.__log_bytes = 0
+        self.__checkpoint_bytes = 0
+        self.__dirty = {}
+        self.__full = None
+        self.__busy = False
+        self.__changed = threading.Condition()
+        self.__stop = True
+        self.__thread = None
+
+    def __call__(self):
+        return self
+
+    def start(self):
+        with self.__changed:
+            if not self.path:
+                return
+            if self.__thread is not None and self.__thread.is_alive():
+                return
+            self.__stop = False
+            self.__thread = threading.Thread(
+                name="PRESERVER_STORE", target=self._store_loop, daemon=True
+            )
+            self.__thread.start()
+
+    def stop(self, timeout=None):
+        # Everything changed so far is written before the thread ends
+        with self.__changed:
+            self.__stop = True
+            self.__changed.notify_all()
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+            if self.__thread.is_alive():
+                return
+        if self.__log is not None:
+            self.__log.close()
+            self.__log = None
+
+    def changed(self, phynode):
+        # phynode is a copy, the caller holds the lock of the Preserver
+        if not self.path:
+            return
+        self.start()
+        with self.__changed:
+            self.__dirty[phynode["phyaddr"]] = phynode
+            self.__changed.notify_all()
+
+    def replace(self, phynodes):
+        # The whole list changed, the next write is a checkpoint
+        if not self.path:
+            return
+        self.start()
+        with self.__changed:
+            self.__full = phynodes
+            self.__dirty = {}
+            self.__changed.notify_all()
+
+    def flush(self, timeout=None):
+        # Blocks until all changes so far are written
+        with self.__changed:
+            return self.__changed.wait_for(
+                lambda: not (self.__dirty or self.__full is not None or self.__busy),
+                timeout,
+            )
+
+    def get_counters(self):
+        with self.__changed:
+            pending = len(self.__dirty)
+        return {
+            "pending": pending,
+            "records": self.records,
+            "checkpoints": self.checkpoints,
+            "bytes": self.bytes_written,
+            "log_bytes": self.__log_bytes,
+            "errors": self.errors,
+        }
+
+    def load(self):
+        # Returns the recovered phynode_list, None without a checkpoint
+        if not self.path:
+            return None
+        try:
+            with open(self.path, "rb") as f:
+                checkpoint = json.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except ValueError as err:
+            log(40, "PRESERVER_STORE", "Invalid checkpoint {}: {}", self.path, err)
+            return None
+        if checkpoint.get("version") != self.VERSION:
+            log(40, "PRESERVER_STORE", "Unknown checkpoint version in {}", self.path)
+            return None
+        self.generation = checkpoint["generation"]
+        self.image = {phynode["phyaddr"]: phynode for phynode in checkpoint["nodes"]}
+        replayed = self._replay()
+        log(
+            20,
+            "PRESERVER_STORE",
+            "Loaded {:d} PhyNodes from {}, {:d} changes replayed",
+            len(self.image),
+            self.path,
+            replayed,
+        )
+        return [dict(phynode) for phynode in self.image.values()]
+
+    def _replay(self):
+        try:
+            with open(self.path + ".log", "rb") as f:
+                lines = f.read().split(b"\n")
+        except FileNotFoundError:
+            return 0
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            return 0
+        if header.get("generation") != self.generation:
+            # Left over from before the checkpoint, which already has it
+            return 0
+        if lines[-1]:
+            # Torn by a crash while it was written
+            log(30, "PRESERVER_STORE", "Log ends in a partial line, skipped")
+        # Only the last line of a PhyNode is decoded, "<phyaddr> <json>"
+        latest = {}
+        for line in lines[1:-1]:
+            phyaddr, sep, record = line.partition(b" ")
+            latest[phyaddr] = record
+        try:
+            phynodes = json.loads(b"[" + b",".join(latest.values()) + b"]")
+        except ValueError as err:
+            log(40, "PRESERVER_STORE", "Invalid log {}: {}", self.path + ".log", err)
+            return 0
+        for phynode in phynodes:
+            self.image[phynode["phyaddr"]] = phynode
+        return len(lines) - 2
+
+    def _checkpoint(self, phynodes):
+        self.generation += 1
+        data = json.dumps(
+            {"version": self.VERSION, "generation": self.generation, "nodes": phynodes},
+            separators=(",", ":"),
+        ).encode()
+        with open(self.path + ".tmp", "wb") as f:
+            f.write(data)
+            f.flush()
+            if self.sync:
+                os.fsync(f.fileno())
+        os.replace(self.path + ".tmp", self.path)
+        # The log of the previous generation is not needed any more
+        if self.__log is not None:
+            self.__log.close()
+        self.__log = open(self.path + ".log", "wb")
+        header = json.dumps({"generation": self.generation}).encode() + b"\n"
+        self.__log.write(header)
+        self.__log.flush()
+        self.image = {phynode["phyaddr"]: phynode for phynode in phynodes}
+        self.checkpoints += 1
+        self.bytes_written += len(data) + len(header)
+        self.__checkpoint_bytes = len(data)
+        self.__log_bytes = len(header)
+
+    def _write(self, full, dirty):
+        if full is not None:
+            self._checkpoint(full)
+        elif self.__log is None:
+            # The log of a previous run is compacted first
+            self._checkpoint(list(self.image.values()))
+        if dirty:
+            data = "".join(
+                "{:d} {}\n".format(phyaddr, json.dumps(phynode, separators=(",", ":")))
+                for phyaddr, phynode in dirty.items()
+            ).encode()
+            self.__log.write(data)
+            self.__log.flush()
+            if self.sync:
+                os.fsync(self.__log.fileno())
+            self.image.update(dirty)
+            self.records += len(dirty)
+            self.bytes_written += len(data)
+            self.__log_bytes += len(data)
+        if self.__log_bytes > self.compact_ratio * self.__checkpoint_bytes:
+            self._checkpoint(list(self.image.values()))
+
+    def _store_loop(self):
+        log(10, "PRESERVER_STORE", "Started!")
+        while True:
+            with self.__changed:
+                self.__changed.wait_for(
+                    lambda: self.__stop or self.__dirty or self.__full is not None
+                )
+                if not (self.__dirty or self.__full is not None):
+                    break
+                self.__busy = True
+                # Let the changes of a burst pile up, stop() writes them at once
+                self.__changed.wait_for(lambda: self.__stop, self.interval)
+                full = self.__full
+                dirty = self.__dirty
+                self.__full = None
+                self.__dirty = {}
+
+            try:
+                self._write(full, dirty)
+            except Exception as err:
+                self.errors += 1
+                log(40, "PRESERVER_STORE", "Write to {} failed: {}", self.path, err)
+                with self.__changed:
+                    # Retried with the next write, unless the list was replaced
+                    if self.__full is None and not self.__stop:
+                        self.__full = full
+                        for phyaddr, phynode in dirty.items():
+                            self.__dirty.setdefault(phyaddr, phynode)
+                if self.__log is not None:
+                    self.__log.close()
+                    self.__log = None
+            finally:
+                with self.__changed:
+                    self.__busy = False
+                    self.__changed.notify_all()
+        log(10, "PRESERVER_STORE", "Stopped!")
+
+
+"""
+############################################################
+"""
+
+
+class Preserver:
+    def __init__(self, mqtt_client, store=None):
+        self.mqtt_client = mqtt_client
+        # Without a store every start (and reset) begins with init()
+        self.store = store
+        recovered = store.load() if store is not None else None
+        self.phynode_list = self.init() if recovered is None else recovered
+        self.polls = PollStore()
+        # Reentrant, the update methods publish while holding it
+        self.lock = threading.RLock()
+        self.reindex()
+        self.publisher = StatePublisher(
+            mqtt_client, lambda: self.phynode_list, self.lock
+        )
         self.print_phynodelist()
         log(20, "PRESERVER", "Initialized!")
         # self.cleaning_thread = threading.Thread(group=None, target=self.cleaning_loop, name='Cleaning Thread', daemon=True)
@@ -976,6 +4182,39 @@ class Preserver:
             },
         ]
 
+    def reindex(self):
+        # phynode_list stays the published state, the indexes point into it
+        with self.lock:
+            self.by_phyaddr = {}
+            self.by_uid = {}
+            self.by_ordernumber = {}
+            self.position = {}
+            for index, phynode in enumerate(self.phynode_list):
+                self.by_phyaddr.setdefault(phynode["phyaddr"], phynode)
+                self.by_uid.setdefault(phynode["uid"], phynode)
+                self.position.setdefault(phynode["phyaddr"], index)
+                self.by_ordernumber.setdefault(phynode["ordernumber"], {})[
+                    phynode["phyaddr"]
+                ] = phynode
+
+    def set_ordernumber(self, phynode, ordernumber):
+        with self.lock:
+            nodes = self.by_ordernumber.get(phynode["ordernumber"])
+            if nodes is not None:
+                nodes.pop(phynode["phyaddr"], None)
+                if not nodes:
+                    del self.by_ordernumber[phynode["ordernumber"]]
+            phynode["ordernumber"] = ordernumber
+            self.by_ordernumber.setdefault(ordernumber, {})[
+                phynode["phyaddr"]
+            ] = phynode
+
+    def get_by_phyaddr(self, phyaddr):
+        return self.by_phyaddr.get(phyaddr)
+
+    def get_by_uid(self, uid):
+        return self.by_uid.get(uid)
+
     def print_phynodelist(self):
         print("\n --- PHYNODES ---\n")
         print("DUID      PHYADDR    RSTO       ORDERNUMBER      BLOCKED")
@@ -992,67 +4231,73 @@ class Preserver:
         print(" ---          ---\n")
         self.publish_information()
 
-    def publish_information(self):
-        self.mqtt_client.publish(
-            topic="/gateway/phynode/information",
-            payload=json.dumps(self.phynode_list),
-            qos=0,
-            retain=False,
-        )
+    def publish_information(self, phynode=None):
+        # Published by the PUBLISHER thread, phynode None publishes the full list
+        self.publisher.changed(phynode)
+        if self.store is not None:
+            # Written behind by the PRESERVER_STORE thread, copied while locked
+            with self.lock:
+                if phynode is None:
+                    self.store.replace([dict(node) for node in self.phynode_list])
+                else:
+                    self.store.changed(dict(phynode))
 
     def update_energy(self, phyaddr, energy, timestamp):
-        for phynode in self.phynode_list:
-            if phynode["phyaddr"] == phyaddr:
+        with self.lock:
+            phynode = self.by_phyaddr.get(phyaddr)
+            if phynode is not None:
                 phynode["energy"] = energy
                 phynode["energy_timestamp"] = timestamp
                 # print('Update energy: ' + str(phyaddr) + str(energy) + ', ' + timestamp)
-        log(20, "ORDER_PRESERVER", "Updated energy on phyaddr {:d}\n".format(phyaddr))
-        self.publish_information()
+                self.publish_information(phynode)
+        log(20, "ORDER_PRESERVER", "Updated energy on phyaddr {:d}\n", phyaddr)
 
     def rsve_by_phyaddr(self, phyaddr, ordernumber):
-        for phynode in self.phynode_list:
-            if phynode["phyaddr"] == phyaddr:
-                phynode["ordernumber"] = ordernumber
-                self.publish_information()
+        with self.lock:
+            phynode = self.by_phyaddr.get(phyaddr)
+            if phynode is not None:
+                self.set_ordernumber(phynode, ordernumber)
+                self.publish_information(phynode)
                 return True
         return False
 
     def block_by_ordernumber(self, ordernumber):
-        for phynode in self.phynode_list:
-            if phynode["ordernumber"] == ordernumber:
+        with self.lock:
+            nodes = self.by_ordernumber.get(ordernumber)
+            if nodes:
+                # The first one in phynode_list, several nodes share ordernumber 0
+                phynode = min(
+                    nodes.values(), key=lambda node: self.position[node["phyaddr"]]
+                )
                 phynode["blocked"] = True
-                self.publish_information()
-                return
+                self.publish_information(phynode)
 
     def is_blocked(self, phyaddr):
-        for phynode in self.phynode_list:
-            if phynode["phyaddr"] == phyaddr and phynode["blocked"] == True:
-                return True
-            else:
-                return False
+        phynode = self.by_phyaddr.get(phyaddr)
+        return phynode is not None and phynode["blocked"] == True
 
     def rsto_by_phyaddr(self, phyaddr, ordernumber):
-        phynode = None
-        for phynode in self.phynode_list:
-            if phynode["phyaddr"] == phyaddr:
-                phynode = phynode
-        if phynode is not None and ordernumber != 0:
-            if not phynode["empty"]:
+        with self.lock:
+            phynode = self.by_phyaddr.get(phyaddr)
+            if phynode is not None and ordernumber != 0:
+                if not phynode["empty"]:
+                    phynode["blocked"] = False
+                    self.set_ordernumber(phynode, 0)
+                    phynode["rsto"] = True
+                else:
+                    phynode["blocked"] = True
+                    self.set_ordernumber(phynode, 0)
+                    phynode["rsto"] = True
+            if phynode is not None and ordernumber == 0 and phynode["blocked"]:
                 phynode["blocked"] = False
-                phynode["ordernumber"] = 0
-                phynode["rsto"] = True
-            else:
-                phynode["blocked"] = True
-                phynode["ordernumber"] = 0
                 phynode["rsto"] = True
-        if phynode is not None and ordernumber == 0 and phynode["blocked"]:
-            phynode["blocked"] = False
-            phynode["rsto"] = True
-        self.publish_information()
+            if phynode is not None:
+                self.publish_information(phynode)
 
     def get_rsto_status(self, phyaddr: int) -> bool:
-        for phynode in self.phynode_list:
-            if phynode["phyaddr"] == phyaddr:
+        with self.lock:
+            phynode = self.by_phyaddr.get(phyaddr)
+            if phynode is not None:
                 result = phynode["rsto"]
                 if result:
                     phynode["rsto"] = False
@@ -1063,11 +4308,13 @@ class Preserver:
                             phynode["phyaddr"], phynode["rsto"]
                         ),
                     )
-                    self.publish_information()
+                    self.publish_information(phynode)
                 return result
 
     def reset(self):
-        self.phynode_list = self.init()
+        with self.lock:
+            self.phynode_list = self.init()
+            self.reindex()
         self.publish_information()
 
     # def store_poll_by_phyaddr(self, poll):
@@ -1084,26 +4331,21 @@ class Preserver:
     #                 phynode['poll_list'].remove(index)
     #     return result
 
-    def get_by_ordernumber(self, ordernumber):
-        result = []
-       # print('interface py')
-       # print(self.received_poll_messages)
-        for index, item in enumerate(self.received_poll_messages):
-            if int(item["ordernumber"]) == ordernumber:
-                result.append(self.received_poll_messages.pop(index))
-        return result
+    def get_by_ordernumber(self, ordernumber, seqnr=None):
+        # The replies stay in the store until they expire
+        return self.polls.get(ordernumber, seqnr)
 
-    def store_by_ordernumber(self, poll, tmpstamp):
-        self.received_poll_messages.append(poll)
+    def store_by_ordernumber(self, poll, tmpstamp, seqnr=None):
+        self.polls.put(poll, seqnr)
         self.update_energy(
             phyaddr=poll["phyaddr"], energy=poll["energy"], timestamp=tmpstamp
         )
         log(
             20,
             "ORDER_PRESERVER",
-            "Append...\n{}, length: {:d}\n".format(
-                str(poll), len(self.received_poll_messages)
-            ),
+            "Append...\n{}, length: {:d}\n",
+            poll,
+            len(self.polls),
         )
 
 
@@ -1112,6 +4354,126 @@ class Preserver:
 """
 
 
+"""
+RxWorkerPool decouples reading RX_FIFO from handling the packets.
+
+The RX loop only decodes frames and put()s the APPackets, a pool of worker
+threads does the parsing, Preserver updates and MQTT publishing. Every
+worker has its own bounded queue and all packets of one PhyNode go to the
+same worker, so they are handled in the order they were received. If the
+queue of a worker is full, the packet is dropped and counted instead of
+blocking the RX loop (and with it SFBGateway.app).
+"""
+
+
+class RxWorkerPool:
+    # Position of the phyaddr in replies that carry one:
+    # <INSTR> R <seqnr> ... <phyaddr>
+    PHYADDR_FIELD = {b"DUID": 4, b"POLL": 5, b"ENUM": 5}
+
+    def __init__(self, handler, workers=2, maxsize=1024):
+        self.handler = handler
+        self.queues = [queue.Queue(maxsize=maxsize) for i in range(0, workers)]
+        self.handled = [0 for i in range(0, workers)]
+        self.dropped = 0
+        self.max_depth = 0
+        self.__threads = []
+        self.__stop = True
+
+    def __call__(self):
+        return self
+
+    def start(self):
+        self.__stop = False
+        for index, worker_queue in enumerate(self.queues):
+            thread = threading.Thread(
+                name="RX_WORKER_{:d}".format(index),
+                target=self._worker,
+                args=(index, worker_queue),
+                daemon=True,
+            )
+            thread.start()
+            self.__threads.append(thread)
+
+    def stop(self, timeout=None):
+        self.__stop = True
+        for worker_queue in self.queues:
+            try:
+                worker_queue.put_nowait(None)
+            except queue.Full:
+                pass
+        for thread in self.__threads:
+            thread.join(timeout)
+        self.__threads = []
+
+    def join(self):
+        # Blocks until every queued packet was handled
+        for worker_queue in self.queues:
+            worker_queue.join()
+
+    def node_key(self, ap_pkt):
+        # M mode: <INSTR> M <phyaddr> ..., replies without a phyaddr are
+        # kept in order per seqnr
+        payload = bytes(ap_pkt.pkt.payload)
+        fields = payload.split(b" ")
+        if len(fields) < 3:
+            return payload
+        index = 2
+        if fields[1] == b"R":
+            index = self.PHYADDR_FIELD.get(fields[0], 2)
+        if index >= len(fields):
+            index = 2
+        return fields[index]
+
+    def put(self, ap_pkt):
+        worker_queue = self.queues[hash(self.node_key(ap_pkt)) % len(self.queues)]
+        try:
+            worker_queue.put_nowait((time.monotonic(), ap_pkt))
+        except queue.Full:
+            self.dropped += 1
+            log(
+                30,
+                "RX_WORKER",
+                "Queue full, dropped packet from module {:d}".format(ap_pkt.module),
+            )
+            return False
+        depth = worker_queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        return True
+
+    def get_counters(self):
+        return {
+            "depth": [worker_queue.qsize() for worker_queue in self.queues],
+            "max_depth": self.max_depth,
+            "dropped": self.dropped,
+            "handled": sum(self.handled),
+        }
+
+    def _worker(self, index, worker_queue):
+        name = "RX_WORKER_{:d}".format(index)
+        log(10, name, "Started!")
+        while not self.__stop:
+            item = worker_queue.get()
+            try:
+                if item is not None:
+                    self.handler(item[1])
+                    self.handled[index] += 1
+                    metrics.observe(
+                        "gateway_rx_fifo_latency_seconds", time.monotonic() - item[0]
+                    )
+            except Exception as err:
+                log(40, name, str(err))
+            finally:
+                worker_queue.task_done()
+        log(10, name, "Stopped!")
+
+
+"""
+############################################################
+"""
+
+
 class GatewayHandler:
     def __init__(self, proto, stats, dhcp, parser, mqttc):
         self.__proto = proto
@@ -1121,6 +4483,11 @@ class GatewayHandler:
         self.__mqttc = mqttc
         self.__stop = True
         self.__rx_loop = None
+        self.__pool = RxWorkerPool(
+            self._handle_packet,
+            workers=if_config.getint("rx_workers", fallback=2),
+            maxsize=if_config.getint("rx_queue_size", fallback=1024),
+        )
         log(20, "GATEWAY_HANDLER", "Initialized!")
 
     def run(self):
@@ -1150,6 +4517,7 @@ class GatewayHandler:
         # signal.signal(signal.SIGINT, self.signal_handler)
 
         self.__stop = False
+        self.__pool.start()
         self.__rx_loop = threading.Thread(
             name="RX_LOOP", target=self._rx_loop, daemon=True
         )
@@ -1162,36 +4530,45 @@ class GatewayHandler:
 
     def _rx_loop(self):
         log(10, self.__rx_loop.getName(), "Started!")
+        decoder = RxDecoder()
+        try:
+            # Opened read/write, so the FIFO stays open between the writes of
+            # SFBGateway.app and read() blocks instead of returning EOF
+            fifo = io.FileIO(os.open(RX_FIFO, os.O_RDWR), "r")
+        except OSError as err:
+            log(40, self.__rx_loop.getName(), "RX_FIFO is closed!")
+            self.__stop = True
+            return
+
         while not self.__stop:
             try:
-                fifo = open(RX_FIFO, "rb")
-                data = fifo.read()
-               # print('rx loop',str(data))
-                fifo.close()
-                packets = data.split(b"\r\n")
+                if decoder.readinto(fifo) == 0:
+                    continue
             except IOError as err:
                 log(40, self.__rx_loop.getName(), "RX_FIFO is closed!")
                 self.__stop = True
+                break
             except Exception as err:
                 log(40, self.__rx_loop.getName(), str(err))
                 break
 
-            for dat in packets:
-                if len(dat) is 0:
-                    break
-                payload_len = len(dat) - 5
-                module, status1, status2, length, addr, payload = struct.unpack(
-                    "BBBBB%ds" % (payload_len), dat
+            for ap_pkt in decoder.decode():
+                if codec.is_binary(ap_pkt.pkt.payload):
+                    try:
+                        ap_pkt.pkt.payload = bytearray(codec.decode(ap_pkt.pkt.payload))
+                    except ValueError as err:
+                        log(40, self.__rx_loop.getName(), str(err))
+                        continue
+                metrics.inc("gateway_rx_packets_total", (ap_pkt.module,))
+                metrics.inc(
+                    "gateway_rx_bytes_total", (ap_pkt.module,), ap_pkt.pkt.length
                 )
-                cc = CCPacket(address=addr, payload=bytearray(payload))
-                cc.status1 = status1
-                cc.status2 = status2
-                ap_pkt = APPacket(module, cc)
-                self._handle_packet(ap_pkt)
-                time.sleep(0.05)  #  Timeout for handle packet
+                metrics.inc("gateway_rx_address_packets_total", (ap_pkt.pkt.address,))
+                self.__pool.put(ap_pkt)
 
         else:
             log(10, self.__rx_loop.getName(), "Stopped!")
+        fifo.close()
 
     """
     Example for packet handler function.
@@ -1206,13 +4583,15 @@ class GatewayHandler:
 
         pl = ap_pkt.pkt.payload
 
-        log(
-            10,
-            "HANDLE_PACKET",
-            "Received packet on module {:d} at {} {}".format(
-                ap_pkt.module, time.strftime("%d.%m.%Y"), time.strftime("%H:%M:%S")
-            ),
-        )
+        if log_enabled(10, "HANDLE_PACKET"):
+            log(
+                10,
+                "HANDLE_PACKET",
+                "Received packet on module {:d} at {} {}",
+                ap_pkt.module,
+                time.strftime("%d.%m.%Y"),
+                time.strftime("%H:%M:%S"),
+            )
         #        log(10, 'HANDLE_PACKET', '\tRSSI:\t{:d}'.format(ap_pkt.pkt.get_rssi()))
         #        log(10, 'HANDLE_PACKET', '\tlength:\t{:d}'.format(ap_pkt.pkt.length))
 
@@ -1225,7 +4604,15 @@ class GatewayHandler:
         self.__mqttc.publish(
             topic="/gateway/phynode/replys", payload=json.dumps(pl), qos=0, retain=False
         )
-        self.__parser.parse_line(pl)
+        self.__parser.parse_line(
+            pl,
+            module=ap_pkt.module,
+            rssi=ap_pkt.pkt.get_rssi(),
+            lqi=ap_pkt.pkt.get_lqi(),
+        )
+
+    def get_rx_counters(self):
+        return self.__pool.get_counters()
 
     def signal_handler(self, signum, frame):
         log(10, "GATEWAY_HANDLER", "Stopped...")
@@ -1234,6 +4621,7 @@ class GatewayHandler:
 
     def _stop(self):
         self.__stop = True
+        self.__pool.stop()
 
 
 """
@@ -2,23 +2,36 @@
 
 from crypt import methods
 import threading, _thread
-import os, sys, subprocess, time
+import os, sys, subprocess, time, atexit
+from functools import partial
 import paho.mqtt.client as mqtt
 
-from flask import Flask, jsonify, make_response, request, abort, json, Response
+from flask import Flask, jsonify, make_response, request, abort, json, Response, g
 from gateway_interface import (
     CCPhyParser,
     RadioStats,
     DHCP,
     Preserver,
+    PreserverStore,
     LineReader,
     GatewayHandler,
+    FanOut,
+    MqttOutbound,
+    MqttCommands,
+    BatchRunner,
+    LinkQuality,
+    StatsExport,
+    StatCollector,
+    Discovery,
+    CCPhyStats,
     configparser,
     APPacket,
     CCPacket,
     gs_config,
+    metrics,
+    tx_writer,
 )
-from models import log, shell_font_style
+from models import log, log_config, shell_font_style
 
 """
 ############################################################
@@ -34,6 +47,7 @@ mqttc = mqtt.Client("GatewayServer")
 # The callback for when the client receives a CONNACK response from the server.
 def on_connect(client, userdata, flags, rc):
     log(20, "MQTT_CLIENT", "Connected with result code " + str(rc))
+    commands.subscribe()
 
 
 def connect_to_mqtt_broker():
@@ -52,22 +66,37 @@ def connect_to_mqtt_broker():
         log(40, "MQTT_CLIENT", "Connection failed with status code: {:d}".format(rc))
 
 
-mqttc.on_connect = on_connect
-connect_to_mqtt_broker()
-
 # APPacket
 # Only fallback option!
 # module = gs_config.getint('module')
 
 # Initialize dependency's
-preserver = Preserver(mqttc)
+outbound = MqttOutbound(mqttc)
+store = PreserverStore()
+preserver = Preserver(outbound, store)
+# The changes that are not written yet
+atexit.register(store.stop)
 proto = CCPhyParser()
 stats = RadioStats(proto)
-dhcp = DHCP(proto)
-parser = LineReader(stats, dhcp, preserver, proto)
-gateway = GatewayHandler(proto, stats, dhcp, parser, mqttc)
+exporter = StatsExport(stats)
+links = LinkQuality()
+fanout = FanOut(proto)
+batcher = BatchRunner(proto, preserver, links=links)
+discovery = Discovery(proto, fanout)
+dhcp = DHCP(proto, discovery, batcher)
+# The addresses of the known nodes are taken
+for phynode in preserver.phynode_list:
+    dhcp.adopt(phynode["uid"], phynode["phyaddr"])
+parser = LineReader(stats, dhcp, preserver, proto, links=links)
+gateway = GatewayHandler(proto, stats, dhcp, parser, outbound)
+collector = StatCollector(stats, proto, links=links)
 app = Flask(__name__)
 
+# Deadlines for RR mode requests. A route returns as soon as the expected
+# replies are in, broadcasts wait for the whole window.
+reply_timeout = gs_config.getfloat("reply_timeout", fallback=1.0)
+broadcast_window = gs_config.getfloat("broadcast_window", fallback=2.0)
+
 """
 ############################################################
 """
@@ -83,6 +112,141 @@ def welcome():
 """
 
 
+# Metrics in the Prometheus text format
+metrics.histogram(
+    "gateway_http_request_seconds", "Duration of a route", ("route", "method")
+)
+metrics.counter(
+    "gateway_http_requests_total", "Requests per route", ("route", "method", "status")
+)
+metrics.gauge(
+    "gateway_replies_unmatched_total",
+    "Replies nobody was waiting for (late or unknown seqnr)",
+    lambda: proto.get_counters()["unmatched"],
+    kind="counter",
+)
+metrics.gauge(
+    "gateway_replies_expired_total",
+    "Stored replies dropped before they were read",
+    lambda: proto.get_counters()["expired"],
+    kind="counter",
+)
+metrics.gauge(
+    "gateway_seqnr_skipped_total",
+    "Seqnrs skipped because they were pending or held after their release",
+    lambda: proto.get_counters()["skipped"],
+    kind="counter",
+)
+metrics.gauge(
+    "gateway_requests_pending",
+    "Requests waiting for replies",
+    lambda: proto.get_counters()["pending"],
+)
+metrics.gauge(
+    "gateway_tx_queue_depth",
+    "Packets in the TX scheduler",
+    lambda: {
+        cls: counters["depth"]
+        for cls, counters in tx_writer.get_counters()["classes"].items()
+    },
+    ("class",),
+)
+metrics.gauge(
+    "gateway_rx_queue_depth",
+    "Packets waiting for a RX worker",
+    lambda: sum(gateway.get_rx_counters()["depth"]),
+)
+metrics.gauge(
+    "gateway_rx_dropped_total",
+    "Packets dropped because the RX queue was full",
+    lambda: gateway.get_rx_counters()["dropped"],
+    kind="counter",
+)
+metrics.gauge(
+    "gateway_mqtt_queue_depth",
+    "Messages in the MQTT outbound queue",
+    lambda: outbound.get_counters()["depth"],
+)
+metrics.gauge(
+    "gateway_mqtt_dropped_total",
+    "Messages dropped because the MQTT outbound queue was full",
+    lambda: outbound.get_counters()["dropped"],
+    kind="counter",
+)
+metrics.gauge(
+    "gateway_mqtt_errors_total",
+    "Publishes the MQTT client refused",
+    lambda: outbound.get_counters()["errors"],
+    kind="counter",
+)
+metrics.gauge(
+    "gateway_log_dropped_total",
+    "Log records dropped because the logging queue was full",
+    lambda: log_config["dropped"],
+    kind="counter",
+)
+metrics.gauge(
+    "gateway_preserver_phynodes",
+    "PhyNodes known to the Preserver",
+    lambda: len(preserver.phynode_list),
+)
+metrics.gauge(
+    "gateway_links", "Links (phyaddr, module) in LinkQuality", lambda: len(links)
+)
+metrics.gauge(
+    "gateway_preserver_polls",
+    "POLL replies stored in the Preserver",
+    lambda: preserver.polls.get_counters()["stored"],
+)
+metrics.gauge(
+    "gateway_preserver_store_pending",
+    "PhyNode changes not written to the Preserver store yet",
+    lambda: store.get_counters()["pending"],
+)
+metrics.gauge(
+    "gateway_preserver_store_bytes_total",
+    "Bytes written to the Preserver store",
+    lambda: store.get_counters()["bytes"],
+    kind="counter",
+)
+metrics.gauge(
+    "gateway_preserver_store_errors_total",
+    "Failed writes to the Preserver store",
+    lambda: store.get_counters()["errors"],
+    kind="counter",
+)
+
+
+@app.before_request
+def start_timer():
+    g.started = time.monotonic()
+
+
+@app.after_request
+def count_request(response):
+    route = request.url_rule.rule if request.url_rule is not None else "unknown"
+    if "started" in g:
+        metrics.observe(
+            "gateway_http_request_seconds",
+            time.monotonic() - g.started,
+            (route, request.method),
+        )
+    metrics.inc(
+        "gateway_http_requests_total", (route, request.method, response.status_code)
+    )
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_route():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+"""
+############################################################
+"""
+
+
 # MQTT
 @app.route("/gateway/MQTT", methods=["POST"])
 def mqtt_publish():
@@ -93,7 +257,7 @@ def mqtt_publish():
     if request.method == "POST":
         topic = request_data["topic"]
         payload = request_data["payload"]
-        mqttc.publish(topic=topic, payload=json.dumps(payload), qos=0, retain=False)
+        outbound.publish(topic=topic, payload=json.dumps(payload), qos=0, retain=False)
 
         return json.dumps(payload)
 
@@ -153,10 +317,13 @@ def becn():
 
 # DUID Q seq                                (RR mode)
 #   >> DUID R seq uid phyaddr
+# A broadcast collects the replies in one window (broadcast_window or
+# "window"). With "slotted": true it takes the inventory in rounds of
+# slotted replies like /gateway/discover, and the rounds are returned too.
 @app.route("/gateway/DUID", methods=["POST"])
 def duid():
-    seqnr_err = duid_c(request)
-    return duid_r(seqnr_err)
+    reply_err = duid_c(request)
+    return duid_r(reply_err)
 
 
 def duid_c(request):
@@ -165,6 +332,7 @@ def duid_c(request):
     if request.method == "POST":
         addr = 0
         modules = None
+        expected = None
 
         # Check if request have an json-body and an address option.
         # If no option is defined, send to broadcast.
@@ -177,27 +345,133 @@ def duid_c(request):
         else:
             modules = [req_data["module"]]
 
-        payload = proto.create_duid_request(addr=addr)
-        # preserver.publish_information()
-        for module in modules:
+        # A unicast is answered once, a broadcast waits for the whole window
+        # unless the number of expected nodes is given.
+        if addr != 0:
+            expected = 1
+        elif "expected" in req_data:
+            expected = int(req_data["expected"])
+
+        # Rounds of slotted replies (DUID Q with slots) only on request, old
+        # clients keep the single window and the plain DUID Q
+        if addr == 0 and req_data.get("slotted"):
             try:
-                packet = APPacket(module, addr, payload)
-                packet.send()
-                if addr == 0:
-                    time.sleep(2)
-                else:
-                    time.sleep(0.35)
+                return discovery.run("DUID", modules, expected)
             except Exception as err:
                 return "{}".format(err)
-        return proto.get_seqnr()
 
-
-def duid_r(seqnr_err):
-    if type(seqnr_err) == int:
-        reply = proto.get_by_seqnr(seqnr=seqnr_err-1)
-        return make_response(jsonify(ack=str(reply)), 200)
+        # Send on all modules at once and collect in one window, a node
+        # heard on several modules is only listed once.
+        try:
+            reply = fanout.request(
+                modules,
+                addr,
+                partial(proto.create_duid_request, addr=addr),
+                float(req_data.get("window", broadcast_window))
+                if addr == 0
+                else reply_timeout,
+                expected,
+                key=lambda item: item["uid"],
+            )
+        except Exception as err:
+            return "{}".format(err)
+        return reply
+
+
+def duid_r(reply_err):
+    if type(reply_err) == list:
+        return make_response(jsonify(ack=str(reply_err)), 200)
+    elif type(reply_err) == dict:
+        # Slotted discovery, the nodes and what the rounds found
+        return make_response(
+            jsonify(
+                ack=str(reply_err["nodes"]),
+                rounds=reply_err["rounds"],
+                estimate=reply_err["estimate"],
+                unheard=reply_err["unheard"],
+                elapsed=reply_err["elapsed"],
+            ),
+            200,
+        )
     else:
-        return make_response(jsonify(FAILURE=seqnr_err), 400)
+        return make_response(jsonify(FAILURE=reply_err), 400)
+
+
+"""
+############################################################
+"""
+
+
+# Inventory of all nodes by DUID (uid) or ENUM (phyaddr) broadcast, in rounds
+# of slotted replies until the estimated number of nodes is heard
+#   POST /gateway/discover {"instr": "DUID", "modules": [1, 2, 3], "expected": 500}
+#     >> {"nodes": [...], "rounds": [{"slots": 16, "heard": 9, "new": 9,
+#         "estimate": 24.5}, ...], "estimate": 14.0, "elapsed": 3.1}
+@app.route("/gateway/discover", methods=["POST"])
+def discover():
+    req_data = request.get_json(silent=True) or {}
+    try:
+        modules = [int(module) for module in req_data.get("modules", [1, 2, 3])]
+        expected = req_data.get("expected")
+        if expected is not None:
+            expected = int(expected)
+        result = discovery.run(req_data.get("instr", "DUID"), modules, expected)
+    except (TypeError, ValueError, IOError) as err:
+        return make_response(jsonify(FAILURE="{}".format(err)), 400)
+    return Response(json.dumps(result), mimetype="application/json")
+
+
+"""
+############################################################
+"""
+
+
+# Address assignment: DUID broadcast, then SADR to every node whose address
+# is not free, all modules in parallel
+#   POST   /gateway/dhcp {"modules": [1, 2, 3], "expected": 300}
+#          /gateway/dhcp {"nodes": [{"uid": 2330, "addr": 48, "module": 2}, ...]}
+#                                            >> without DUID broadcast
+#     >> {"discovered": 300, "kept": 14, "assigned": [{"duid": 2330, "addr": 10}, ...],
+#         "failed": [{"duid": 2574, "error": "No reply"}], "elapsed": 4.2}
+#   GET    /gateway/dhcp                     >> leases
+#   DELETE /gateway/dhcp {"duid": 2330}      >> the address goes back to the pool
+@app.route("/gateway/dhcp", methods=["GET", "POST", "DELETE"])
+def dhcp_assign():
+    if request.method == "GET":
+        return Response(json.dumps(dhcp.leases()), mimetype="application/json")
+
+    req_data = request.get_json(silent=True) or {}
+    if request.method == "DELETE":
+        if "duid" not in req_data:
+            return make_response(
+                jsonify(FAILURE='No duid defined. For example "duid": 2330'), 400
+            )
+        if not dhcp.release(int(req_data["duid"])):
+            return make_response(jsonify(FAILURE="No lease for this duid"), 404)
+        return make_response(jsonify(SUCCESS=True), 200)
+
+    try:
+        modules = [int(module) for module in req_data.get("modules", [1, 2, 3])]
+        expected = req_data.get("expected")
+        if expected is not None:
+            expected = int(expected)
+        nodes = req_data.get("nodes")
+        if nodes is not None:
+            # DUID replies of an earlier discovery, the module they were heard on
+            nodes = [
+                {
+                    "uid": int(node["uid"]),
+                    "addr": int(node["addr"]),
+                    "heard": [{"module": int(node["module"]), "rssi": None}],
+                }
+                for node in nodes
+            ]
+        result = dhcp.assign(modules, expected, nodes=nodes)
+    except KeyError as err:
+        return make_response(jsonify(FAILURE="{} is not defined".format(err)), 400)
+    except (TypeError, ValueError, IOError) as err:
+        return make_response(jsonify(FAILURE="{}".format(err)), 400)
+    return make_response(jsonify(result), 200)
 
 
 """
@@ -261,15 +535,17 @@ def sadr():
         else:
             module = req_data["module"]
 
-        seqnr = proto.get_seqnr()
-        payload = proto.create_sadr_request(addr=addr, uid=uid, newaddr=newAddr)
+        pending = proto.expect()
+        payload = proto.create_sadr_request(
+            addr=addr, uid=uid, newaddr=newAddr, seqnr=pending.seqnr
+        )
         try:
             packet = APPacket(module, addr, payload)
             packet.send()
         except Exception as err:
+            proto.release(pending)
             return make_response(jsonify(FAILURE="{}".format(err)), 400)
-        time.sleep(0.1)
-        reply = proto.get_by_seqnr(seqnr=seqnr)
+        reply = proto.wait_for(pending, reply_timeout)
         return make_response(jsonify(ack=str(reply)), 200)
 
 
@@ -310,16 +586,16 @@ def chnl():
         else:
             module = req_data["module"]
 
-        seqnr = proto.get_seqnr()
+        pending = proto.expect()
         # TODO: Why always addr=0? No possibility to only access phyNodes on spec. channel?
-        payload = proto.create_chnl_request(addr=0, channel=channel)
+        payload = proto.create_chnl_request(addr=0, channel=channel, seqnr=pending.seqnr)
         try:
             packet = APPacket(module, 0, payload)
             packet.send()
         except Exception as err:
+            proto.release(pending)
             return make_response(jsonify(FAILURE="{}".format(err)), 400)
-        time.sleep(0.1)
-        reply = proto.get_by_seqnr(seqnr=seqnr)
+        reply = proto.wait_for(pending, reply_timeout)
         return make_response(jsonify(ack=str(reply)), 200)
 
 
@@ -384,16 +660,18 @@ def seti():
         else:
             amount = req_data["amount"]
 
-        seqnr = proto.get_seqnr()
-        payload = proto.create_set_item_request(addr, itemdescr, amount)
+        pending = proto.expect()
+        payload = proto.create_set_item_request(
+            addr, itemdescr, amount, seqnr=pending.seqnr
+        )
         try:
             packet = APPacket(module, addr, payload)
            # print(packet.pkt.payload)
             packet.send()
         except Exception as err:
+            proto.release(pending)
             return make_response(jsonify(FAILURE="{}".format(err)), 400)
-        time.sleep(1)
-        reply = proto.get_by_seqnr(seqnr=seqnr)
+        reply = proto.wait_for(pending, reply_timeout)
        # print('seti',type(reply))
         return make_response(jsonify(ack=str(reply)), 200)
 
@@ -458,8 +736,21 @@ def ping():
 
 # POLL Q seq ordernumber itemdescr      (RR mode)
 #   >> POLL R seq ordernumber amount phyaddr [energy]
-@app.route("/gateway/POLL", methods=["POST"])
+@app.route("/gateway/POLL", methods=["POST", "GET"])
 def poll():
+    # GET returns the stored replies for an order without sending a POLL
+    if request.method == "GET":
+        if "ordernumber" not in request.args:
+            return make_response(jsonify(FAILURE="ordernumber is not defined! (For Example 42)"), 400)
+        try:
+            ordernumber = int(request.args["ordernumber"])
+        except ValueError as err:
+            return make_response(jsonify(FAILURE="{}".format(err)), 400)
+        return Response(
+            json.dumps(preserver.get_by_ordernumber(ordernumber)),
+            mimetype="application/json",
+        )
+
     req_data = json.loads(request.data)
 
     if request.method == "POST":
@@ -483,42 +774,28 @@ def poll():
         else:
             itemdescr = req_data["itemdescr"]
 
-        payload = proto.create_poll_request(addr, ordernumber, itemdescr)
+        # A broadcast POLL waits for the whole timeout, unless the number
+        # of expected nodes is given.
+        expected = None
+        if "expected" in req_data:
+            expected = int(req_data["expected"])
 
-        final_response = []
-        
         modules = [1,2,3]
 
-        for module in modules:
-            result = []
-            try:
-                result = preserver.get_by_ordernumber(int(ordernumber))
-                packet = APPacket(module, addr, payload)
-                packet.send()
-            
-            except Exception as err:
-                return make_response(jsonify(FAILURE="{}".format(err)), 400)
-
-            time.sleep(1)
-     
-           # result = preserver.get_by_ordernumber(int(ordernumber))
-            result = preserver.received_poll_messages
-             
-            if len(result) == 0:
-               print('module {} no data from phynodes received'.format(module))
-               # return make_response(
-               # jsonify(FAILURE="No data from phynodes received!"), 400)
-            else:
-                # This seems fishy. We only take the first entry of the list 
-                # provided in line 510?
-                # Also the get_by_ordernumber does not care about the module
-                # after sending the package we should be getting every PhyNode, 
-                # whatever module it has!
-                while result:
-                    final_response.append(result.pop())
-               # final_response.append(result)
-               # print('result',result)
-               # return Response(json.dumps(result), mimetype="application/json")
+        # Send on all modules at once and collect in one window, a node
+        # heard on several modules is only listed once.
+        try:
+            final_response = fanout.request(
+                modules,
+                addr,
+                partial(proto.create_poll_request, addr, ordernumber, itemdescr),
+                reply_timeout,
+                expected,
+                key=lambda item: item["phyaddr"],
+            )
+        except Exception as err:
+            return make_response(jsonify(FAILURE="{}".format(err)), 400)
+
         print(final_response)
 
         if len(final_response) == 0:
@@ -587,15 +864,32 @@ def enum():
         else:
             module = req_data["module"]
 
-        payload = proto.create_enum_request(addr=addr)
+        # A unicast is answered once, a broadcast waits for the whole window
+        # unless the number of expected replies is given.
+        expected = None
+        if addr != 0:
+            expected = 1
+        elif "expected" in req_data:
+            expected = int(req_data["expected"])
+
+        pending = proto.expect(expected)
+        payload = proto.create_enum_request(addr=addr, seqnr=pending.seqnr)
         try:
             packet = APPacket(module, addr, payload)
             packet.send()
-            return make_response(
-                jsonify(SUCCESS="ENUM send on address: {:2d}".format(addr)), 200
-            )
         except Exception as err:
+            proto.release(pending)
             return make_response(jsonify(FAILURE="{}".format(err)), 400)
+        if addr == 0:
+            reply = proto.wait_for(
+                pending, float(req_data.get("window", broadcast_window))
+            )
+        else:
+            reply = proto.wait_for(pending, reply_timeout)
+        return make_response(
+            jsonify(SUCCESS="ENUM send on address: {:2d}".format(addr), ack=str(reply)),
+            200,
+        )
 
 
 """
@@ -629,13 +923,13 @@ def rsto():
         payload = proto.create_butn_request(addr=0, buttonid=1)
         try:
             packet = APPacket(1, 0, payload)
-            packet.send()
+            packet.send(priority="control")
             packet = APPacket(2, 0, payload)
-            packet.send()
+            packet.send(priority="control")
             packet = APPacket(3, 0, payload)
-            packet.send()
+            packet.send(priority="control")
             packet = APPacket(4, 0, payload)
-            packet.send()
+            packet.send(priority="control")
         except Exception as err:
             return make_response(jsonify(FAILURE="{}".format(err)), 400)
 
@@ -675,7 +969,7 @@ def bats():
         if "addr" not in req_data:
             return make_response(jsonify(FAILURE="addr is not defined!"), 400)
         else:
-            addr = req_data["addr"]
+            addr = int(req_data["addr"])
 
         # If module not defined, abort.
         if "module" not in req_data:
@@ -686,13 +980,18 @@ def bats():
         else:
             module = req_data["module"]
 
-        payload = proto.create_bats_request(addr, energy)
+        # A broadcast waits for the whole window
+        pending = proto.expect(1 if addr != 0 else None)
+        payload = proto.create_bats_request(addr, energy, seqnr=pending.seqnr)
         try:
             packet = APPacket(module, addr, payload)
             packet.send()
-            return make_response(jsonify(SUCCESSFULL="True"), 200)
         except Exception as err:
+            proto.release(pending)
             return make_response(jsonify(FAILURE="{}".format(err)), 400)
+        timeout = broadcast_window if addr == 0 else reply_timeout
+        reply = proto.wait_for(pending, timeout)
+        return make_response(jsonify(SUCCESSFULL="True", ack=str(reply)), 200)
 
 
 """
@@ -741,7 +1040,7 @@ def butn():
         payload = proto.create_butn_request(addr=addr, buttonid=buttonId)
         try:
             packet = APPacket(module, addr, payload)
-            packet.send()
+            packet.send(priority="control")
             return make_response(
                 jsonify(SUCCESS="BUTN send on address: {:2d}".format(addr)), 200
             )
@@ -837,15 +1136,21 @@ def rsve():
             module = req_data["module"]
 
         preserver.rsve_by_phyaddr(addr, ordernumber)
-        payload = proto.create_reserve_request(addr, ordernumber, amount)
+        pending = proto.expect()
+        payload = proto.create_reserve_request(
+            addr, ordernumber, amount, seqnr=pending.seqnr
+        )
         try:
             packet = APPacket(module, addr, payload)
             packet.send()
-            return make_response(
-                jsonify(SUCCESS="RSVE send on address: {:d}".format(addr)), 200
-            )
         except Exception as err:
+            proto.release(pending)
             return make_response(jsonify(FAILURE="{}".format(err)), 400)
+        reply = proto.wait_for(pending, reply_timeout)
+        return make_response(
+            jsonify(SUCCESS="RSVE send on address: {:d}".format(addr), ack=str(reply)),
+            200,
+        )
 
         # Unreachable code
         # time.sleep(1)
@@ -857,6 +1162,137 @@ def rsve():
         #    return Response(jsonify(blocked=result), mimetype='application/json')
 
 
+"""
+############################################################
+"""
+
+
+# Batch of commands, e.g. provisioning a hall in one call
+#   {"commands": [{"instr": "SADR", "addr": 48, "uid": 2330, "newAddr": 10}, ...],
+#    "stream": false, "timeout": 1.0}
+# Returns one result per command, ordered by index. With "stream": true the
+# results are sent as JSON lines as soon as they complete.
+@app.route("/gateway/batch", methods=["POST"])
+def batch():
+    req_data = json.loads(request.data)
+
+    if request.method == "POST":
+        # If no data in body defined, abort.
+        if req_data is None:
+            return make_response(jsonify(FAILURE="No body defined"), 400)
+
+        if isinstance(req_data, list):
+            req_data = {"commands": req_data}
+
+        commands = req_data.get("commands")
+        if not isinstance(commands, list):
+            return make_response(
+                jsonify(FAILURE='No commands defined. For example "commands": [...]'),
+                400,
+            )
+
+        timeout = req_data.get("timeout")
+        if timeout is not None:
+            timeout = float(timeout)
+
+        results = batcher.run(commands, timeout)
+        if req_data.get("stream", False):
+            return Response(
+                (json.dumps(result) + "\n" for result in results),
+                mimetype="application/x-ndjson",
+            )
+        results = sorted(results, key=lambda result: result["index"])
+        return Response(json.dumps(results), mimetype="application/json")
+
+
+"""
+############################################################
+"""
+
+
+# Link quality per (phyaddr, module) from the RSSI and LQI of received packets
+#   GET /gateway/links?phyaddr=10&since=60
+#   GET /gateway/links?best=1     >> {"10": 2, ...} best module per phyaddr
+@app.route("/gateway/links", methods=["GET"])
+def link_quality():
+    # Invalid numbers are ignored like missing ones
+    phyaddr = request.args.get("phyaddr", type=int)
+    since = request.args.get("since", type=float)
+
+    if request.args.get("best"):
+        return make_response(jsonify(links.best_modules(phyaddr, since)), 200)
+    return Response(
+        json.dumps(links.stats(phyaddr, since)), mimetype="application/json"
+    )
+
+
+"""
+############################################################
+"""
+
+
+# RadioStats export, one row per address (csv or columnar)
+#   GET  /gateway/stats?format=csv            >> streamed while it is written
+#   POST /gateway/stats {"format": "csv"}     >> 202 {"path": ...}, the file is
+#                                                written in the background
+#   GET  /gateway/stats/export                >> state of the file exports
+@app.route("/gateway/stats", methods=["GET", "POST"])
+def stats_export():
+    if request.method == "GET":
+        try:
+            writer, chunks = exporter.stream(request.args.get("format"))
+        except ValueError as err:
+            return make_response(jsonify(FAILURE="{}".format(err)), 400)
+        return Response(chunks, mimetype=writer.mimetype)
+
+    req_data = request.get_json(silent=True) or {}
+    try:
+        path, future = exporter.export(req_data.get("format"))
+    except ValueError as err:
+        return make_response(jsonify(FAILURE="{}".format(err)), 400)
+    return make_response(jsonify(SUCCESS=True, path=path), 202)
+
+
+@app.route("/gateway/stats/export", methods=["GET"])
+def stats_export_state():
+    return make_response(jsonify(exporter.get_counters()), 200)
+
+
+# STAT Q of the nodes' counters, collected in the background
+#   POST /gateway/stats/collect {"addrs": [10, 11], "items": ["ENERGY"], "module": 2}
+#        all fields are optional, default are all known nodes and counters
+#                                               >> 202, 409 if a sweep is running
+#   GET  /gateway/stats/collect                 >> state and summary of the last sweep
+@app.route("/gateway/stats/collect", methods=["GET", "POST"])
+def stats_collect():
+    if request.method == "GET":
+        return make_response(jsonify(collector.get_counters()), 200)
+
+    req_data = request.get_json(silent=True) or {}
+    try:
+        if "addrs" in req_data:
+            addrs = [int(addr) for addr in req_data["addrs"]]
+        else:
+            with preserver.lock:
+                addrs = sorted(
+                    {phynode["phyaddr"] for phynode in preserver.phynode_list}
+                )
+        items = None
+        if "items" in req_data:
+            items = [CCPhyStats[name] for name in req_data["items"]]
+        module = req_data.get("module")
+        if module is not None:
+            module = int(module)
+    except KeyError as err:
+        return make_response(jsonify(FAILURE="Unknown counter {}".format(err)), 400)
+    except (TypeError, ValueError) as err:
+        return make_response(jsonify(FAILURE="{}".format(err)), 400)
+
+    if not collector.start(addrs, items, module):
+        return make_response(jsonify(FAILURE="A sweep is running already"), 409)
+    return make_response(jsonify(SUCCESS=True, nodes=len(addrs)), 202)
+
+
 """
 ############################################################
 """
@@ -870,7 +1306,7 @@ def rese():
         payload = proto.create_butn_request(addr=0, buttonid=1)
         try:
             packet = APPacket(2, 0, payload)
-            packet.send()
+            packet.send(priority="control")
         except Exception as err:
             return make_response(jsonify(FAILURE="{}".format(err)), 400)
 
@@ -889,6 +1325,29 @@ def not_found(error):
     return make_response(jsonify({"error": "Route not found"}), 404)
 
 
+"""
+############################################################
+"""
+
+
+# MQTT commands, /gateway/cmd/<INSTR> is dispatched to /gateway/<INSTR>
+# in-process, without a HTTP round-trip.
+def dispatch_command(instr, method, body):
+    options = {"data": json.dumps(body), "content_type": "application/json"}
+    if method == "GET" and isinstance(body, dict):
+        options["query_string"] = body
+    with app.test_request_context("/gateway/" + instr, method=method, **options):
+        response = app.full_dispatch_request()
+    if response.is_json:
+        return response.status_code, response.get_json()
+    return response.status_code, response.get_data(as_text=True)
+
+
+commands = MqttCommands(mqttc, outbound, dispatch_command)
+mqttc.on_connect = on_connect
+connect_to_mqtt_broker()
+
+
 """
 ############################################################
 """
@@ -912,6 +1371,7 @@ if __name__ == "__main__":
     except IOError as err:
         log(40, "GATEWAY_SERVER", "{}".format(str(err)))
         sys.exit(-1)
+    exporter.start()
 
     time.sleep(1)
 
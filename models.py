@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
 
 
+import atexit
 import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
 
 '''
 ############################################################
@@ -15,21 +21,165 @@ WARNING	    30
 INFO	    20
 DEBUG	    10
 NOTSET	    0
+
+log() checks the level of the topic (or the default level) before the
+message is formatted, args are only formatted into the message if it is
+logged. The records are put into a bounded queue and written to the log
+file (and mirrored to stdout) by a background thread, so the RX path never
+waits for the disk or the terminal. If the queue is full, the record is
+dropped and counted in log_config['dropped'], a warning with the number of
+dropped records is logged at most every DROP_WARNING_INTERVAL seconds.
+With block_timeout > 0 (off by default) a record waits up to that many
+seconds for space before it is dropped, so bursts at DEBUG lose nothing
+but the logging thread may hold up the RX and TX paths.
 '''
 
-logging.basicConfig(
-    filename='_logfile.log',
-    level=logging.DEBUG,
-    format='%(asctime)s %(levelname)-8s: %(message)s'
-)
+LOG_FORMAT = '%(asctime)s %(levelname)-8s: %(message)s'
+
+DROP_WARNING_INTERVAL = 10.0
+
+log_config = {
+    'level': logging.DEBUG,
+    'topics': {},
+    'dropped': 0,
+}
+_listener = None
+_dropped_lock = threading.Lock()
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, queue, block_timeout=0.0):
+        super().__init__(queue)
+        self.block_timeout = block_timeout
+        self.reported = 0
+        self.warned_at = 0.0
+
+    def enqueue(self, record):
+        try:
+            if self.block_timeout > 0:
+                self.queue.put(record, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            with _dropped_lock:
+                log_config['dropped'] += 1
+            return
+        if log_config['dropped'] > self.reported:
+            self.warn_dropped()
+
+    def warn_dropped(self):
+        # Rate limited, there is space in the queue again
+        with _dropped_lock:
+            now = time.monotonic()
+            if now - self.warned_at < DROP_WARNING_INTERVAL:
+                return
+            dropped = log_config['dropped'] - self.reported
+            self.reported = log_config['dropped']
+            self.warned_at = now
+        record = logging.LogRecord(
+            'root', logging.WARNING, __file__, 0,
+            '[{:<20}]: {:d} log records dropped, the queue was full'.format(
+                'LOGGING', dropped
+            ),
+            None, None
+        )
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+    def prepare(self, record):
+        # log() hands over the formatted message, no need to copy the record
+        return record
+
+
+class BlockingStopQueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # put_nowait() would fail on a full queue, the thread drains it
+        self.queue.put(self._sentinel)
 
 
-def log(level, topic, message):
+def configure_logging(level=logging.DEBUG, topics=None, filename='_logfile.log',
+                      max_bytes=0, backup_count=0, rotate_when=None, stdout=True,
+                      queue_size=10000, block_timeout=0.0):
+    global _listener
+
+    if rotate_when:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            filename, when=rotate_when, backupCount=backup_count
+        )
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            filename, maxBytes=max_bytes, backupCount=backup_count
+        )
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handlers = [file_handler]
+    if stdout:
+        stdout_handler = logging.StreamHandler(sys.stdout)
+        stdout_handler.setFormatter(logging.Formatter('%(message)s'))
+        handlers.append(stdout_handler)
+
+    stop_logging()
+    log_queue = queue.Queue(maxsize=queue_size)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(DroppingQueueHandler(log_queue, block_timeout))
+    root.setLevel(logging.DEBUG)
+
+    log_config['level'] = level
+    log_config['topics'] = dict(topics or {})
+    _listener = BlockingStopQueueListener(log_queue, *handlers)
+    _listener.start()
+
+
+def configure_logging_from(section):
+    # [Logging] section of config.ini, topics as "LINE_READER:20, AP_PACKET:20"
+    topics = {}
+    for item in section.get('topics', fallback='').split(','):
+        if item.strip():
+            topic, level = item.split(':')
+            topics[topic.strip()] = int(level)
+    configure_logging(
+        level=section.getint('level', fallback=logging.DEBUG),
+        topics=topics,
+        filename=section.get('file', fallback='_logfile.log'),
+        max_bytes=section.getint('max_bytes', fallback=0),
+        backup_count=section.getint('backup_count', fallback=0),
+        rotate_when=section.get('rotate_when', fallback='').strip() or None,
+        stdout=section.getboolean('stdout', fallback=True),
+        queue_size=section.getint('queue_size', fallback=10000),
+        block_timeout=section.getfloat('block_timeout', fallback=0.0),
+    )
+
+
+def stop_logging():
+    # Writes what is still queued
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def log_enabled(level, topic):
+    return level >= log_config['topics'].get(topic, log_config['level'])
+
+
+def log(level, topic, message, *args):
+    if level < log_config['topics'].get(topic, log_config['level']):
+        return
+    if args:
+        message = message.format(*args)
     logging.log(
         level,
         '[{}]: {}'.format('{:<20}'.format(topic), message)
     )
-    print('[{}]: {}'.format('{:<20}'.format(topic), message))
+
+
+configure_logging()
+atexit.register(stop_logging)
 
 
 '''
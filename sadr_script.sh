@@ -1,47 +1,23 @@
 #!/bin/bash
 
-# KLT_01
-curl --header "Content-Type: application/json" --request POST --data '{"addr":48, "uid":2330,"phyaddr":10}' http://localhost:8760/gateway/SADR
-sleep 0.5s
-# KLT_02
-curl --header "Content-Type: application/json" --request POST --data '{"addr":48, "uid":6202,"phyaddr":11}' http://localhost:8760/gateway/SADR
-sleep 0.5s
-# KLT_03
-curl --header "Content-Type: application/json" --request POST --data '{"addr":48, "uid":9991,"phyaddr":12}' http://localhost:8760/gateway/SADR
-sleep 0.5s
-# KLT_04
-curl --header "Content-Type: application/json" --request POST --data '{"addr":48, "uid":6672,"phyaddr":13}' http://localhost:8760/gateway/SADR
-sleep 0.5s
-# KLT_05
-curl --header "Content-Type: application/json" --request POST --data '{"addr":48, "uid":10502,"phyaddr":14}' http://localhost:8760/gateway/SADR
-sleep 0.5s
-# KLT_06
-curl --header "Content-Type: application/json" --request POST --data '{"addr":48, "uid":2574,"phyaddr":50}' http://localhost:8760/gateway/SADR
-sleep 0.5s
-# KLT_07
-curl --header "Content-Type: application/json" --request POST --data '{"addr":48, "uid":9995,"phyaddr":51}' http://localhost:8760/gateway/SADR
-sleep 0.5s
-# KLT_08
-curl --header "Content-Type: application/json" --request POST --data '{"addr":48, "uid":7946,"phyaddr":52}' http://localhost:8760/gateway/SADR
-sleep 0.5s
-# KLT_09
-curl --header "Content-Type: application/json" --request POST --data '{"addr":48, "uid":6925,"phyaddr":53}' http://localhost:8760/gateway/SADR
-sleep 0.5s
-# KLT_10
-curl --header "Content-Type: application/json" --request POST --data '{"addr":48, "uid":3095,"phyaddr":54}' http://localhost:8760/gateway/SADR
-sleep 0.5s
-# KLT_11
-curl --header "Content-Type: application/json" --request POST --data '{"addr":48, "uid":7437,"phyaddr":55}' http://localhost:8760/gateway/SADR
-sleep 0.5s
-# KLT_12
-curl --header "Content-Type: application/json" --request POST --data '{"addr":48, "uid":9741,"phyaddr":56}' http://localhost:8760/gateway/SADR
-sleep 0.5s
-# KLT_13
-curl --header "Content-Type: application/json" --request POST --data '{"addr":48, "uid":3852,"phyaddr":57}' http://localhost:8760/gateway/SADR
-sleep 0.5s
-# KLT_14
-curl --header "Content-Type: application/json" --request POST --data '{"addr":48, "uid":7483,"phyaddr":58}' http://localhost:8760/gateway/SADR
-sleep 0.5s
-# KLT_15
-curl --header "Content-Type: application/json" --request POST --data '{"addr":48, "uid":2574,"phyaddr":59}' http://localhost:8760/gateway/SADR
-sleep 0.5s
+# KLT_01 ... KLT_15 in one call, the gateway sends them on all modules
+# and returns one result per KLT.
+curl --header "Content-Type: application/json" --request POST --data @- http://localhost:8760/gateway/batch <<'EOF'
+{"commands": [
+    {"instr":"SADR", "addr":48, "uid":2330,"newAddr":10},
+    {"instr":"SADR", "addr":48, "uid":6202,"newAddr":11},
+    {"instr":"SADR", "addr":48, "uid":9991,"newAddr":12},
+    {"instr":"SADR", "addr":48, "uid":6672,"newAddr":13},
+    {"instr":"SADR", "addr":48, "uid":10502,"newAddr":14},
+    {"instr":"SADR", "addr":48, "uid":2574,"newAddr":50},
+    {"instr":"SADR", "addr":48, "uid":9995,"newAddr":51},
+    {"instr":"SADR", "addr":48, "uid":7946,"newAddr":52},
+    {"instr":"SADR", "addr":48, "uid":6925,"newAddr":53},
+    {"instr":"SADR", "addr":48, "uid":3095,"newAddr":54},
+    {"instr":"SADR", "addr":48, "uid":7437,"newAddr":55},
+    {"instr":"SADR", "addr":48, "uid":9741,"newAddr":56},
+    {"instr":"SADR", "addr":48, "uid":3852,"newAddr":57},
+    {"instr":"SADR", "addr":48, "uid":7483,"newAddr":58},
+    {"instr":"SADR", "addr":48, "uid":2574,"newAddr":59}
+]}
+EOF
@@ -1,47 +1,23 @@
 #!/bin/bash
 
-# KLT_01
-curl --header "Content-Type: application/json" --request POST --data '{"addr":10, "itemdescr":0, "amount":0}' http://localhost:8760/gateway/SETI
-sleep 0.5s
-# KLT_02
-curl --header "Content-Type: application/json" --request POST --data '{"addr":11, "itemdescr":0, "amount":0}' http://localhost:8760/gateway/SETI
-sleep 0.5s
-# KLT_03
-curl --header "Content-Type: application/json" --request POST --data '{"addr":12, "itemdescr":0, "amount":0}' http://localhost:8760/gateway/SETI
-sleep 0.5s
-# KLT_04
-curl --header "Content-Type: application/json" --request POST --data '{"addr":13, "itemdescr":0, "amount":0}' http://localhost:8760/gateway/SETI
-sleep 0.5s
-# KLT_05
-curl --header "Content-Type: application/json" --request POST --data '{"addr":14, "itemdescr":0, "amount":0}' http://localhost:8760/gateway/SETI
-sleep 0.5s
-# KLT_06
-curl --header "Content-Type: application/json" --request POST --data '{"addr":50, "itemdescr":1001, "amount":100}' http://localhost:8760/gateway/SETI
-sleep 0.5s
-# KLT_07
-curl --header "Content-Type: application/json" --request POST --data '{"addr":51, "itemdescr":1002, "amount":100}' http://localhost:8760/gateway/SETI
-sleep 0.5s
-# KLT_08
-curl --header "Content-Type: application/json" --request POST --data '{"addr":52, "itemdescr":1003, "amount":100}' http://localhost:8760/gateway/SETI
-sleep 0.5s
-# KLT_09
-curl --header "Content-Type: application/json" --request POST --data '{"addr":53, "itemdescr":1004, "amount":100}' http://localhost:8760/gateway/SETI
-sleep 0.5s
-# KLT_10
-curl --header "Content-Type: application/json" --request POST --data '{"addr":54, "itemdescr":1005, "amount":100}' http://localhost:8760/gateway/SETI
-sleep 0.5s
-# KLT_11
-curl --header "Content-Type: application/json" --request POST --data '{"addr":55, "itemdescr":1006, "amount":100}' http://localhost:8760/gateway/SETI
-sleep 0.5s
-# KLT_12
-curl --header "Content-Type: application/json" --request POST --data '{"addr":56, "itemdescr":1007, "amount":100}' http://localhost:8760/gateway/SETI
-sleep 0.5s
-# KLT_13
-curl --header "Content-Type: application/json" --request POST --data '{"addr":57, "itemdescr":1008, "amount":100}' http://localhost:8760/gateway/SETI
-sleep 0.5s
-# KLT_14
-curl --header "Content-Type: application/json" --request POST --data '{"addr":58, "itemdescr":1009, "amount":100}' http://localhost:8760/gateway/SETI
-sleep 0.5s
-# KLT_15
-curl --header "Content-Type: application/json" --request POST --data '{"addr":59, "itemdescr":1010, "amount":100}' http://localhost:8760/gateway/SETI
-sleep 0.5s
+# KLT_01 ... KLT_15 in one call, the gateway sends them on all modules
+# and returns one result per KLT.
+curl --header "Content-Type: application/json" --request POST --data @- http://localhost:8760/gateway/batch <<'EOF'
+{"commands": [
+    {"instr":"SETI", "addr":10, "itemdescr":0, "amount":0},
+    {"instr":"SETI", "addr":11, "itemdescr":0, "amount":0},
+    {"instr":"SETI", "addr":12, "itemdescr":0, "amount":0},
+    {"instr":"SETI", "addr":13, "itemdescr":0, "amount":0},
+    {"instr":"SETI", "addr":14, "itemdescr":0, "amount":0},
+    {"instr":"SETI", "addr":50, "itemdescr":1001, "amount":100},
+    {"instr":"SETI", "addr":51, "itemdescr":1002, "amount":100},
+    {"instr":"SETI", "addr":52, "itemdescr":1003, "amount":100},
+    {"instr":"SETI", "addr":53, "itemdescr":1004, "amount":100},
+    {"instr":"SETI", "addr":54, "itemdescr":1005, "amount":100},
+    {"instr":"SETI", "addr":55, "itemdescr":1006, "amount":100},
+    {"instr":"SETI", "addr":56, "itemdescr":1007, "amount":100},
+    {"instr":"SETI", "addr":57, "itemdescr":1008, "amount":100},
+    {"instr":"SETI", "addr":58, "itemdescr":1009, "amount":100},
+    {"instr":"SETI", "addr":59, "itemdescr":1010, "amount":100}
+]}
+EOF
@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+
+"""
+Stand-in for SFBGateway.app with simulated PhyNodes.
+
+Creates RX_FIFO and TX_FIFO like SFBGateway.app does and speaks the same
+byte formats: AP_PACKET_SIZE records are read from TX_FIFO, received
+packets are written to RX_FIFO as module, status1, status2, length,
+address, payload, "\r\n". Every sent packet is followed by the 75 ms
+delay of readFifoLoop.
+
+The PhyNodes are spread over the 4 modules. A request sent on any module
+reaches every node it is addressed to (0 is broadcast), the reply comes
+back on the same module, weaker the further away the home module of the
+node is. Replies are delayed by a random latency, lost with a given
+probability and collide with every other reply on the same module that is
+on air at the same time. Binary requests (see BinaryCodec) are answered in
+the same form.
+
+DUID and ENUM broadcasts can carry a number of slots and their length in
+ms, the nodes answer them in a random slot (see Discovery).
+
+The nodes also send FULE, LOWE and RSTO messages on their own.
+
+Run from the repository root, before gateway_server.py:
+    python3 sfb_simulator.py --nodes 200 --loss 0.02
+"""
+
+import argparse
+import heapq
+import os
+import random
+import signal
+import struct
+import sys
+import threading
+import time
+
+from models import log
+from gateway_interface import AP_PACKET_SIZE, RX_FIFO, TX_FIFO, BinaryCodec, Preserver
+
+
+# Radio settings of CC1200_RPi_reg_config.h: 38.4 kbps, 24 bytes preamble,
+# 4 bytes sync word, length, address and CRC-16
+BITRATE = 38400
+FRAME_OVERHEAD = 24 + 4 + 1 + 1 + 2
+
+MODULES = [1, 2, 3, 4]
+
+# Address of a node that has not been assigned one (see sadr_script.sh)
+FRESH_ADDR = 48
+
+
+def airtime(length):
+    return (FRAME_OVERHEAD + length) * 8 / BITRATE
+
+
+"""
+############################################################
+"""
+
+
+"""
+SimNode is the state of one simulated PhyNode. handle() returns the reply
+to a request as list of fields, or None if the node stays silent.
+"""
+
+
+class SimNode:
+    def __init__(self, uid, phyaddr, module, rssi, item, amount):
+        self.uid = uid
+        self.phyaddr = phyaddr
+        self.module = module
+        self.rssi = rssi
+        self.item = item
+        self.amount = amount
+        self.energy = random.randint(20, 100)
+        self.ordernumber = 0
+        self.channel = 0
+        self.requests = 0
+
+    def __call__(self):
+        return self
+
+    def rssi_on(self, module):
+        # dBm as signed byte in status1, 6 dB less per module in between
+        return (self.rssi - 6 * abs(module - self.module)) & 0xFF
+
+    def handle(self, instr, fields):
+        seqnr = fields[0]
+        self.requests += 1
+        if instr == "PING":
+            return ["PING", "R", seqnr]
+        elif instr == "DUID":
+            return ["DUID", "R", seqnr, self.uid, self.phyaddr]
+        elif instr == "SADR":
+            if int(fields[1]) != self.uid:
+                return None
+            self.phyaddr = int(fields[2])
+            return ["SADR", "R", seqnr, "ACK"]
+        elif instr == "CHNL":
+            self.channel = int(fields[1])
+            return ["CHNL", "R", seqnr, "ACK"]
+        elif instr == "SETI":
+            self.item = int(fields[1])
+            self.amount = int(fields[2])
+            return ["SETI", "R", seqnr]
+        elif instr == "POLL":
+            if int(fields[2]) != self.item:
+                return None
+            ordernumber = int(fields[1])
+            return [
+                "POLL",
+                "R",
+                seqnr,
+                ordernumber,
+                self.amount,
+                self.phyaddr,
+                self.energy,
+            ]
+        elif instr == "ENUM":
+            return [
+                "ENUM",
+                "R",
+                seqnr,
+                self.item,
+                self.amount,
+                self.phyaddr,
+                self.ordernumber,
+                self.amount if self.ordernumber else 0,
+            ]
+        elif instr == "RSVE":
+            self.ordernumber = int(fields[1])
+            return ["RSVE", "R", seqnr, self.ordernumber]
+        elif instr == "BATS":
+            return ["BATS", "R", seqnr, self.energy]
+        elif instr == "STAT":
+            # ENERGY and RX_SUCCESS_PKG, the other counters stay 0
+            item = int(fields[1])
+            value = {1: self.energy, 4: self.requests}.get(item, 0)
+            return ["STAT", "R", seqnr, value]
+        return None
+
+    def spontaneous(self):
+        if self.ordernumber and random.random() < 0.3:
+            ordernumber = self.ordernumber
+            self.ordernumber = 0
+            return ["RSTO", "M", self.phyaddr, self.uid, ordernumber]
+        self.energy = max(0, min(100, self.energy + random.randint(-5, 3)))
+        return ["LOWE" if self.energy < 20 else "FULE", "M", self.phyaddr, self.energy]
+
+
+"""
+############################################################
+"""
+
+
+"""
+SFBSimulator reads TX_FIFO in one thread (TX_LOOP), schedules the replies
+of the nodes and writes them to RX_FIFO from another (AIR_LOOP).
+
+Transmissions are kept per module in a heap ordered by start time. A
+transmission is delivered if no other transmission on the same module
+overlaps with it, otherwise it is counted as collided.
+"""
+
+
+class SFBSimulator:
+    def __init__(
+        self,
+        nodes,
+        latency=(0.005, 0.05),
+        loss=0.0,
+        tx_delay=0.075,
+        message_interval=5.0,
+        rx_path=RX_FIFO,
+        tx_path=TX_FIFO,
+    ):
+        self.nodes = nodes
+        self.latency = latency
+        self.loss = loss
+        self.tx_delay = tx_delay
+        self.message_interval = message_interval
+        self.rx_path = rx_path
+        self.tx_path = tx_path
+        self.codec = BinaryCodec()
+        self.counters = {
+            "requests": 0,
+            "replies": 0,
+            "messages": 0,
+            "lost": 0,
+            "collided": 0,
+        }
+        self.__air = {module: [] for module in MODULES}
+        self.__last_end = {module: 0.0 for module in MODULES}
+        self.__cond = threading.Condition()
+        self.__stop = False
+
+    def __call__(self):
+        return self
+
+    @classmethod
+    def with_nodes(cls, count, fresh=0, **kwargs):
+        # The nodes the Preserver knows first, so its state follows them.
+        # Preserver.init() only returns the initial list. Fresh nodes come
+        # last, they all have the address FRESH_ADDR until they get one.
+        known = [
+            (phynode["uid"], phynode["phyaddr"]) for phynode in Preserver.init(None)
+        ]
+        nodes = []
+        for index in range(0, count):
+            if index < len(known):
+                uid, phyaddr = known[index]
+            elif index >= count - fresh:
+                uid, phyaddr = 30000 + index, FRESH_ADDR
+            else:
+                uid, phyaddr = 20000 + index, 100 + index
+            nodes.append(
+                SimNode(
+                    uid,
+                    phyaddr,
+                    MODULES[index % len(MODULES)],
+                    random.randint(-90, -40),
+                    1001 + index % 5,
+                    random.randint(0, 20),
+                )
+            )
+        return cls(nodes, **kwargs)
+
+    def create_fifos(self):
+        for path in [self.tx_path, self.rx_path]:
+            if os.path.exists(path):
+                os.remove(path)
+            os.mkfifo(path, 0o666)
+
+    def remove_fifos(self):
+        for path in [self.tx_path, self.rx_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def run(self):
+        self.create_fifos()
+        log(20, "SFB_SIMULATOR", "{:d} PhyNodes, FIFOs created".format(len(self.nodes)))
+        threads = [
+            threading.Thread(name="TX_LOOP", target=self._tx_loop, daemon=True),
+            threading.Thread(name="AIR_LOOP", target=self._air_loop, daemon=True),
+        ]
+        if self.message_interval > 0:
+            threads.append(
+                threading.Thread(
+                    name="MESSAGE_LOOP", target=self._message_loop, daemon=True
+                )
+            )
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def stop(self):
+        with self.__cond:
+            self.__stop = True
+            self.__cond.notify_all()
+        self.remove_fifos()
+
+    # ~~~ TX_FIFO ~~~
+
+    def _tx_loop(self):
+        log(10, "TX_LOOP", "Waiting for data in TX_FIFO ({})".format(self.tx_path))
+        # Like readFifoLoop, every module pauses tx_delay after sending
+        next_tx = {}
+        while not self.__stop:
+            with open(self.tx_path, "rb", buffering=0) as tx_fifo:
+                while not self.__stop:
+                    record = self._read_record(tx_fifo)
+                    if record is None:
+                        # EOF, all writers closed the FIFO
+                        break
+                    delay = next_tx.get(record[0], 0.0) - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    self.transmit(record)
+                    next_tx[record[0]] = time.monotonic() + self.tx_delay
+
+    def _read_record(self, tx_fifo):
+        record = b""
+        while len(record) < AP_PACKET_SIZE:
+            data = tx_fifo.read(AP_PACKET_SIZE - len(record))
+            if len(data) == 0:
+                return None
+            record += data
+        return record
+
+    def transmit(self, record):
+        module, status1, status2, length, address = struct.unpack("BBBBB", record[:5])
+        payload = record[5 : 5 + length]
+        binary = self.codec.is_binary(payload)
+        try:
+            line = self.codec.decode(payload) if binary else payload
+            fields = line.decode().split(" ")
+        except (ValueError, UnicodeDecodeError) as err:
+            log(40, "TX_LOOP", "Invalid packet: {}".format(err))
+            return
+        if len(fields) < 3 or fields[1] != "Q":
+            return
+        self.counters["requests"] += 1
+        now = time.monotonic()
+        for node in self.nodes:
+            if address != 0 and address != node.phyaddr:
+                continue
+            if random.random() < self.loss:
+                self.counters["lost"] += 1
+                continue
+            reply = node.handle(fields[0], fields[2:])
+            if reply is None:
+                continue
+            reply = " ".join(map(str, reply)).encode()
+            if binary:
+                reply = self.codec.encode(
+                    reply, "binary" if payload[0] & 0x40 else "compact"
+                )
+            self.schedule(module, node, reply, now + self.delay(fields))
+
+    def delay(self, fields):
+        # DUID and ENUM broadcasts with "slots slot_ms" are answered in a
+        # random slot, counted from the earliest reply
+        if fields[0] in ("DUID", "ENUM") and len(fields) >= 5:
+            slot = random.randrange(0, int(fields[3])) * int(fields[4]) / 1000
+            return self.latency[0] + slot
+        return random.uniform(*self.latency)
+
+    # ~~~ On air ~~~
+
+    def schedule(self, module, node, payload, start):
+        with self.__cond:
+            heapq.heappush(
+                self.__air[module],
+                (start, start + airtime(len(payload)), id(payload), node, payload),
+            )
+            self.__cond.notify_all()
+
+    def _next(self):
+        # The transmission that starts next on any module
+        heads = [(air[0][0], module) for module, air in self.__air.items() if air]
+        return min(heads) if heads else None
+
+    def _air_loop(self):
+        log(10, "AIR_LOOP", "Started!")
+        rx_fifo = open(self.rx_path, "ab", buffering=0)
+        while True:
+            with self.__cond:
+                while not self.__stop:
+                    head = self._next()
+                    if head is not None and head[0] <= time.monotonic():
+                        break
+                    self.__cond.wait(
+                        None if head is None else head[0] - time.monotonic()
+                    )
+                if self.__stop:
+                    break
+                air = self.__air[head[1]]
+                start, end, _, node, payload = heapq.heappop(air)
+                collided = start < self.__last_end[head[1]] or (air and air[0][0] < end)
+                self.__last_end[head[1]] = max(self.__last_end[head[1]], end)
+
+            if collided:
+                self.counters["collided"] += 1
+                continue
+            # Received at the end of the transmission
+            time.sleep(max(0.0, end - time.monotonic()))
+            self.counters["replies"] += 1
+            frame = self.frame(head[1], node, payload)
+            try:
+                rx_fifo.write(frame)
+            except BrokenPipeError:
+                # The gateway went away, wait for the next one
+                log(30, "AIR_LOOP", "Nobody reads RX_FIFO")
+                rx_fifo.close()
+                rx_fifo = open(self.rx_path, "ab", buffering=0)
+        rx_fifo.close()
+
+    def frame(self, module, node, payload):
+        return (
+            bytes([module, node.rssi_on(module), 0x80 | random.randint(0, 0x7F)])
+            + bytes([len(payload), 0])
+            + payload
+            + b"\r\n"
+        )
+
+    # ~~~ Spontaneous messages ~~~
+
+    def _message_loop(self):
+        while not self.__stop:
+            time.sleep(random.expovariate(len(self.nodes) / self.message_interval))
+            node = random.choice(self.nodes)
+            message = " ".join(map(str, node.spontaneous())).encode()
+            self.counters["messages"] += 1
+            self.schedule(node.module, node, message, time.monotonic())
+
+
+"""
+############################################################
+"""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--nodes", type=int, default=14)
+    parser.add_argument(
+        "--fresh", type=int, default=0, help="how many of the nodes have no address"
+    )
+    parser.add_argument("--latency-min", type=float, default=0.005, help="seconds")
+    parser.add_argument("--latency-max", type=float, default=0.05, help="seconds")
+    parser.add_argument("--loss", type=float, default=0.0, help="0..1 per packet")
+    parser.add_argument("--tx-delay", type=float, default=0.075, help="seconds")
+    parser.add_argument(
+        "--message-interval",
+        type=float,
+        default=5.0,
+        help="mean seconds between spontaneous messages of one node, 0 is off",
+    )
+    parser.add_argument("--stats-interval", type=float, default=10.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    simulator = SFBSimulator.with_nodes(
+        args.nodes,
+        fresh=args.fresh,
+        latency=(args.latency_min, args.latency_max),
+        loss=args.loss,
+        tx_delay=args.tx_delay,
+        message_interval=args.message_interval,
+    )
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    simulator.run()
+    try:
+        while True:
+            time.sleep(args.stats_interval)
+            log(20, "SFB_SIMULATOR", str(simulator.counters))
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        simulator.stop()
+        log(20, "SFB_SIMULATOR", "Stopped, {}".format(simulator.counters))
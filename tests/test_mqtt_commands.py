@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+"""
+MqttCommands with the command layer of gateway_server.
+
+A fake paho client takes the subscription, the messages are delivered
+through the callback MqttCommands registered, like the network loop of
+paho does, and end up in gateway_server.dispatch_command. The replies are
+recorded by a stand-in for MqttOutbound.
+
+gateway_server is imported in a temporary directory with a copy of
+config.ini, so the files it writes (preserver state, DHCP leases, log)
+stay out of the tree, and with the fake client, so it connects nowhere.
+
+    python3 -m pytest -q tests
+"""
+
+import importlib
+import json
+import os
+import shutil
+import sys
+import types
+
+import paho.mqtt.client as mqtt
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+class FakeClient:
+    def __init__(self, *args, **kwargs):
+        self.callbacks = {}
+        self.subscriptions = []
+
+    def connect(self, *args, **kwargs):
+        return 0
+
+    def loop_start(self):
+        pass
+
+    def publish(self, *args, **kwargs):
+        pass
+
+    def message_callback_add(self, pattern, callback):
+        self.callbacks[pattern] = callback
+
+    def subscribe(self, pattern, *args, **kwargs):
+        self.subscriptions.append(pattern)
+
+    def deliver(self, topic, payload):
+        # What the network loop does for a message on a subscribed topic
+        prefix = topic.rsplit("/", 1)[0] + "/+"
+        message = types.SimpleNamespace(topic=topic, payload=payload)
+        self.callbacks[prefix](self, None, message)
+
+
+class Outbound:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.published.append((topic, json.loads(payload)))
+
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("gateway")
+    shutil.copy(os.path.join(ROOT, "config.ini"), directory)
+    cwd = os.getcwd()
+    client = mqtt.Client
+    os.chdir(directory)
+    mqtt.Client = FakeClient
+    try:
+        server = importlib.import_module("gateway_server")
+        yield server
+        # Writes behind into the relative path, before the directory changes
+        server.store.stop()
+    finally:
+        mqtt.Client = client
+        os.chdir(cwd)
+
+
+@pytest.fixture
+def commands(server):
+    from gateway_interface import MqttCommands
+
+    client = FakeClient()
+    outbound = Outbound()
+    commands = MqttCommands(
+        client,
+        outbound,
+        server.dispatch_command,
+        topic="/gateway/cmd",
+        response_topic="/gateway/response",
+        workers=1,
+    )
+    commands.subscribe()
+    yield client, commands, outbound.published
+    commands.stop()
+
+
+def test_subscribes_to_the_command_topic(commands):
+    client, commands, published = commands
+    assert client.subscriptions == ["/gateway/cmd/+"]
+
+
+def test_command_reply_on_the_response_topic(server, commands):
+    client, commands, published = commands
+    client.deliver("/gateway/cmd/links", b'{"id": "42", "method": "GET"}')
+    commands.stop()
+    assert published == [
+        (
+            "/gateway/response/links/42",
+            {
+                "id": "42",
+                "instr": "links",
+                "status": 200,
+                "body": server.links.stats(None, None),
+            },
+        )
+    ]
+
+
+def test_reply_to_overrides_the_response_topic(commands):
+    client, commands, published = commands
+    client.deliver(
+        "/gateway/cmd/links",
+        b'{"id": "7", "method": "GET", "reply_to": "/client/replies"}',
+    )
+    commands.stop()
+    assert [(topic, reply["id"]) for topic, reply in published] == [
+        ("/client/replies", "7")
+    ]
+
+
+def test_unknown_command_is_answered_with_an_error(commands):
+    client, commands, published = commands
+    client.deliver("/gateway/cmd/NOPE", b'{"id": "43"}')
+    commands.stop()
+    assert published == [
+        (
+            "/gateway/response/NOPE/43",
+            {
+                "id": "43",
+                "instr": "NOPE",
+                "status": 404,
+                "body": {"error": "Route not found"},
+            },
+        )
+    ]
+
+
+def test_invalid_payload_is_answered_without_dispatch(commands):
+    client, commands, published = commands
+    client.deliver("/gateway/cmd/PING", b"[1, 2]")
+    assert published == [
+        (
+            "/gateway/response/PING",
+            {
+                "id": None,
+                "instr": "PING",
+                "status": 400,
+                "body": {"FAILURE": "payload is not a JSON object"},
+            },
+        )
+    ]
+    assert commands.get_counters() == {"received": 1, "invalid": 1}
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+"""
+Multithreaded stress test for the seqnr allocation and reply matching of
+CCPhyParser.
+
+Every client thread does what a RR mode route does: expect(), build a
+request with the reserved seqnr and wait for the reply. A radio thread
+answers every request after a random latency, some of them too late and
+some twice. The test fails if two outstanding requests shared a seqnr or a
+request got a reply that was meant for another one.
+
+    python3 -m pytest -q tests
+    python3 tests/test_seqnr.py [threads] [requests per thread]
+"""
+
+import heapq
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gateway_interface
+from gateway_interface import CCPhyParser
+
+TIMEOUT = 0.05
+
+
+def radio(proto, requests, stop):
+    due = []
+    while not stop.is_set() or not requests.empty() or due:
+        try:
+            while True:
+                payload, sent = requests.get_nowait()
+                # "SETI Q <seqnr> <token> 0"
+                seqnr, token = map(int, payload.decode().split(" ")[2:4])
+                latency = random.choice([0.001, 0.005, 0.02, TIMEOUT * 2])
+                for i in range(0, 2 if random.random() < 0.05 else 1):
+                    heapq.heappush(due, (sent + latency, seqnr, token))
+        except queue.Empty:
+            pass
+        while due and due[0][0] <= time.monotonic():
+            tm, seqnr, token = heapq.heappop(due)
+            proto.log_by_seqnr(seqnr, {"token": token})
+        time.sleep(0.0005)
+
+
+def client(proto, requests, count, tokens, outstanding, lock, errors, answered):
+    for i in range(0, count):
+        token = next(tokens)
+        pending = proto.expect()
+        with lock:
+            if pending.seqnr in outstanding:
+                errors.append("seqnr {:d} handed out twice".format(pending.seqnr))
+            outstanding.add(pending.seqnr)
+        payload = proto.create_set_item_request(0, token, seqnr=pending.seqnr)
+        requests.put((payload, time.monotonic()))
+        replys = pending.wait(TIMEOUT)
+        with lock:
+            outstanding.discard(pending.seqnr)
+        proto.release(pending)
+        for reply in replys:
+            if reply["token"] != token:
+                errors.append(
+                    "seqnr {:d}: got reply for {:d}, expected {:d}".format(
+                        pending.seqnr, reply["token"], token
+                    )
+                )
+        if replys:
+            answered.append(token)
+
+
+def stress(threads, count):
+    # Returns the errors, the answered tokens, the counters and the duration
+    proto = CCPhyParser(ttl=1.0, hold=TIMEOUT * 4)
+    requests = queue.Queue()
+    stop = threading.Event()
+    tokens = iter(range(0, threads * count))
+    outstanding = set()
+    lock = threading.Lock()
+    errors = []
+    answered = []
+
+    radio_thread = threading.Thread(target=radio, args=(proto, requests, stop))
+    radio_thread.start()
+    clients = [
+        threading.Thread(
+            target=client,
+            args=(proto, requests, count, tokens, outstanding, lock, errors, answered),
+        )
+        for i in range(0, threads)
+    ]
+    start = time.perf_counter()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    radio_thread.join()
+    return errors, answered, proto.get_counters(), elapsed
+
+
+def test_no_shared_seqnr_and_no_foreign_reply():
+    random.seed(0)
+    errors, answered, counters, elapsed = stress(48, 50)
+    assert errors == []
+    assert answered
+    assert counters["pending"] == 0
+
+
+def test_released_seqnr_is_held():
+    proto = CCPhyParser(hold=60.0)
+    pending = proto.expect()
+    proto.release(pending)
+    # One more than the other seqnrs, the last one wraps around
+    seqnrs = [proto.next_seqnr() for i in range(0, 255)]
+    assert pending.seqnr not in seqnrs
+    assert proto.get_counters()["skipped"] == 1
+
+
+def test_seqnr_without_pending_is_not_held():
+    # Fire-and-forget requests (PING, BUTN) are not limited by the hold
+    proto = CCPhyParser(hold=60.0)
+    start = time.monotonic()
+    seqnrs = [proto.next_seqnr() for i in range(0, 1000)]
+    assert time.monotonic() - start < 1.0
+    assert seqnrs[:255] == list(range(0, 255))
+    assert proto.get_counters()["exhausted"] == 0
+
+
+if __name__ == "__main__":
+    gateway_interface.log = lambda level, topic, message, *args: None
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 48
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    errors, answered, counters, elapsed = stress(threads, count)
+    print(
+        "{:d} requests from {:d} threads in {:.2f} s, {:d} answered in time".format(
+            threads * count, threads, elapsed, len(answered)
+        )
+    )
+    print("counters: {}".format(counters))
+    for error in errors[:10]:
+        print("[E] {}".format(error))
+    sys.exit(1 if errors else 0)